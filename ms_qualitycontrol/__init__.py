@@ -1,7 +1,3 @@
-from .app import app
-# from . import functions
-# from . import plotting_functions
-# from . import main_calculations
-from . import controller
-from .view import apply_app_layout
-from . import analysis
\ No newline at end of file
+# the Dash app (app, controller, view) is imported by run.py, so the analysis and batch modules can be used
+# without a web server
+from . import analysis
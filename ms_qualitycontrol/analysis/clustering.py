@@ -0,0 +1,186 @@
+import numpy as np
+
+# Ward clustering of the correlation map with bounded memory. scipy's linkage needs the condensed distance matrix
+# next to the proteins x proteins correlation matrix. Here the clusters are kept as centroids and sizes only, and
+# the nearest-neighbor chain (Ward is reducible, so merging reciprocal nearest neighbours gives the same tree as
+# the greedy algorithm) finds the merges with one matrix-vector product per step. Large maps are first projected
+# to a few hundred dimensions, reading the correlation matrix (which may be memory-mapped) in blocks of rows;
+# random projections keep the euclidean distances of the profiles. Very large maps can be pre-clustered by k-means,
+# the proteins of every k-means cluster are then clustered on their own and the clusters on top of them.
+
+BLOCK_ROWS = 2000
+KMEANS_ITERATIONS = 10
+
+
+def iter_blocks(n_rows, block_rows=BLOCK_ROWS):
+    for start in range(0, n_rows, block_rows):
+        yield slice(start, min(start + block_rows, n_rows))
+
+
+def finite_rows(points, rows):
+    # missing correlations count as 0
+    return np.nan_to_num(np.asarray(points[rows], dtype=np.float64))
+
+
+def random_projection(matrix, dims, seed=0, block_rows=BLOCK_ROWS):
+    """
+    Projects the rows of a matrix to dims dimensions, missing correlations count as 0.
+    Args:
+        matrix: A proteins x proteins correlation matrix, may be memory-mapped.
+        dims: Number of dimensions, None or at least the number of columns keeps the rows as they are.
+        seed: A seed of the projection.
+        block_rows: Number of rows read at once.
+
+    Returns:A proteins x dims array, or the matrix itself if it isn't projected.
+
+    """
+    n_rows, n_columns = matrix.shape
+    if dims is None or dims >= n_columns:
+        return matrix
+    projection = np.random.default_rng(seed).standard_normal((n_columns, dims)) / np.sqrt(dims)
+    out = np.empty((n_rows, dims))
+    for block in iter_blocks(n_rows, block_rows):
+        out[block] = finite_rows(matrix, block).dot(projection)
+    return out
+
+
+def nn_chain(points, sizes=None):
+    """
+    Ward clustering by the nearest-neighbor chain algorithm.
+    Args:
+        points: An observations x features array (the centroids if sizes are given).
+        sizes: Number of observations behind every point, 1 if None.
+
+    Returns:The merges (first point, second point, height) in the order they were found, every cluster is named
+    after one of its points. Heights are the Ward distances of scipy's linkage.
+
+    """
+    n = len(points)
+    centroids = finite_rows(points, slice(None))
+    sizes = np.ones(n) if sizes is None else np.array(sizes, dtype=np.float64)
+    norms = np.einsum('ij,ij->i', centroids, centroids)
+    active = np.ones(n, dtype=bool)
+    merges, chain = [], []
+    for remaining in range(n - 1, 0, -1):
+        while True:
+            if not chain:
+                chain.append(int(np.argmax(active)))
+            x = chain[-1]
+            distances = np.maximum(norms + norms[x] - 2 * centroids.dot(centroids[x]), 0)
+            cost = sizes * sizes[x] / (sizes + sizes[x]) * distances
+            cost[~active] = np.inf
+            cost[x] = np.inf
+            y = int(np.argmin(cost))
+            # prefer the previous link on ties, so the chain always ends in reciprocal nearest neighbours
+            if len(chain) > 1 and cost[chain[-2]] <= cost[y]:
+                y = chain[-2]
+            if len(chain) > 1 and y == chain[-2]:
+                break
+            chain.append(y)
+        chain = chain[:-2]
+        merges.append((x, y, float(np.sqrt(2 * cost[y]))))
+        size = sizes[x] + sizes[y]
+        centroids[y] = (sizes[x] * centroids[x] + sizes[y] * centroids[y]) / size
+        norms[y] = centroids[y].dot(centroids[y])
+        sizes[y], sizes[x], active[x] = size, 0, False
+    return merges
+
+
+def linkage_from_merges(merges, n):
+    """
+    Builds a scipy linkage matrix from merges named after points, in the given order.
+    """
+    parent = np.arange(2 * n - 1)
+    counts = np.concatenate([np.ones(n), np.zeros(n - 1)])
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    linkage_matrix = np.empty((len(merges), 4))
+    for k, (x, y, height) in enumerate(merges):
+        a, b = sorted((find(x), find(y)))
+        counts[n + k] = counts[a] + counts[b]
+        linkage_matrix[k] = a, b, height, counts[n + k]
+        parent[a] = parent[b] = n + k
+    return linkage_matrix
+
+
+def sorted_merges(merges):
+    return sorted(merges, key=lambda merge: merge[2])
+
+
+def kmeans(points, k, seed=0, iterations=KMEANS_ITERATIONS, block_rows=BLOCK_ROWS):
+    """
+    Lloyd's k-means started from k random points.
+    Returns:The cluster of every point.
+
+    """
+    rng = np.random.default_rng(seed)
+    centers = finite_rows(points, np.sort(rng.choice(len(points), k, replace=False)))
+    labels = np.zeros(len(points), dtype=np.int64)
+    for iteration in range(iterations):
+        center_norms = np.einsum('ij,ij->i', centers, centers)
+        sums = np.zeros_like(centers)
+        for block in iter_blocks(len(points), block_rows):
+            values = finite_rows(points, block)
+            labels[block] = np.argmin(center_norms - 2 * values.dot(centers.T), axis=1)
+            np.add.at(sums, labels[block], values)
+        counts = np.bincount(labels, minlength=k)
+        # empty clusters keep their center
+        filled = counts > 0
+        centers[filled] = sums[filled] / counts[filled][:, np.newaxis]
+    return labels
+
+
+def preclustered_merges(points, k, seed=0):
+    """
+    Ward clustering of the points inside every k-means cluster, followed by the Ward clustering of the clusters.
+    The distance of two centroids can be lower than the merges inside the clusters, so the height of every merge
+    of clusters is raised to the heights of its children to keep the dendrogram monotone.
+    Returns:The merges sorted by height.
+
+    """
+    labels = kmeans(points, k, seed)
+    merges, representatives, centroids, sizes, heights = [], [], [], [], []
+    for cluster in np.unique(labels):
+        members = np.flatnonzero(labels == cluster)
+        cluster_points = finite_rows(points, members)
+        cluster_merges = sorted_merges(nn_chain(cluster_points))
+        merges.extend((members[x], members[y], height) for x, y, height in cluster_merges)
+        representatives.append(members[0])
+        centroids.append(cluster_points.mean(axis=0))
+        sizes.append(len(members))
+        heights.append(max([height for x, y, height in cluster_merges] or [0.0]))
+    for x, y, height in sorted_merges(nn_chain(np.array(centroids), sizes)):
+        # y stands for the merged clusters from now on
+        heights[y] = max(height, heights[x], heights[y])
+        merges.append((representatives[x], representatives[y], heights[y]))
+    # the merges of all clusters in the order of their heights, a stable sort keeps every merge after its children
+    return sorted_merges(merges)
+
+
+def ward_linkage(matrix, dims=None, preclusters=None, seed=0, block_rows=BLOCK_ROWS):
+    """
+    Ward linkage of the rows of a correlation matrix like scipy's linkage(matrix, 'ward'), without the
+    condensed distance matrix.
+    Args:
+        matrix: A proteins x proteins correlation matrix, may be memory-mapped.
+        dims: Number of dimensions of the random projection of the rows, None clusters the rows as they are.
+        preclusters: Number of k-means clusters formed first if there are more proteins, None never pre-clusters.
+        seed: A seed of the projection and of k-means.
+        block_rows: Number of rows read at once.
+
+    Returns:A linkage matrix.
+
+    """
+    points = random_projection(matrix, dims, seed, block_rows)
+    if preclusters is not None and len(points) > preclusters:
+        merges = preclustered_merges(points, preclusters, seed)
+    else:
+        merges = sorted_merges(nn_chain(points))
+    return linkage_from_merges(merges, len(points))
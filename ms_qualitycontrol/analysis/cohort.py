@@ -0,0 +1,171 @@
+import json
+import os
+import uuid
+
+import numpy as np
+
+from . import functions as fn
+
+# Reference distributions of the contamination ratios across many studies. Every panel keeps a small mergeable
+# sketch of all sample ratios seen so far: count, mean and sum of squared deviations (merged like parallel
+# variance), the sum of reciprocals (for the harmonic mean) and a histogram over log10 ratios with
+# HISTOGRAM_RESOLUTION bins per decade, which answers quantile queries to within about 1% of the ratio.
+# Sketches of two cohorts are merged by adding them up, so studies can be added in any order, in parallel
+# workers, and without the original files. A cohort is stored as one JSON file and knows the content digests of
+# its studies, so adding the same file twice has no effect.
+
+HISTOGRAM_MIN = -8
+HISTOGRAM_MAX = 8
+HISTOGRAM_RESOLUTION = 100
+COHORT_VERSION = 1
+
+
+def empty_sketch():
+    return {'count': 0, 'mean': 0.0, 'm2': 0.0, 'reciprocal_sum': 0.0, 'zeros': 0, 'invalid': 0,
+            'histogram': [0] * ((HISTOGRAM_MAX - HISTOGRAM_MIN) * HISTOGRAM_RESOLUTION)}
+
+
+def histogram_bins(values):
+    bins = np.floor((np.log10(values) - HISTOGRAM_MIN) * HISTOGRAM_RESOLUTION).astype(np.int64)
+    return np.clip(bins, 0, (HISTOGRAM_MAX - HISTOGRAM_MIN) * HISTOGRAM_RESOLUTION - 1)
+
+
+def sketch_of(ratios):
+    """
+    Returns:The sketch of the contamination ratios of one study. NaN and negative ratios are only counted.
+    """
+    ratios = np.asarray(ratios, dtype=np.float64)
+    valid = ratios[np.isfinite(ratios) & (ratios >= 0)]
+    sketch = empty_sketch()
+    sketch['invalid'] = int(len(ratios) - len(valid))
+    if len(valid):
+        positive = valid[valid > 0]
+        sketch.update(count=int(len(valid)), mean=float(valid.mean()),
+                      m2=float(np.sum((valid - valid.mean()) ** 2)), reciprocal_sum=float(np.sum(1 / positive)),
+                      zeros=int(len(valid) - len(positive)))
+        sketch['histogram'] = np.bincount(histogram_bins(positive), minlength=len(sketch['histogram'])).tolist()
+    return sketch
+
+
+def merge_sketches(a, b):
+    """
+    Returns:The sketch of the union of two sets of ratios.
+    """
+    count = a['count'] + b['count']
+    merged = empty_sketch()
+    if count:
+        delta = b['mean'] - a['mean']
+        merged.update(count=count, mean=a['mean'] + delta * b['count'] / count,
+                      m2=a['m2'] + b['m2'] + delta ** 2 * a['count'] * b['count'] / count)
+    merged.update(reciprocal_sum=a['reciprocal_sum'] + b['reciprocal_sum'], zeros=a['zeros'] + b['zeros'],
+                  invalid=a['invalid'] + b['invalid'],
+                  histogram=[x + y for x, y in zip(a['histogram'], b['histogram'])])
+    return merged
+
+
+def sketch_summary(sketch):
+    """
+    Returns:The harmonic mean and the standard deviation of the ratios, the summary of functions.ratio_summary.
+    """
+    if sketch['count'] == 0:
+        raise ValueError('The cohort has no ratios of this panel.')
+    harmonic_mean = 0.0 if sketch['zeros'] else sketch['count'] / sketch['reciprocal_sum']
+    return {'harmonic_mean': np.float64(harmonic_mean), 'std': np.float64(np.sqrt(sketch['m2'] / sketch['count']))}
+
+
+def quantile(sketch, q):
+    """
+    Returns:The approximate q-quantile of the ratios (0 <= q <= 1).
+    """
+    histogram = np.concatenate([[sketch['zeros']], sketch['histogram']])
+    position = np.searchsorted(np.cumsum(histogram), q * histogram.sum(), side='left')
+    if position == 0:
+        return 0.0
+    return float(10 ** (HISTOGRAM_MIN + (position - 1 + 0.5) / HISTOGRAM_RESOLUTION))
+
+
+def percentile_of(sketch, ratios):
+    """
+    Returns:The approximate percentage of cohort ratios below every given ratio.
+    """
+    ratios = np.asarray(ratios, dtype=np.float64)
+    # cohort ratios in the bins below every bin
+    cumulative = np.concatenate([[0], np.cumsum(sketch['histogram'])])
+    total = sketch['zeros'] + cumulative[-1]
+    with np.errstate(invalid='ignore'):
+        positive = ratios > 0
+    below = np.where(positive, sketch['zeros'] + cumulative[histogram_bins(np.where(positive, ratios, 1))], 0)
+    return np.where(np.isfinite(ratios), 100.0 * below / max(total, 1), np.nan)
+
+
+def new_cohort():
+    return {'version': COHORT_VERSION, 'studies': [], 'panels': {}}
+
+
+def load_cohort(path):
+    """
+    Returns:The cohort stored in path, an empty one if the file doesn't exist.
+    """
+    if not os.path.exists(path):
+        return new_cohort()
+    with open(path) as f:
+        cohort = json.load(f)
+    if cohort.get('version') != COHORT_VERSION:
+        raise ValueError('Unsupported cohort file version in {}.'.format(path))
+    return cohort
+
+
+def save_cohort(cohort, path):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, '.tmp_' + uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        json.dump(cohort, f)
+    os.replace(tmp_path, path)
+
+
+def add_study(cohort, study_id, ratios):
+    """
+    Adds the contamination ratios of one study to a cohort.
+    Args:
+        cohort: A cohort, changed in place.
+        study_id: A unique id of the study, e.g. the content digest of its file.
+        ratios: A dict of panel names to the ratios of all samples.
+
+    Returns:True if the study was added, False if the cohort already had it.
+
+    """
+    if study_id in cohort['studies']:
+        return False
+    cohort['studies'].append(study_id)
+    for panel, values in ratios.items():
+        cohort['panels'][panel] = merge_sketches(cohort['panels'].get(panel, empty_sketch()), sketch_of(values))
+    return True
+
+
+def merge_cohorts(a, b):
+    """
+    Returns:A cohort with the studies of two cohorts, which must not share any study.
+    """
+    if set(a['studies']) & set(b['studies']):
+        raise ValueError('The cohorts share studies, add the studies of one of them again instead.')
+    panels = {panel: merge_sketches(a['panels'].get(panel, empty_sketch()), b['panels'].get(panel, empty_sketch()))
+              for panel in set(a['panels']) | set(b['panels'])}
+    return {'version': COHORT_VERSION, 'studies': a['studies'] + b['studies'], 'panels': panels}
+
+
+def score(cohort, panel, ratios, num_std=3):
+    """
+    Scores the samples of a new study against the cohort baseline of a panel.
+    Returns:A dict with the cohort 'threshold' (harmonic mean + num_std standard deviations, like the threshold
+    within one study), the cohort 'percentile' and the 'flagged' state of every ratio.
+
+    """
+    sketch = cohort['panels'].get(panel)
+    if sketch is None:
+        raise KeyError('The cohort has no ratios of the {} panel.'.format(panel))
+    threshold = fn.ratio_threshold(sketch_summary(sketch), num_std)
+    ratios = np.asarray(ratios, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        flagged = ratios > threshold
+    return {'threshold': threshold, 'percentile': percentile_of(sketch, ratios), 'flagged': flagged}
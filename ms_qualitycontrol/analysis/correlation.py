@@ -0,0 +1,201 @@
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Protein x protein correlation of the global correlation map. Missing values are handled through masked
+# sufficient statistics: for every pair of proteins the number of common observations, the sums and the sums of
+# squares over them are matrix products of the zero-filled values with the validity masks, so the pairwise
+# complete correlation of a block of proteins against another block is a handful of BLAS calls. Blocks run on a
+# thread pool (numpy releases the GIL inside BLAS), and only the upper triangle of blocks is computed.
+# Spearman ranks complete proteins once. Proteins with missing values are correlated again row by row afterwards,
+# ranking only the observations each pair has in common.
+
+BLOCK_ROWS = 2000
+
+
+def log_transform(values):
+    """
+    log10 of the intensities, 0 stays 0 (like the former applymap over the Data Frame).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(values != 0, np.log10(values), 0)
+
+
+def rank_rows(values):
+    """
+    Ranks of the valid values of every protein, ties get their average rank, missing values stay NaN.
+    """
+    order = np.argsort(values, axis=1, kind='mergesort')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    positions = np.broadcast_to(np.arange(1, values.shape[1] + 1, dtype=np.float64), values.shape)
+    starts_group = np.ones(values.shape, dtype=bool)
+    starts_group[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    ends_group = np.ones(values.shape, dtype=bool)
+    ends_group[:, :-1] = starts_group[:, 1:]
+    first = np.maximum.accumulate(np.where(starts_group, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends_group, positions, np.inf)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty(values.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2, axis=1)
+    ranks[np.isnan(values)] = np.nan
+    return ranks
+
+
+def sufficient_statistics(values, dtype):
+    """
+    Returns:The values centered on their row means with missing values set to 0, their squares and the mask.
+    Centering doesn't change the correlation, but keeps the float32 sums of squares accurate.
+
+    """
+    mask = ~np.isnan(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(mask, values, 0).sum(axis=1) / mask.sum(axis=1)
+    x = np.where(mask, values - means[:, np.newaxis], 0).astype(dtype)
+    return x, x * x, mask.astype(dtype)
+
+
+def block_correlation(a, b):
+    """
+    Pairwise complete Pearson correlation between the rows of two blocks, NaN for less than 2 common values
+    or a constant profile.
+    """
+    x, xx, mask_x = a
+    y, yy, mask_y = b
+    n = mask_x.dot(mask_y.T)
+    sum_x, sum_y = x.dot(mask_y.T), mask_x.dot(y.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = x.dot(y.T) - sum_x * sum_y / n
+        var_x = xx.dot(mask_y.T) - sum_x * sum_x / n
+        var_y = mask_x.dot(yy.T) - sum_y * sum_y / n
+        r = cov / np.sqrt(var_x * var_y)
+        r[(n < 2) | ~(var_x > 0) | ~(var_y > 0)] = np.nan
+    return np.clip(r, -1, 1, out=r)
+
+
+def paired_correlation(a, b, mask):
+    """
+    Pearson correlation between the rows of a and b over the values in mask, NaN for less than 2 values
+    or a constant profile.
+    """
+    n = mask.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = np.where(mask, a - np.where(mask, a, 0).sum(axis=1, keepdims=True) / n[:, np.newaxis], 0)
+        b = np.where(mask, b - np.where(mask, b, 0).sum(axis=1, keepdims=True) / n[:, np.newaxis], 0)
+        var_a, var_b = (a * a).sum(axis=1), (b * b).sum(axis=1)
+        r = (a * b).sum(axis=1) / np.sqrt(var_a * var_b)
+        r[(n < 2) | ~(var_a > 0) | ~(var_b > 0)] = np.nan
+    return np.clip(r, -1, 1, out=r)
+
+
+def spearman_row(values, row, targets):
+    """
+    Spearman correlation of one protein with the target proteins, ranking only the common observations of
+    every pair.
+    """
+    valid = ~np.isnan(values[row])
+    x, y = values[row, valid], values[targets][:, valid]
+    common = ~np.isnan(y)
+    return paired_correlation(rank_rows(np.where(common, x, np.nan)), rank_rows(y), common)
+
+
+def correlation(matrix, out=None, method='pearson', dtype=np.float64, threads=None, transform=None,
+                block_rows=BLOCK_ROWS):
+    """
+    Correlation between the profiles of all proteins from pairwise complete observations, like DataFrame.T.corr.
+    Args:
+        matrix: A proteins x samples matrix (may be memory-mapped), missing values are NaN.
+        out: A proteins x proteins array for the result (e.g. a memory-mapped file), allocated if None.
+        method: 'pearson' or 'spearman'. Spearman ranks the common observations of every pair, like pandas.
+        dtype: np.float64 or np.float32 for the matrix products.
+        threads: Number of threads, None uses all CPUs.
+        transform: A function applied to every block of the intensities first, e.g. log_transform.
+        block_rows: Number of proteins correlated at once.
+
+    Returns:The correlation matrix.
+
+    """
+    if method not in ('pearson', 'spearman'):
+        raise ValueError('Unknown correlation method: {}'.format(method))
+    n_rows = matrix.shape[0]
+    out = np.empty((n_rows, n_rows), dtype=dtype) if out is None else out
+    blocks = [slice(start, min(start + block_rows, n_rows)) for start in range(0, n_rows, block_rows)]
+
+    def prepare(block):
+        values = np.asarray(matrix[block], dtype=np.float64)
+        values = transform(values) if transform is not None else values
+        return sufficient_statistics(rank_rows(values) if method == 'spearman' else values, dtype)
+
+    def correlate_row(i):
+        a = prepare(blocks[i])
+        for j in range(i, len(blocks)):
+            r = block_correlation(a, a if j == i else prepare(blocks[j]))
+            out[blocks[i], blocks[j]] = r
+            if j != i:
+                out[blocks[j], blocks[i]] = r.T
+
+    with ThreadPoolExecutor(threads or os.cpu_count() or 1) as executor:
+        list(executor.map(correlate_row, range(len(blocks))))
+        if method == 'spearman':
+            values = np.asarray(matrix, dtype=np.float64)
+            values = transform(values) if transform is not None else values
+            missing = np.isnan(values).any(axis=1)
+            complete, incomplete = np.flatnonzero(~missing), np.flatnonzero(missing)
+
+            def correlate_incomplete(k):
+                # the ranks of the first pass only hold for pairs of complete proteins
+                row, targets = incomplete[k], np.concatenate([complete, incomplete[k:]])
+                r = spearman_row(values, row, targets)
+                out[row, targets] = r
+                out[targets, row] = r
+
+            list(executor.map(correlate_incomplete, range(len(incomplete))))
+    return out
+
+
+def aggregate_blocks(values, rows, cols, row_block, col_block):
+    """
+    Mean of every row_block x col_block block of the correlation matrix reordered by rows and cols, skipping
+    missing values. One block of rows is read at a time, so memory-mapped maps work too.
+    """
+    if row_block == col_block == 1:
+        return np.asarray(values[np.ix_(rows, cols)], dtype=np.float64)
+    pad = (-len(cols)) % col_block
+    out = np.empty((-(-len(rows) // row_block), -(-len(cols) // col_block)))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for k, start in enumerate(range(0, len(rows), row_block)):
+            part = np.asarray(values[np.sort(rows[start:start + row_block])], dtype=np.float64)[:, cols]
+            part = np.pad(part, ((0, 0), (0, pad)), mode='constant', constant_values=np.nan)
+            out[k] = np.nanmean(part.reshape(part.shape[0], -1, col_block), axis=(0, 2))
+    return out
+
+
+def level_of_detail(values, leaves, x_range, y_range, max_cells):
+    """
+    The part of the leaf-ordered correlation map inside the visible ranges, averaged over blocks of proteins
+    so that neither axis has more than max_cells cells. Zooming in far enough returns the full resolution.
+    Args:
+        values: The proteins x proteins correlation matrix.
+        leaves: The leaf order of the clustering.
+        x_range: The visible range of the x axis, protein i of the leaf order is drawn at 10 * i + 5.
+        y_range: The visible range of the y axis.
+        max_cells: Maximal number of cells per axis.
+
+    Returns:The cells and the x and y coordinates of their centers.
+
+    """
+    n = len(leaves)
+    leaves = np.asarray(leaves)
+
+    def window(axis_range):
+        start = int(min(max(0, np.floor(min(axis_range) / 10)), n - 1))
+        end = int(max(min(n, np.ceil(max(axis_range) / 10)), start + 1))
+        block = max(1, int(np.ceil((end - start) / max_cells)))
+        starts = np.arange(start, end, block)
+        # blocks of proteins are drawn at the centers of their leaves
+        return leaves[start:end], block, 10 * (starts + np.minimum(starts + block, end)) / 2
+
+    rows, row_block, y = window(y_range)
+    cols, col_block, x = window(x_range)
+    return aggregate_blocks(values, rows, cols, row_block, col_block), x, y
@@ -1,25 +1,239 @@
 import numpy as np
 import pandas as pd
-from scipy import stats
+import io
 import os
 import re
+import bz2
+import gzip
+import lzma
+import time
+import logging
 import itertools
 import statistics
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
 
 def select_cols(columns):
     return 'LFQ' in columns or columns in ['Gene names', 'Protein IDs', 'Protein names']
 
 
-def read_own_table(filepath):
-    extent = filepath.split('.')[-1]
+# magic numbers of the supported compression formats
+COMPRESSIONS = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zstd')]
+COMPRESSED_EXTENSIONS = ['gz', 'bz2', 'xz', 'zst']
+
+
+def compression_of(head):
+    for magic, compression in COMPRESSIONS:
+        if head.startswith(magic):
+            return compression
+
+
+def detect_compression(filepath):
+    with open(filepath, 'rb') as f:
+        return compression_of(f.read(6))
+
+
+def get_separator(filepath):
+    """
+    Picks the separator from the file extension, ignoring a compression suffix (e.g. proteinGroups.txt.gz).
+    """
+    extensions = os.path.basename(filepath).lower().split('.')[1:]
+    if extensions and extensions[-1] in COMPRESSED_EXTENSIONS:
+        extensions = extensions[:-1]
+    extent = extensions[-1] if extensions else ''
     if extent == 'txt':
-        df = pd.read_table(filepath, usecols=select_cols, low_memory=False)
+        return '\t'
     elif extent == 'csv':
-        df = pd.read_csv(filepath, usecols=select_cols, low_memory=False)
+        return ','
+    raise ValueError('Unsupported file type: {}. Please upload a .txt or .csv file.'.format(filepath))
+
+
+def open_table(filepath):
+    """
+    Opens a file for reading and decompresses gzip, bz2, xz and zstd files on the fly, so no uncompressed copy
+    is written to disk.
+    Returns:A binary file object.
+
+    """
+    compression = detect_compression(filepath)
+    if compression == 'gzip':
+        return gzip.open(filepath, 'rb')
+    elif compression == 'bz2':
+        return bz2.open(filepath, 'rb')
+    elif compression == 'xz':
+        return lzma.open(filepath, 'rb')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('Reading .zst files requires the zstandard package.')
+        return zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), closefd=True)
+    return open(filepath, 'rb')
+
+
+def open_stream(f):
+    """
+    Same as open_table for an already opened binary stream, e.g. an upload which is still being received.
+    The returned object doesn't close f.
+    """
+    f = f if hasattr(f, 'peek') else io.BufferedReader(f)
+    compression = compression_of(f.peek(6)[:6])
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    elif compression == 'bz2':
+        return bz2.BZ2File(f, 'rb')
+    elif compression == 'xz':
+        return lzma.LZMAFile(f, 'rb')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('Reading .zst files requires the zstandard package.')
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=False)
+    return f
+
+
+def read_own_stream(f, filename):
+    return pd.read_csv(open_stream(f), sep=get_separator(filename), usecols=select_cols, low_memory=False)
+
+
+def read_own_table(filepath, chunksize=None, dtype=None):
+    if chunksize is not None:
+        return read_own_table_chunked(filepath, chunksize, dtype or np.float32)[0]
+    sep = get_separator(filepath)
+    with open_table(filepath) as f:
+        df = pd.read_csv(f, sep=sep, usecols=select_cols, low_memory=False)
     return df
 
 
+def count_lines(filepath, block_size=1024 * 1024):
+    lines, last = 0, b'\n'
+    with open_table(filepath) as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    return lines + (last != b'\n')
+
+
+def table_shape(filepath):
+    """
+    Estimates the size of a table without parsing it.
+    Returns:The number of rows (lines after the header) and the LFQ columns.
+
+    """
+    with open_table(filepath) as f:
+        header = pd.read_csv(f, sep=get_separator(filepath), nrows=0).columns
+    return max(count_lines(filepath) - 1, 0), [column for column in header if select_LFQ_cols(column)]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def read_own_table_chunked(filepath, chunksize=20000, dtype=np.float32, lfq_path=None, expected_rows=None):
+    """
+    Streaming version of read_own_table for multi-GB inputs. The header is read once to select the columns,
+    the rows are parsed in chunks and the LFQ values are written into one preallocated matrix, which grows while
+    the rows are parsed and is trimmed to them at the end.
+    Args:
+        filepath: A path to a .txt or .csv file, optionally compressed.
+        chunksize: Number of rows parsed at once.
+        dtype: A dtype of the LFQ matrix, float32 or float64.
+        lfq_path: If set, the LFQ matrix is written into this memory-mapped .npy file instead and the Data Frame
+            has the other columns only.
+        expected_rows: The estimated number of rows (e.g. from table_shape) to preallocate, one chunk if None.
+
+    Returns:A Data Frame with the same columns as read_own_table and a dict with rows, seconds, rows/s and
+    peak RSS in MB.
+
+    """
+    start = time.time()
+    sep = get_separator(filepath)
+    with open_table(filepath) as f:
+        header = pd.read_csv(f, sep=sep, nrows=0).columns
+    columns = [column for column in header if select_cols(column)]
+    lfq_columns = [column for column in columns if select_LFQ_cols(column)]
+    other_columns = [column for column in columns if column not in lfq_columns]
+
+    shape = (chunksize if expected_rows is None else expected_rows, len(lfq_columns))
+    if lfq_path is None:
+        matrix = np.empty(shape, dtype=dtype)
+    else:
+        matrix = np.lib.format.open_memmap(lfq_path, mode='w+', dtype=dtype, shape=shape)
+    others = {column: [] for column in other_columns}
+    rows = 0
+    with open_table(filepath) as f:
+        for chunk in pd.read_csv(f, sep=sep, usecols=columns, chunksize=chunksize,
+                                 dtype={column: dtype for column in lfq_columns}):
+            if rows + len(chunk) > len(matrix):
+                # the expected rows are only an estimate, e.g. with quoted line breaks or other line endings
+                matrix = resize_matrix(matrix, rows, max(rows + len(chunk), 2 * len(matrix)), lfq_path, chunksize)
+            matrix[rows:rows + len(chunk)] = chunk[lfq_columns].values
+            for column in other_columns:
+                others[column].append(chunk[column].values)
+            rows += len(chunk)
+
+    if rows != len(matrix):
+        matrix = resize_matrix(matrix, rows, rows, lfq_path, chunksize)
+    if lfq_path is None:
+        df = pd.DataFrame(matrix, columns=lfq_columns, copy=False)
+    else:
+        matrix.flush()
+        del matrix
+        df = pd.DataFrame(index=pd.RangeIndex(rows))
+    layout = columns if lfq_path is None else other_columns
+    for column in other_columns:
+        df.insert(layout.index(column), column,
+                  np.concatenate(others[column]) if others[column] else np.array([], dtype=object))
+    seconds = time.time() - start
+    report = {'rows': rows, 'seconds': seconds, 'rows_per_s': rows / seconds if seconds else float('inf'),
+              'peak_rss_mb': peak_rss_mb()}
+    logger.info('Parsed %s: %d rows in %.1f s (%.0f rows/s), peak RSS %s MB', filepath, report['rows'],
+                report['seconds'], report['rows_per_s'], report['peak_rss_mb'])
+    return df, report
+
+
+def resize_matrix(matrix, rows, size, path=None, block_rows=20000):
+    """
+    Resizes the preallocated LFQ matrix of the chunked reader to size rows, keeping its first rows.
+    Args:
+        matrix: A matrix allocated by the reader.
+        rows: Number of rows filled so far.
+        size: The new number of rows.
+        path: The .npy file of a memory-mapped matrix, which is rewritten.
+        block_rows: Number of rows copied at once.
+
+    Returns:The resized matrix.
+
+    """
+    if path is None:
+        matrix.resize((size,) + matrix.shape[1:], refcheck=False)
+        return matrix
+    matrix.flush()
+    dtype, shape = matrix.dtype, matrix.shape
+    del matrix
+    tmp_path = path + '.tmp.npy'
+    source = np.load(path, mmap_mode='r')
+    resized = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(size,) + shape[1:])
+    for start in range(0, min(rows, size), block_rows):
+        stop = min(start + block_rows, rows, size)
+        resized[start:stop] = source[start:stop]
+    resized.flush()
+    del source, resized
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r+')
+
+
 def delete_uploaded_file(dir_path, filename):
     try:
         for root, dirs, files in os.walk(dir_path, topdown=False):
@@ -55,21 +269,6 @@ def get_reversed_list_of_col(df, searched_value):
         return list(itertools.chain.from_iterable(columns))
 
 
-def two_sample_t_test(control, samples):
-    t_stat, p_val = stats.ttest_ind(control, samples, axis=1, nan_policy='omit')
-    return p_val, -np.log10(p_val)
-
-
-def calculate_mean(control, samples):
-    return np.mean(control, axis=1), np.mean(samples, axis=1)
-
-
-def calculate_LFC(df):
-    l10fc = [np.log10(x / y) if (y != 0 and (x / y) != 0) else None
-             for x, y in zip(df['samples_mean'], df['control_mean'])]
-    return l10fc
-
-
 def select_LFQ_cols(columns):
     return 'LFQ' in columns
 
@@ -80,6 +279,87 @@ def filter_valid_values(df, index, numeric_columns, percent, ax):
     return df_copied.reset_index()
 
 
+def build_index(values, separator):
+    """
+    Builds an inverted index of a column with separated values, e.g. Gene names or Protein IDs.
+    Args:
+        values: Values of the column, missing values are skipped.
+        separator: A separator based on which we'd like to split a string.
+
+    Returns:A dict of every single value to the positions of the rows containing it.
+
+    """
+    index = {}
+    for position, value in enumerate(values):
+        if isinstance(value, str):
+            for each in value.split(separator):
+                index.setdefault(each, []).append(position)
+    return index
+
+
+def build_indices(df, separator=';'):
+    return {column: build_index(df[column].values, separator)
+            for column in ['Gene names', 'Protein IDs'] if column in df.columns}
+
+
+def lookup_rows(index, mask):
+    """
+    Finds the rows which contain at least one value of the mask, in O(1) per value.
+    Returns:A sorted list of row positions.
+
+    """
+    rows = set()
+    for each in mask:
+        rows.update(index.get(each, ()))
+    return sorted(rows)
+
+
+def panel_membership(index, panels, n_rows):
+    """
+    Assigns every row to the marker panels in one pass over the panel genes.
+    Args:
+        index: An inverted index of the Gene names (build_index).
+        panels: Lists of genes, one per panel.
+        n_rows: Number of rows of the table.
+
+    Returns:A rows x panels boolean matrix, a row may belong to several panels.
+
+    """
+    membership = np.zeros((n_rows, len(panels)), dtype=bool)
+    for column, genes in enumerate(panels):
+        membership[[row for each in genes for row in index.get(each, ())], column] = True
+    return membership
+
+
+def decimate_points(x, y, keep, max_points, bins=256):
+    """
+    Thins out a dense scatter to one point per cell of a bins x bins grid, points marked in keep are never dropped.
+    Args:
+        x: x coordinates of the points.
+        y: y coordinates of the points.
+        keep: A boolean mask of points which must stay, e.g. significant ones.
+        max_points: Nothing is dropped up to this number of points.
+        bins: Number of grid cells per axis.
+
+    Returns:Sorted positions of the remaining points.
+
+    """
+    x, y, keep = np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(keep, dtype=bool)
+    if len(x) <= max_points:
+        return np.arange(len(x))
+    finite = np.isfinite(x) & np.isfinite(y)
+    if not finite.any():
+        return np.flatnonzero(keep)
+    cells = []
+    for values in (x, y):
+        low, high = values[finite].min(), values[finite].max()
+        scaled = (values - low) / (high - low) * bins if high > low else np.zeros(len(values))
+        cells.append(np.clip(np.nan_to_num(scaled), 0, bins - 1).astype(np.int64))
+    candidates = np.flatnonzero(finite & ~keep)
+    first = np.unique(cells[0][candidates] * bins + cells[1][candidates], return_index=True)[1]
+    return np.union1d(np.flatnonzero(keep), candidates[first])
+
+
 def get_list_of_indices(df, column, mask, separator):
     """
     A function that can be used for sorting of Data Frame based on a created list of values(mask).
@@ -92,12 +372,32 @@ def get_list_of_indices(df, column, mask, separator):
     Returns:A sorted Data Frame
 
     """
-    indices = []
-    for i in list(df[column].dropna(axis=0).index):
-        proteinsIDs = df.loc[i, column].split(separator)
-        if len(set(proteinsIDs).intersection(mask)) > 0:
-            indices.append(i)
-    return df.loc[indices]
+    return df.iloc[lookup_rows(build_index(df[column].values, separator), mask)]
+
+
+def build_marker_index(markers, separator=';'):
+    """
+    Maps every single gene of the heatmap labels to its coordinate, keeping the first label like a linear scan.
+    Args:
+        markers: A dict of heatmap labels (Gene names) to coordinates.
+        separator: A separator of the genes in a label.
+
+    Returns:A dict of genes and full labels to coordinates.
+
+    """
+    index = {}
+    for label, coordinate in markers.items():
+        index.setdefault(label, coordinate)
+        for each in str(label).split(separator):
+            index.setdefault(each, coordinate)
+    return index
+
+
+def find_marker(index, markers, gene):
+    if gene in index:
+        return index[gene]
+    # partial names, e.g. a prefix of a gene, still need the scan over all labels
+    return [val for key, val in markers.items() if gene in key][0]
 
 
 def extract_val_from_col(df, column, separator):
@@ -115,15 +415,25 @@ def extract_val_from_col(df, column, separator):
     return list(itertools.chain.from_iterable(values_protIDs))
 
 
+def contamination_ratio(df, marker, reverse=False):
+    test = np.array(np.sum(marker, axis=0) / np.sum(df, axis=0), dtype=float).round(decimals=4)
+    return 1 / test if reverse else test
+
+
+def ratio_summary(test):
+    """
+    Summary statistics of the contamination ratios, everything the threshold depends on besides num_std.
+    """
+    return {'harmonic_mean': statistics.harmonic_mean(test), 'std': np.std(test)}
+
+
+def ratio_threshold(summary, num_std):
+    return (summary['harmonic_mean'] + summary['std'] * num_std).round(decimals=4)
+
+
 def normal_ratio(df, marker, num_std, reverse=False):
-    if reverse == False:
-        test = np.array(np.sum(marker, axis=0) / np.sum(df, axis=0), dtype=float).round(decimals=4)
-        std_bn_samples = (statistics.harmonic_mean(test) + np.std(test) * num_std).round(decimals=4)
-        return test, std_bn_samples
-    else:
-        test = 1 / np.array(np.sum(marker, axis=0) / np.sum(df, axis=0), dtype=float).round(decimals=4)
-        std_bn_samples = (statistics.harmonic_mean(test) + np.std(test) * num_std).round(decimals=4)
-        return test, std_bn_samples
+    test = contamination_ratio(df, marker, reverse=reverse)
+    return test, ratio_threshold(ratio_summary(test), num_std)
 
 
 def make_annotation_item(x, y, z, color):
@@ -135,15 +445,11 @@ def make_annotation_item(x, y, z, color):
 
 
 def create_annotations(data, threshold, col_names):
-    data_above_threshold, data_above_threshold_indices = [], []
-    for i, dd in enumerate(data):
-        if dd > threshold:
-            data_above_threshold.append(round(dd, 4))
-            data_above_threshold_indices.append(i)
-    names = [col_names[i] for i in data_above_threshold_indices]
+    data = np.asarray(data)
+    data_above_threshold_indices = np.flatnonzero(data > threshold)
     annotations = []
-    for x, y, z in zip(data_above_threshold_indices, data_above_threshold, names):
-        annotations.append(make_annotation_item(x, y, z, '#F19F4D'))
+    for x in data_above_threshold_indices.tolist():
+        annotations.append(make_annotation_item(x, round(data[x], 4), col_names[x], '#F19F4D'))
     return annotations
 
 
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import uuid
+
+import pandas as pd
+
+from .functions import get_separator
+from .table_cache import file_digest
+
+# Registry of the quality marker panels. Panel files (the Excel workbook with one sheet per panel, or .txt/.csv
+# tables with a 'Gene names' column) are compiled on first use into pre-split, interned gene and protein ID sets.
+# The compiled form is cached as JSON next to the parsed tables, so the Excel file is only parsed again when its
+# content changes. Files are checked for changes on every lookup and recompiled without a restart, panel directories
+# are scanned again for new and removed files.
+
+_sources = {}
+_directories = {}
+_panels = {}
+_lock = threading.RLock()
+
+
+def split_values(values, separator=';'):
+    """
+    Splits separated values (e.g. 'ACTB;ACTG1') and interns every single value, keeping the first occurrence order.
+    """
+    result, seen = [], set()
+    for value in values:
+        if isinstance(value, str):
+            for each in value.split(separator):
+                each = sys.intern(each.strip())
+                if each and each not in seen:
+                    seen.add(each)
+                    result.append(each)
+    return result
+
+
+def make_panel(name, genes, protein_ids=(), source=None):
+    genes = tuple(split_values(genes))
+    protein_ids = tuple(split_values(protein_ids))
+    return {'name': name, 'genes': genes, 'gene_set': frozenset(genes), 'protein_ids': protein_ids,
+            'protein_id_set': frozenset(protein_ids), 'source': source}
+
+
+def read_panel_file(path):
+    """
+    Parses a panel file.
+    Returns:A dict of panel names to {'Gene names': [...], 'Protein IDs': [...]}.
+
+    """
+    if path.lower().endswith(('.xlsx', '.xls')):
+        sheets = pd.read_excel(path, sheet_name=None)
+    else:
+        sheets = {os.path.splitext(os.path.basename(path))[0]: pd.read_csv(path, sep=get_separator(path))}
+    panels = {}
+    for name, sheet in sheets.items():
+        if 'Gene names' not in sheet.columns:
+            raise ValueError('The marker panel {} in {} has no "Gene names" column.'.format(name, path))
+        panels[name] = {column: split_values(sheet[column].dropna().astype(str))
+                        for column in ['Gene names', 'Protein IDs'] if column in sheet.columns}
+    return panels
+
+
+def compiled_prefix(path):
+    # compiled panels of one source file share a prefix, older versions are removed when it changes
+    return 'markers_' + hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:16] + '_'
+
+
+def compile_source(path, cache_dir=None):
+    if not cache_dir:
+        return read_panel_file(path)
+    prefix = compiled_prefix(path)
+    cache_file = os.path.join(cache_dir, prefix + file_digest(path, salt='markers') + '.json')
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    panels = read_panel_file(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = os.path.join(cache_dir, '.tmp_' + uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(panels, f)
+        os.replace(tmp_path, cache_file)
+    except OSError:
+        # the panels are still usable, they are compiled again next time
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return panels
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and name != os.path.basename(cache_file):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+    return panels
+
+
+def register_file(path, cache_dir=None):
+    """
+    Registers all panels of a file. Nothing is read until a panel is requested.
+    Args:
+        path: A path to the Excel workbook (one panel per sheet) or a .txt/.csv panel table.
+        cache_dir: A directory for the compiled panels, e.g. the table cache.
+
+    """
+    with _lock:
+        _sources[path] = {'cache_dir': cache_dir, 'mtime': None, 'panels': [], 'directory': None}
+
+
+def panel_files(path):
+    if not os.path.isdir(path):
+        return []
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if name.lower().endswith(('.xlsx', '.xls', '.txt', '.csv')) and not name.startswith(('.', '~'))]
+
+
+def register_directory(path, cache_dir=None):
+    """
+    Registers every panel file of a directory, e.g. additional hemolysis panels. The directory is scanned again on
+    every lookup, so files can be added and removed without a restart.
+    """
+    with _lock:
+        _directories[path] = cache_dir
+        scan_directories()
+
+
+def scan_directories():
+    # panel files added to or removed from the registered directories since the last lookup
+    for directory, cache_dir in _directories.items():
+        files = panel_files(directory)
+        for path in files:
+            if path not in _sources:
+                _sources[path] = {'cache_dir': cache_dir, 'mtime': None, 'panels': [], 'directory': directory}
+        for path in [path for path, source in _sources.items() if source['directory'] == directory]:
+            if path not in files:
+                drop_panels(path, _sources.pop(path)['panels'])
+
+
+def drop_panels(path, names):
+    for name in names:
+        if name in _panels and _panels[name]['source'] == path:
+            del _panels[name]
+
+
+def register_panel(name, genes, protein_ids=()):
+    """
+    Registers a panel from a list of genes (and optionally Protein IDs) without any file.
+    """
+    with _lock:
+        _panels[name] = make_panel(name, genes, protein_ids)
+
+
+def refresh():
+    """
+    (Re)compiles all registered files which are new or changed since they were compiled.
+    """
+    with _lock:
+        scan_directories()
+        for path, source in _sources.items():
+            mtime = os.path.getmtime(path) if os.path.exists(path) else None
+            if mtime is None or mtime == source['mtime']:
+                continue
+            compiled = compile_source(path, source['cache_dir'])
+            drop_panels(path, source['panels'])
+            for name, values in compiled.items():
+                _panels[name] = make_panel(name, values['Gene names'], values.get('Protein IDs', ()), source=path)
+            source['panels'] = list(compiled)
+            source['mtime'] = mtime
+
+
+def get_panel(name):
+    """
+    Returns:A dict with the pre-split 'genes' (tuple, in file order), 'gene_set', 'protein_ids' and
+    'protein_id_set' of a panel.
+
+    """
+    refresh()
+    with _lock:
+        if name not in _panels:
+            raise KeyError('Unknown marker panel: {}'.format(name))
+        return _panels[name]
+
+
+def panel_names():
+    refresh()
+    with _lock:
+        return list(_panels)
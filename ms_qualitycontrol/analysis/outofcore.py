@@ -0,0 +1,195 @@
+import numpy as np
+
+from . import correlation as corr
+from . import functions as fn
+from . import stats_engine as se
+
+# Out-of-core versions of the pipeline stages. The LFQ intensities are kept in a memory-mapped
+# proteins x samples .npy file and every stage reads it in blocks of rows, so only one block
+# has to fit into RAM at a time.
+
+BLOCK_ROWS = 5000
+
+
+def estimate_nbytes(n_rows, n_cols, dtype=np.float64):
+    return n_rows * n_cols * np.dtype(dtype).itemsize
+
+
+def exceeds_budget(n_rows, n_cols, budget, dtype=np.float64):
+    return budget is not None and estimate_nbytes(n_rows, n_cols, dtype) > budget
+
+
+def is_memmap(array):
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def memmap_file(array):
+    """
+    Returns:The .npy file of an array if it is a whole memory-mapped file (possibly as a view), otherwise None.
+    """
+    base = array
+    # slices of a memmap are memmaps too, the file itself is the last one
+    while isinstance(getattr(base, 'base', None), np.ndarray):
+        base = base.base
+    if not isinstance(base, np.memmap) or base.filename is None:
+        return None
+    # the same data in the same layout, not a part or a transposed view
+    same = base.shape == array.shape and base.strides == array.strides and \
+        base.__array_interface__['data'][0] == array.__array_interface__['data'][0]
+    return base.filename if same else None
+
+
+def iter_blocks(n_rows, block_rows=BLOCK_ROWS):
+    for start in range(0, n_rows, block_rows):
+        yield slice(start, min(start + block_rows, n_rows))
+
+
+def to_memmap(df, columns, path, rows=None, block_rows=BLOCK_ROWS, dtype=np.float64):
+    """
+    Writes the intensity columns of a Data Frame into a memory-mapped .npy file block by block.
+    Args:
+        df: A Data Frame or a memory-mapped matrix.
+        columns: LFQ columns, or the positions of the columns of a matrix (all if None).
+        path: A path of the .npy file.
+        rows: Positions of the rows to keep, all rows if None.
+        block_rows: Number of rows copied at once.
+        dtype: A dtype of the matrix.
+
+    Returns:A memory-mapped proteins x samples matrix.
+
+    """
+    rows = np.arange(len(df)) if rows is None else np.asarray(rows)
+    n_cols = df.shape[1] if columns is None else len(columns)
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(len(rows), n_cols))
+    for block in iter_blocks(len(rows), block_rows):
+        if hasattr(df, 'iloc'):
+            matrix[block] = df.iloc[rows[block]].loc[:, columns].values
+        elif columns is None:
+            matrix[block] = df[rows[block]]
+        else:
+            matrix[block] = df[rows[block]][:, columns]
+    matrix.flush()
+    return matrix
+
+
+def filter_valid_values(matrix, percent, block_rows=BLOCK_ROWS):
+    """
+    Blocked version of filter_valid_values along the rows (ax=0).
+    Returns:A boolean mask of the proteins with at least the given percentage of valid values.
+
+    """
+    thresh = int(matrix.shape[1] * percent)
+    mask = np.empty(matrix.shape[0], dtype=bool)
+    for block in iter_blocks(matrix.shape[0], block_rows):
+        mask[block] = np.sum(~np.isnan(matrix[block]), axis=1) >= thresh
+    return mask
+
+
+def blocked_statistics(function, matrix, block_rows=BLOCK_ROWS):
+    """
+    Applies a per-protein statistics function of a block of rows, returning a dict of arrays, to the whole matrix.
+    """
+    columns = {}
+    for block in iter_blocks(matrix.shape[0], block_rows):
+        for column, result in function(np.asarray(matrix[block])).items():
+            if column not in columns:
+                columns[column] = np.empty((matrix.shape[0],) + result.shape[1:], dtype=result.dtype)
+            columns[column][block] = result
+    return columns
+
+
+def differential_statistics(matrix, control_cols, samples_cols, equal_var=True, dtype=np.float64,
+                            block_rows=BLOCK_ROWS):
+    """
+    Blocked version of stats_engine.differential_statistics.
+    Returns:A dict of the statistics columns.
+
+    """
+    function = lambda values: se.differential_statistics(values[:, control_cols], values[:, samples_cols],
+                                                         equal_var=equal_var, dtype=dtype)
+    return blocked_statistics(function, matrix, block_rows)
+
+
+def paired_group_statistics(matrix, design, control_cols, samples_cols, dtype=np.float64, block_rows=BLOCK_ROWS):
+    function = lambda values: se.paired_group_statistics(values, design, control_cols, samples_cols, dtype)
+    return blocked_statistics(function, matrix, block_rows)
+
+
+def pair_differences(matrix, design, control_cols, samples_cols, block_rows=BLOCK_ROWS):
+    """
+    Returns:The proteins x subjects differences of the pairs, small enough to be kept in memory.
+    """
+    function = lambda values: {'differences': se.pair_differences(values, design, control_cols, samples_cols)}
+    return blocked_statistics(function, matrix, block_rows)['differences']
+
+
+def paired_contrast_statistics(matrix, design, contrasts, dtype=np.float64, block_rows=BLOCK_ROWS):
+    """
+    Blocked stats_engine.paired_contrast_statistics, the design tensor is built for one block at a time.
+    """
+    function = lambda values: {(name, column): result for name, statistics in se.paired_contrast_statistics(
+        se.design_tensor(values, design), design['timepoints'], contrasts, dtype).items()
+                               for column, result in statistics.items()}
+    results = {}
+    for (name, column), result in blocked_statistics(function, matrix, block_rows).items():
+        results.setdefault(name, {})[column] = result
+    return results
+
+
+def group_moments(matrix, groups, dtype=np.float64, block_rows=BLOCK_ROWS):
+    """
+    Blocked stats_engine.group_moments of several groups.
+    Args:
+        matrix: A proteins x samples matrix.
+        groups: A dict of group names to column positions.
+
+    Returns:A dict of group names to moments, which can be passed to stats_engine.multi_contrast_statistics.
+
+    """
+    moments = {name: [[], [], []] for name in groups}
+    for block in iter_blocks(matrix.shape[0], block_rows):
+        values = np.asarray(matrix[block])
+        for name, cols in groups.items():
+            for parts, result in zip(moments[name], se.group_moments(values[:, cols], dtype)):
+                parts.append(result)
+    return {name: tuple(np.concatenate(parts) for parts in group) for name, group in moments.items()}
+
+
+def column_sums(matrix, rows=None, block_rows=BLOCK_ROWS):
+    """
+    Sums of every sample over all proteins (or the given rows), skipping missing values like DataFrame.sum.
+    """
+    rows = np.arange(matrix.shape[0]) if rows is None else np.sort(np.asarray(rows))
+    sums = np.zeros(matrix.shape[1])
+    for block in iter_blocks(len(rows), block_rows):
+        sums += np.nansum(matrix[rows[block]], axis=0)
+    return sums
+
+
+def contamination_ratio(matrix, marker_rows, reverse=False, block_rows=BLOCK_ROWS):
+    return fn.contamination_ratio(column_sums(matrix, block_rows=block_rows)[np.newaxis, :],
+                                  column_sums(matrix, marker_rows, block_rows)[np.newaxis, :], reverse=reverse)
+
+
+def log_correlation(matrix, path, method='pearson', dtype=np.float64, threads=None):
+    """
+    Correlation between the log10 intensity profiles of all proteins, written into a memory-mapped file.
+    Args:
+        matrix: A proteins x samples matrix.
+        path: A path of the .npy file for the proteins x proteins result.
+        method: 'pearson' or 'spearman'.
+        dtype: A dtype of the computation and the result.
+        threads: Number of threads, None uses all CPUs.
+
+    Returns:A memory-mapped correlation matrix.
+
+    """
+    n_rows = matrix.shape[0]
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n_rows, n_rows))
+    corr.correlation(matrix, out=out, method=method, dtype=dtype, threads=threads, transform=corr.log_transform)
+    out.flush()
+    return out
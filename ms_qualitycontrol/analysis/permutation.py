@@ -0,0 +1,266 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+# Permutation-based FDR of the volcano plot, SAM style (Tusher et al., 2001). The relative difference
+# d = (samples mean - control mean) / (s + s0) is computed for the observed groups and for random permutations
+# of the group labels. Every batch of permutations is one matrix product of the centered intensities with a
+# samples x permutations label matrix, so all proteins and permutations of a batch are tested at once.
+# Each batch draws its labels from its own seeded stream, so the q-values don't depend on how the batches are
+# spread over the worker processes. The proteins are read in blocks of rows, so memory-mapped studies work too.
+# Paired designs test the differences of the pairs against 0, their null distribution comes from random sign flips.
+
+N_PERMUTATIONS = 1000
+BATCH_SIZE = 64
+BLOCK_ROWS = 5000
+# proteins x samples x permutations above which the permutations are spread over a process pool
+PARALLEL_MIN_CELLS = 200 * 1000 * 1000
+# groups of batches per worker process, progress is reported after every group
+TASKS_PER_WORKER = 4
+
+
+def open_matrix(matrix):
+    # worker processes get the path of a memory-mapped matrix instead of a pickled copy
+    return np.load(matrix, mmap_mode='r') if isinstance(matrix, str) else matrix
+
+
+def iter_blocks(n_rows, block_rows=BLOCK_ROWS):
+    for start in range(0, n_rows, block_rows):
+        yield slice(start, min(start + block_rows, n_rows))
+
+
+def centered(values):
+    """
+    Returns:The intensities centered on the mean of every protein with missing values set to 0, their squares
+    and the mask of the valid values.
+
+    """
+    mask = ~np.isnan(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(mask, values, 0).sum(axis=1) / mask.sum(axis=1)
+    x = np.where(mask, values - means[:, np.newaxis], 0)
+    return x, x * x, mask.astype(np.float64)
+
+
+def relative_difference(x, xx, mask, labels, s0):
+    """
+    SAM relative difference of every protein and labelling.
+    Args:
+        x: Centered intensities, proteins x samples.
+        xx: Squares of x.
+        mask: 1.0 for valid values, 0.0 for missing ones.
+        labels: A samples x labellings matrix, 1.0 for the control group and 0.0 for the samples group.
+        s0: The fudge factor added to the standard error.
+
+    Returns:The relative differences (proteins x labellings, NaN if a group has less than 2 values) and the
+    standard errors.
+
+    """
+    n_c, sum_c, sq_c = mask.dot(labels), x.dot(labels), xx.dot(labels)
+    n_s = mask.sum(axis=1)[:, np.newaxis] - n_c
+    sum_s = x.sum(axis=1)[:, np.newaxis] - sum_c
+    sq_s = xx.sum(axis=1)[:, np.newaxis] - sq_c
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_c, mean_s = sum_c / n_c, sum_s / n_s
+        m2 = np.maximum(sq_c - sum_c * mean_c, 0) + np.maximum(sq_s - sum_s * mean_s, 0)
+        se = np.sqrt(m2 / (n_c + n_s - 2) * (1 / n_c + 1 / n_s))
+        d = (mean_s - mean_c) / (se + s0)
+    invalid = (n_c < 2) | (n_s < 2)
+    d[invalid], se[invalid] = np.nan, np.nan
+    return d, se
+
+
+def sign_flip_difference(x, xx, mask, signs, s0):
+    """
+    SAM relative difference of paired data (one-sample test of the differences) for every sign flip.
+    Args:
+        x: Differences of the pairs (proteins x subjects), missing ones set to 0.
+        xx: Squares of x.
+        mask: 1.0 for complete pairs, 0.0 otherwise.
+        signs: A subjects x flips matrix of +1.0 / -1.0.
+        s0: The fudge factor added to the standard error.
+
+    Returns:The relative differences (proteins x flips) and the standard errors.
+
+    """
+    n = mask.sum(axis=1)[:, np.newaxis]
+    sums = x.dot(signs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / n
+        m2 = np.maximum(xx.sum(axis=1)[:, np.newaxis] - sums * mean, 0)
+        se = np.sqrt(m2 / (n - 1) / n)
+        d = mean / (se + s0)
+    invalid = np.broadcast_to(n < 2, d.shape)
+    d[invalid], se[invalid] = np.nan, np.nan
+    return d, se
+
+
+def block_statistics(values, columns, paired):
+    if paired:
+        mask = ~np.isnan(values)
+        x = np.where(mask, values, 0)
+        return x, x * x, mask.astype(np.float64)
+    return centered(values[:, columns])
+
+
+def statistic(blocks, labels, s0, paired):
+    function = sign_flip_difference if paired else relative_difference
+    return [function(x, xx, mask, labels, s0) for x, xx, mask in blocks]
+
+
+def observed_statistics(matrix, columns, n_control, s0=None, paired=False, block_rows=BLOCK_ROWS):
+    """
+    Returns:The relative difference of every protein for the observed groups and the s0 used. If s0 is None,
+    the median standard error of all proteins is used.
+
+    """
+    if paired:
+        labels = np.ones((matrix.shape[1], 1))
+    else:
+        labels = np.zeros((len(columns), 1))
+        labels[:n_control] = 1
+    blocks = []
+    for block in iter_blocks(matrix.shape[0], block_rows):
+        blocks.append(block_statistics(np.asarray(matrix[block], dtype=np.float64), columns, paired))
+    if s0 is None:
+        se = np.concatenate([se[:, 0] for d, se in statistic(blocks, labels, 0, paired)])
+        s0 = float(np.nanmedian(se)) if np.isfinite(se).any() else 0.0
+    d = np.concatenate([d[:, 0] for d, se in statistic(blocks, labels, s0, paired)])
+    return d, s0
+
+
+def permutation_labels(seed, n_permutations, n_samples, n_control):
+    rng = np.random.default_rng(seed)
+    order = rng.random((n_permutations, n_samples)).argsort(axis=1)[:, :n_control]
+    labels = np.zeros((n_samples, n_permutations))
+    labels[order, np.arange(n_permutations)[:, np.newaxis]] = 1
+    return labels
+
+
+def sign_flips(seed, n_permutations, n_subjects):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 2, (n_subjects, n_permutations)) * 2.0 - 1
+
+
+def null_counts(matrix, columns, n_control, cutoffs, s0, batches, paired=False, block_rows=BLOCK_ROWS):
+    """
+    Counts the absolute permuted relative differences falling between the sorted observed cutoffs.
+    Args:
+        matrix: A proteins x samples matrix (proteins x subjects differences if paired) or the path of a .npy file.
+        columns: Positions of the control columns followed by the samples columns.
+        n_control: Number of control columns.
+        cutoffs: Sorted absolute observed relative differences.
+        s0: The fudge factor.
+        batches: (seed, number of permutations) pairs.
+        paired: Flips the signs of the pair differences instead of permuting the group labels.
+        block_rows: Number of proteins tested at once.
+
+    Returns:Counts of every interval between the cutoffs (len(cutoffs) + 1 bins).
+
+    """
+    matrix = open_matrix(matrix)
+    counts = np.zeros(len(cutoffs) + 1, dtype=np.int64)
+    if paired:
+        labels = [sign_flips(seed, n, matrix.shape[1]) for seed, n in batches]
+    else:
+        labels = [permutation_labels(seed, n, len(columns), n_control) for seed, n in batches]
+    for block in iter_blocks(matrix.shape[0], block_rows):
+        blocks = [block_statistics(np.asarray(matrix[block], dtype=np.float64), columns, paired)]
+        for batch_labels in labels:
+            d = np.abs(statistic(blocks, batch_labels, s0, paired)[0][0])
+            d = d[~np.isnan(d)]
+            counts += np.bincount(np.searchsorted(cutoffs, d, side='right'), minlength=len(cutoffs) + 1)
+    return counts
+
+
+def q_values(d, counts):
+    """
+    SAM q-values from the observed relative differences and the pooled permutation counts.
+    Returns:The q-values (NaN where d is NaN) and the estimated proportion of unchanged proteins (pi0).
+
+    """
+    valid = ~np.isnan(d)
+    abs_d = np.abs(d[valid])
+    order = np.argsort(abs_d)
+    cutoffs = abs_d[order]
+    n_tests, n_null = len(cutoffs), counts.sum()
+    q = np.full(len(d), np.nan)
+    if n_tests == 0 or n_null == 0:
+        return q, 1.0
+    # permuted values at or above every cutoff, rescaled to the number of observed tests
+    null_above = np.cumsum(counts[::-1])[::-1][1:] * n_tests / n_null
+    observed_above = n_tests - np.searchsorted(cutoffs, cutoffs, side='left')
+    null_cdf = np.cumsum(counts)[:-1] / n_null
+    median_null = cutoffs[min(np.searchsorted(null_cdf, 0.5), n_tests - 1)]
+    pi0 = min(1.0, np.sum(cutoffs <= median_null) / (0.5 * n_tests))
+    fdr = pi0 * null_above / observed_above
+    # the q-value is the lowest FDR of any cutoff at which the protein is called significant
+    q_sorted = np.minimum(np.minimum.accumulate(fdr), 1)
+    q_valid = np.empty(n_tests)
+    q_valid[order] = q_sorted
+    q[valid] = q_valid
+    return q, pi0
+
+
+def permutation_fdr(matrix, control_cols, samples_cols, n_permutations=N_PERMUTATIONS, s0=None, seed=0,
+                    processes=None, paired=False, batch_size=BATCH_SIZE, block_rows=BLOCK_ROWS, progress=None):
+    """
+    SAM-style permutation FDR of the control vs samples comparison.
+    Args:
+        matrix: A proteins x samples matrix, a memory-mapped matrix or the path of a .npy file. For a paired
+            design the proteins x subjects differences (samples - control) of the pairs.
+        control_cols: Positions of the control group columns (ignored if paired).
+        samples_cols: Positions of the samples group columns (ignored if paired).
+        n_permutations: Number of label permutations (sign flips if paired).
+        s0: The fudge factor, the median standard error of all proteins if None.
+        seed: A seed of the permutations, the result is the same for any number of processes.
+        processes: Number of worker processes, 1 disables the pool, None uses all CPUs.
+        paired: Tests the pair differences against 0.
+        batch_size: Number of permutations tested by one matrix product.
+        block_rows: Number of proteins tested at once.
+        progress: A function called with the completed fraction of the permutations, it may raise to stop.
+
+    Returns:A dict with the relative differences 'd', the 'q_val' of every protein, 's0' and 'pi0'.
+
+    """
+    columns = list(control_cols) + list(samples_cols)
+    n_control = len(control_cols)
+    values = open_matrix(matrix)
+    d, s0 = observed_statistics(values, columns, n_control, s0, paired, block_rows)
+    cutoffs = np.sort(np.abs(d[~np.isnan(d)]))
+    sizes = [min(batch_size, n_permutations - start) for start in range(0, n_permutations, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    batches = list(zip(seeds, sizes))
+    n_workers = min(len(batches), processes or os.cpu_count() or 1)
+    n_columns = values.shape[1] if paired else len(columns)
+    if n_workers <= 1 or values.shape[0] * n_columns * n_permutations < PARALLEL_MIN_CELLS:
+        n_workers = 1
+    n_tasks = max(min(len(batches), n_workers * TASKS_PER_WORKER), 1)
+    tasks = [batches[i::n_tasks] for i in range(n_tasks)]
+    counts = np.zeros(len(cutoffs) + 1, dtype=np.int64)
+    if n_workers == 1:
+        for done, task in enumerate(tasks, 1):
+            counts += null_counts(values, columns, n_control, cutoffs, s0, task, paired, block_rows)
+            if progress is not None:
+                progress(done / n_tasks)
+    else:
+        if isinstance(values, np.memmap) and values.filename:
+            matrix = values.filename
+        # spawned workers don't inherit the locks of a threaded server, e.g. when jobs run inline
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(null_counts, matrix, columns, n_control, cutoffs, s0, task, paired,
+                                       block_rows) for task in tasks]
+            try:
+                for done, future in enumerate(as_completed(futures), 1):
+                    counts += future.result()
+                    if progress is not None:
+                        progress(done / n_tasks)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    q, pi0 = q_values(d, counts)
+    return {'d': d, 'q_val': q, 's0': s0, 'pi0': pi0}
+
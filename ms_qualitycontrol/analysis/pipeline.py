@@ -0,0 +1,301 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import dendrogram, linkage
+
+from . import clustering as clus
+from . import correlation as corr
+from . import functions as fn
+from . import markers
+from . import outofcore as ooc
+from . import permutation as perm
+from . import stats_engine as se
+from . import table_cache as tc
+
+# The analysis of the web interface as a plain Python object, for notebooks, scripts and services. Every stage is
+# evaluated when it is asked for and memoized on its inputs: the parameters it reads and the keys of the stages it
+# builds on. Changing a parameter therefore recomputes only the stages downstream of it, e.g. a new num_std only
+# recomputes the flags, a new control group the statistics but not the correlation map.
+#
+#   pipeline = Pipeline('data/example_Weight_loss_study.txt', control='TP1', samples='TP4',
+#                       marker_file='data/Marker List.xlsx')
+#   pipeline.statistics()          # filtered table with p-values, fold changes and q-values
+#   pipeline.flags('Platelets')    # ratio, threshold and flag of every sample
+#   pipeline.set(num_std=2)        # only the flags are computed again
+
+# panel name, genes used (None uses the whole panel) and whether the ratio is reversed, as in the bar charts
+PANELS = [('Platelets', None, False),
+          ('Erythrocytes', None, False),
+          ('Coagulation', ('FGG', 'FGB', 'FGA'), True)]
+
+DEFAULTS = {
+    'filepath': None,
+    'data': None,
+    'cache_path': None,
+    'cache_max_bytes': 1024 * 1024 * 1024,
+    'percent': 0.5,
+    'control': None,
+    'samples': None,
+    'paired': False,
+    'equal_var': True,
+    'dtype': 'float64',
+    'fdr_permutations': perm.N_PERMUTATIONS,
+    'fdr_s0': None,
+    'fdr_seed': 0,
+    'fdr_processes': None,
+    'num_std': 3,
+    'correlation_method': 'pearson',
+    'correlation_dtype': 'float64',
+    'correlation_threads': None,
+    'cluster_exact_max': 5000,
+    'cluster_dims': 256,
+    'preclusters': None,
+}
+
+# stage: (parameters, stages it builds on)
+STAGES = {
+    'load': (('filepath', 'data', 'cache_path'), ()),
+    'filtered': (('percent',), ('load',)),
+    'groups': (('control', 'samples', 'paired'), ('filtered',)),
+    'statistics': (('equal_var', 'dtype'), ('filtered', 'groups')),
+    'fdr': (('fdr_permutations', 'fdr_s0', 'fdr_seed'), ('filtered', 'groups')),
+    'ratio': ((), ('filtered',)),
+    'flags': (('num_std',), ('ratio',)),
+    'correlation': (('correlation_method', 'correlation_dtype'), ('filtered',)),
+    'clustering': (('cluster_exact_max', 'cluster_dims', 'preclusters'), ('correlation',)),
+}
+
+
+def group_columns(df, control_input, sample_input=None):
+    """
+    The LFQ columns of the control and samples groups, chosen like in the web interface: without a samples
+    identifier every other column is a sample.
+    """
+    columns_control_group = fn.get_list_of_col(df, fn.lower_input(control_input))
+    if not columns_control_group:
+        raise ValueError('The "{}" identifier doesn\'t present in the columns\' name.'.format(control_input))
+    if not sample_input:
+        excluded = columns_control_group + ['Gene names', 'Protein IDs', 'Protein names']
+        columns_samples_group = [column for column in df.columns if column not in excluded]
+    else:
+        columns_samples_group = fn.get_list_of_col(df, fn.lower_input(sample_input))
+        if not columns_samples_group:
+            raise ValueError('"{}" identifier doesn\'t present in the file\'s columns.'.format(sample_input))
+    return columns_control_group, columns_samples_group
+
+
+def panel_genes(name):
+    """
+    Returns:The genes of a quality marker panel used for its contamination ratio and whether it is reversed.
+    """
+    for panel, genes, reverse in PANELS:
+        if panel == name:
+            return tuple(gene for gene in markers.get_panel(name)['genes'] if genes is None or gene in genes), reverse
+    return markers.get_panel(name)['genes'], False
+
+
+class Pipeline(object):
+    """
+    Lazily evaluated, memoized QC analysis of one protein table.
+    Args:
+        filepath: A path to the protein table, or
+        data: an already parsed table (a Data Frame returned by read_own_table).
+        marker_file: A marker panel file (or directory of panel files) registered for the panel ratios.
+        **params: Any of DEFAULTS, e.g. control='TP1', samples='TP4', num_std=2.
+
+    """
+
+    def __init__(self, filepath=None, data=None, marker_file=None, **params):
+        self.params = dict(DEFAULTS)
+        self._cache = {}
+        # ids of tables can be reused once they are freed, every table passed to set gets a new version instead
+        self._data_version = 0
+        if marker_file is not None:
+            if os.path.isdir(marker_file):
+                markers.register_directory(marker_file, params.get('cache_path'))
+            else:
+                markers.register_file(marker_file, params.get('cache_path'))
+        self.set(filepath=filepath, data=data, **params)
+
+    def set(self, **params):
+        """
+        Changes parameters, the stages depending on them are computed again on their next use. Passing data always
+        counts as a new table, also when the same Data Frame was modified in place.
+        """
+        unknown = set(params) - set(DEFAULTS)
+        if unknown:
+            raise TypeError('Unknown pipeline parameters: {}'.format(', '.join(sorted(unknown))))
+        if 'data' in params:
+            self._data_version += 1
+        self.params.update(params)
+        return self
+
+    def key(self, stage, panel=None):
+        """
+        Returns:The inputs of a stage: its parameters and the keys of the stages it builds on.
+        """
+        names, upstream = STAGES[stage]
+        values = []
+        for name in names:
+            value = self.params[name]
+            # tables are compared by version, files by path and modification time
+            if name == 'data':
+                value = self._data_version
+            elif name == 'filepath' and value is not None:
+                value = (value, os.path.getmtime(value))
+            values.append(value)
+        if stage == 'ratio':
+            values.append((panel,) + panel_genes(panel))
+        return tuple(values), tuple(self.key(each, panel) for each in upstream)
+
+    def memoized(self, stage, compute, panel=None):
+        key = self.key(stage, panel)
+        entry = self._cache.get((stage, panel))
+        if entry is None or entry[0] != key:
+            entry = (key, compute())
+            self._cache[(stage, panel)] = entry
+        return entry[1]
+
+    def load(self):
+        """
+        Returns:The parsed table.
+        """
+        def compute():
+            if self.params['data'] is not None:
+                return self.params['data']
+            if self.params['filepath'] is None:
+                raise ValueError('The pipeline has neither a file nor a table.')
+            if self.params['cache_path']:
+                return tc.read_cached_table(self.params['filepath'], self.params['cache_path'],
+                                            self.params['cache_max_bytes'])
+            return fn.read_own_table(self.params['filepath'])
+
+        return self.memoized('load', compute)
+
+    def lfq_columns(self):
+        return fn.get_list_of_col(self.load(), fn.lower_input('LFQ'))
+
+    def filtered(self):
+        """
+        Returns:The proteins with gene names and at least percent valid values.
+        """
+        def compute():
+            df = self.load().dropna(subset=['Gene names'])
+            return fn.filter_valid_values(df, index=fn.get_reversed_list_of_col(df, fn.lower_input('LFQ')),
+                                          numeric_columns=self.lfq_columns(), percent=self.params['percent'], ax=0)
+
+        return self.memoized('filtered', compute)
+
+    def groups(self):
+        """
+        Returns:A dict with the control and samples columns, their positions among the LFQ columns and the paired
+        design (None if unpaired).
+        """
+        def compute():
+            if self.params['control'] is None:
+                raise ValueError('The pipeline needs a control group identifier, e.g. control=\'TP1\'.')
+            control, samples = group_columns(self.filtered(), self.params['control'], self.params['samples'])
+            columns_lfq = self.lfq_columns()
+            design = se.parse_design(columns_lfq) if self.params['paired'] else None
+            return {'control': control, 'samples': samples,
+                    'control_cols': [columns_lfq.index(column) for column in control if column in columns_lfq],
+                    'samples_cols': [columns_lfq.index(column) for column in samples if column in columns_lfq],
+                    'design': design if design is not None and se.is_paired(design) else None}
+
+        return self.memoized('groups', compute)
+
+    def fdr(self):
+        """
+        Returns:The permutation FDR of the control vs samples comparison (see permutation.permutation_fdr).
+        """
+        def compute():
+            groups = self.groups()
+            matrix = self.filtered()[self.lfq_columns()].values
+            options = dict(n_permutations=self.params['fdr_permutations'], s0=self.params['fdr_s0'],
+                           seed=self.params['fdr_seed'], processes=self.params['fdr_processes'])
+            if groups['design'] is not None:
+                differences = ooc.pair_differences(matrix, groups['design'], groups['control_cols'],
+                                                   groups['samples_cols'])
+                return perm.permutation_fdr(differences, [], [], paired=True, **options)
+            return perm.permutation_fdr(matrix, groups['control_cols'], groups['samples_cols'], **options)
+
+        return self.memoized('fdr', compute)
+
+    def statistics(self):
+        """
+        Returns:The filtered table with the p-values, group means, fold changes and q-values, like the table
+        behind the volcano plot.
+        """
+        def compute():
+            groups, df = self.groups(), self.filtered().copy(deep=False)
+            if groups['design'] is not None:
+                statistics = se.paired_group_statistics(df[self.lfq_columns()].apply(pd.to_numeric).values,
+                                                        groups['design'], groups['control_cols'],
+                                                        groups['samples_cols'], dtype=self.params['dtype'])
+            else:
+                statistics = se.differential_statistics(df[groups['control']].apply(pd.to_numeric),
+                                                        df[groups['samples']].apply(pd.to_numeric),
+                                                        equal_var=self.params['equal_var'], dtype=self.params['dtype'])
+            for column, values in statistics.items():
+                df[column] = values
+            return df
+
+        df = self.memoized('statistics', compute).copy(deep=False)
+        df.insert(df.columns.get_loc('L10FC') + 1, 'q_val', self.fdr()['q_val'])
+        return df
+
+    def ratio(self, panel):
+        """
+        Returns:The sample names, the contamination ratios of a marker panel and their summary.
+        """
+        def compute():
+            genes, reverse = panel_genes(panel)
+            df, columns_lfq = self.filtered(), self.lfq_columns()
+            rows = fn.lookup_rows(fn.build_indices(df)['Gene names'], genes)
+            ratio = fn.contamination_ratio(df[columns_lfq], df[columns_lfq].iloc[rows], reverse=reverse)
+            names = [name.replace('LFQ', '').replace(' intensity', '').strip() for name in columns_lfq]
+            return names, ratio, fn.ratio_summary(ratio)
+
+        return self.memoized('ratio', compute, panel)
+
+    def flags(self, panel):
+        """
+        Returns:A Data Frame with the ratio, the threshold (num_std) and the flag of every sample for a panel.
+        """
+        def compute():
+            names, ratio, summary = self.ratio(panel)
+            threshold = fn.ratio_threshold(summary, self.params['num_std'])
+            return pd.DataFrame({'Sample': names, 'ratio': ratio, 'threshold': threshold,
+                                 'flagged': np.asarray(ratio) > threshold})
+
+        return self.memoized('flags', compute, panel)
+
+    def correlation(self):
+        """
+        Returns:The protein x protein correlation of the log intensities (the global correlation map).
+        """
+        def compute():
+            df = self.filtered()
+            data = corr.correlation(df[self.lfq_columns()].values, method=self.params['correlation_method'],
+                                    dtype=self.params['correlation_dtype'],
+                                    threads=self.params['correlation_threads'], transform=corr.log_transform)
+            return pd.DataFrame(data, index=df['Gene names'], columns=df['Gene names'], copy=False)
+
+        return self.memoized('correlation', compute)
+
+    def clustering(self):
+        """
+        Returns:A dict with the Ward 'linkage' matrix of the correlation map and the 'leaves' order of its
+        dendrogram.
+        """
+        def compute():
+            data = self.correlation()
+            if len(data) <= self.params['cluster_exact_max']:
+                linkage_matrix = linkage(data, 'ward', metric='euclidean')
+            else:
+                linkage_matrix = clus.ward_linkage(data.values, self.params['cluster_dims'],
+                                                   self.params['preclusters'])
+            return {'linkage': linkage_matrix, 'leaves': dendrogram(linkage_matrix, no_plot=True)['leaves']}
+
+        return self.memoized('clustering', compute)
@@ -1,33 +1,77 @@
+import copy
+
 import numpy as np
 import plotly.figure_factory as FF
 import plotly.graph_objs as go
 from scipy.cluster.hierarchy import linkage
 
 
-def getComplexHeatmapFigure(data, annotation):
-    # Initialize figure by creating upper dendrogram
-    figure = FF.create_dendrogram(data.values, orientation='bottom', labels=data.columns,
-                                  linkagefun=lambda x: linkage(data, 'ward', metric='euclidean'),
-                                  colorscale=list(['dimgray', 'dimgray', 'dimgray', 'dimgray',
-                                                   'dimgray', 'dimgray', 'dimgray']))
+# size of the correlation map, shared by the static figure and its annotation overlay
+HEATMAP_LAYOUT = {'width': 740, 'height': 740, 'margin': {'l': 20, 'b': 50, 't': 20, 'r': 0}}
+HEATMAP_AXIS = {'mirror': False, 'showgrid': False, 'showline': False, 'zeroline': False, 'showticklabels': False,
+                'ticks': ""}
+
+
+def getHeatmapClustering(data, linkagefun=None):
+    """
+    Ward clustering of the correlation map, computed once per dataset and reused by every figure rebuild.
+    Args:
+        data: The correlation matrix.
+        linkagefun: A function of the matrix values returning the linkage matrix, scipy's Ward linkage if None.
+
+    Returns:A dict with the 'linkage' matrix, the 'top' and 'side' dendrogram figures, the 'leaves' order and
+    the 'markers' (protein name -> x coordinate) of the map.
+
+    """
+    if linkagefun is None:
+        linkage_matrix = linkage(data, 'ward', metric='euclidean')
+    else:
+        linkage_matrix = linkagefun(data.values)
+    # the dendrograms only need the linkage, not the pairwise distances
+    top = FF.create_dendrogram(data.values, orientation='bottom', labels=data.columns,
+                               distfun=lambda x: None, linkagefun=lambda x: linkage_matrix,
+                               colorscale=list(['dimgray', 'dimgray', 'dimgray', 'dimgray',
+                                                'dimgray', 'dimgray', 'dimgray']))
+    side = FF.create_dendrogram(data.values, orientation='right',  # hovertext=list(data.columns),
+                                # labels=data.columns,
+                                distfun=lambda x: None, linkagefun=lambda x: linkage_matrix,
+                                colorscale=list(['dimgray', 'dimgray', 'dimgray', 'dimgray',
+                                                 'dimgray', 'dimgray', 'dimgray']))
+    return {'linkage': linkage_matrix, 'top': top, 'side': side,
+            'leaves': list(map(int, side['layout']['yaxis']['ticktext'])),
+            'markers': dict(zip(top['layout']['xaxis']['ticktext'], top['layout']['xaxis']['tickvals']))}
+
+
+def getComplexHeatmapFigure(data, annotation, clustering=None, cells=None):
+    """
+    The correlation map with both dendrograms.
+    Args:
+        data: The correlation matrix.
+        annotation: Annotations of the map.
+        clustering: The result of getHeatmapClustering, computed if None.
+        cells: The (z, x, y) cells of a level of detail of the map, all proteins in leaf order if None.
+
+    Returns:The figure and the markers (protein name -> x coordinate).
+
+    """
+    clustering = clustering or getHeatmapClustering(data)
+    # Initialize figure by copying upper dendrogram
+    figure = copy.deepcopy(clustering['top'])
     for i in range(len(figure['data'])):
         figure['data'][i]['yaxis'] = 'y2'
-    # Create Side Dendrogram
-    dendro_side = FF.create_dendrogram(data.values, orientation='right',  # hovertext=list(data.columns),
-                                       # labels=data.columns,
-                                       linkagefun=lambda x: linkage(data, 'ward', metric='euclidean'),
-                                       colorscale=list(['dimgray', 'dimgray', 'dimgray', 'dimgray',
-                                                        'dimgray', 'dimgray', 'dimgray']))
-
+    # Side Dendrogram
+    dendro_side = copy.deepcopy(clustering['side'])
     for i in range(len(dendro_side['data'])):
         dendro_side['data'][i]['xaxis'] = 'x2'
     # Add Side Dendrogram Data to Figure
     figure['data'].extend(dendro_side['data'])
-    dendro_leaves = dendro_side['layout']['yaxis']['ticktext']
-    dendro_leaves = list(map(int, dendro_leaves))
-    heat_data = data.values
-    heat_data = heat_data[dendro_leaves, :]
-    heat_data = heat_data[:, dendro_leaves]
+    dendro_leaves = clustering['leaves']
+    if cells is None:
+        heat_data = data.values
+        heat_data = heat_data[dendro_leaves, :]
+        heat_data = heat_data[:, dendro_leaves]
+    else:
+        heat_data = cells[0]
     heatmap = [
         go.Heatmap(
             x=dendro_leaves,
@@ -49,19 +93,25 @@ def getComplexHeatmapFigure(data, annotation):
         )
     ]
 
-    heatmap[0]['x'] = figure['layout']['xaxis']['tickvals']
-    heatmap[0]['y'] = dendro_side['layout']['yaxis']['tickvals']
+    if cells is None:
+        heatmap[0]['x'] = figure['layout']['xaxis']['tickvals']
+        heatmap[0]['y'] = dendro_side['layout']['yaxis']['tickvals']
+    else:
+        # blocks of proteins are drawn at the centers of their leaves, so dendrograms and markers stay aligned
+        heatmap[0]['x'] = cells[1]
+        heatmap[0]['y'] = cells[2]
 
     # Add Heatmap Data to Figure
     figure['data'].extend(heatmap)
     # Edit Layout
+    figure['layout'].update(HEATMAP_LAYOUT)
     figure['layout'].update({
-        'width': 740, 'height': 740, 'margin': {'l': 20, 'b': 50, 't': 20, 'r': 0},
         'showlegend': False, 'hovermode': 'closest', 'paper_bgcolor': '#EFEFEF',
         'plot_bgcolor': '#EFEFEF', 'annotations': annotation
     })
     # Edit xaxis
     figure['layout']['xaxis'].update({'domain': [.15, 1],
+                                      'range': getHeatmapRange(clustering),
                                       'mirror': False,
                                       'showgrid': False,
                                       'showline': False,
@@ -79,6 +129,7 @@ def getComplexHeatmapFigure(data, annotation):
 
     # Edit yaxis
     figure['layout']['yaxis'].update({'domain': [0, .85],
+                                      'range': getHeatmapRange(clustering),
                                       'mirror': False,
                                       'showgrid': False,
                                       'showline': False,
@@ -97,13 +148,60 @@ def getComplexHeatmapFigure(data, annotation):
                                         'zeroline': False,
                                         'showticklabels': False,
                                         'ticks': ""}})
-    markers = dict(zip(figure['layout']['xaxis']['ticktext'], figure['layout']['xaxis']['tickvals']))
+    return figure, clustering['markers']
 
-    return figure, markers
 
+def getHeatmapRange(clustering):
+    # the proteins are drawn at 5, 15, 25, ... on both axes of the map
+    return [0, 10 * len(clustering['leaves'])]
 
-def getVolcanoPlot(data, color, marker_size=8, name=None, opacity=1, marker_symbol='circle'):
-    return go.Scatter(
+
+def getHeatmapTile(figure, cells, x_range, y_range):
+    """
+    The correlation map with the heatmap replaced by the cells of a zoomed range, the dendrograms are reused.
+    Args:
+        figure: The overview figure of getComplexHeatmapFigure.
+        cells: The (z, x, y) cells of the visible range.
+        x_range: The visible range of the x axis.
+        y_range: The visible range of the y axis.
+
+    Returns:A figure.
+
+    """
+    heatmap = go.Heatmap(figure['data'][-1])
+    heatmap.update({'z': cells[0].round(4), 'x': cells[1], 'y': cells[2]})
+    layout = go.Layout(figure['layout'])
+    layout['xaxis'] = dict(layout['xaxis'], range=x_range)
+    layout['yaxis'] = dict(layout['yaxis'], range=y_range)
+    return {'data': list(figure['data'][:-1]) + [heatmap], 'layout': layout}
+
+
+def getHeatmapOverlay(annotation, x_range, y_range):
+    """
+    A transparent figure with only the annotations of the correlation map, laid over the static map, so that
+    selecting a protein sends the annotations instead of the whole map.
+    Args:
+        annotation: Annotations in the coordinates of the map.
+        x_range: The visible range of the map's x axis.
+        y_range: The visible range of the map's y axis.
+
+    Returns:A figure.
+
+    """
+    layout = dict(HEATMAP_LAYOUT)
+    layout.update({
+        'showlegend': False, 'paper_bgcolor': 'rgba(0,0,0,0)', 'plot_bgcolor': 'rgba(0,0,0,0)',
+        'annotations': annotation,
+        'xaxis': dict(HEATMAP_AXIS, domain=[.15, 1], range=x_range, fixedrange=True),
+        'yaxis': dict(HEATMAP_AXIS, domain=[0, .85], range=y_range, fixedrange=True),
+    })
+    return {'data': [], 'layout': layout}
+
+
+def getVolcanoPlot(data, color, marker_size=8, name=None, opacity=1, marker_symbol='circle', webgl=False):
+    # WebGL keeps large studies responsive, SVG is drawn sharper
+    scatter = go.Scattergl if webgl else go.Scatter
+    return scatter(
         x=data['L10FC'],
         y=data['(-)log10_p_val'],
         name=name,
@@ -121,7 +219,27 @@ def getVolcanoPlot(data, color, marker_size=8, name=None, opacity=1, marker_symb
         hoverinfo='x' + 'y' + 'text')
 
 
-def getLayoutVolcanoPlot():
+def getVolcanoSignificant(data, fdr_level):
+    # SAM ranks the proteins by their relative difference (with s0), not by p, so no p-value line separates the
+    # significant proteins: they are circled instead
+    return go.Scatter(
+        x=data['L10FC'],
+        y=data['(-)log10_p_val'],
+        name='FDR {:g}%'.format(fdr_level * 100),
+        mode='markers',
+        text=data['Gene names'],
+        marker=dict(
+            size=14,
+            symbol='circle-open',
+            color='#FF3B3F',
+            line=dict(
+                width=2,
+                color='#FF3B3F'),
+            showscale=False),
+        hoverinfo='x' + 'y' + 'text')
+
+
+def getLayoutVolcanoPlot(threshold=None):
     return go.Layout(
         height=700, width=500,
         margin={'l': 40, 'b': 40, 't': 40, 'r': 20},
@@ -161,8 +279,8 @@ def getLayoutVolcanoPlot():
         showlegend=True,
         shapes=[{
             'type': 'line', 'xref': 'paper', 'opacity': 1.0,
-            'x0': 0, 'y0': -np.log10(0.05), 'x1': 1, 'y1': -np.log10(0.05),
-            'line': {'color': '#FF3B3F', 'width': 2, 'dash': 'dash'}, }, ],
+            'x0': 0, 'y0': threshold, 'x1': 1, 'y1': threshold,
+            'line': {'color': '#FF3B3F', 'width': 2, 'dash': 'dash'}, }, ] if threshold is not None else [],
         legend=dict(x=0.82, y=1.0, traceorder='grouped', orientation="v",
                     font=dict(family='sans-serif', size=12, color='black'),
                     bordercolor='black', borderwidth=2),
@@ -0,0 +1,327 @@
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import special
+
+# Differential statistics of all proteins at once. Every group is reduced to its per-protein moments
+# (number of valid values, mean and sum of squared deviations) with explicit NaN masks, and the t-test,
+# the group means and the fold change are computed from those moments with plain array arithmetic.
+# The moments are centered, so the float32 option doesn't lose the variance of large LFQ intensities.
+# Several contrasts share the moments of their groups, so every group is reduced only once.
+
+# contrasts x proteins above which the contrasts are spread over a process pool
+PARALLEL_MIN_CELLS = 4 * 1000 * 1000
+
+
+def group_moments(values, dtype=np.float64):
+    """
+    Args:
+        values: A proteins x replicates matrix of one group, missing values are NaN.
+        dtype: A dtype of the computation, np.float32 halves the memory traffic.
+
+    Returns:Number of valid values, mean and sum of squared deviations from the mean of every protein.
+
+    """
+    values = np.asarray(values, dtype=dtype)
+    mask = ~np.isnan(values)
+    n = mask.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(mask, values, 0).sum(axis=1, dtype=dtype) / n
+    deviations = np.where(mask, values - mean[:, np.newaxis], 0)
+    m2 = np.einsum('ij,ij->i', deviations, deviations)
+    return n, mean, m2
+
+
+def t_test(moments_a, moments_b, equal_var=True):
+    """
+    Two-sample t-test from the moments of two groups, like scipy.stats.ttest_ind(nan_policy='omit').
+    Args:
+        moments_a: Moments of the first group returned by group_moments.
+        moments_b: Moments of the second group.
+        equal_var: Student's t-test with the pooled variance if True, Welch's t-test otherwise.
+
+    Returns:The t statistics and the two-sided p-values, NaN where a protein has too few valid values.
+
+    """
+    (n_a, mean_a, m2_a), (n_b, mean_b, m2_b) = moments_a, moments_b
+    n_a, n_b = n_a.astype(np.float64), n_b.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if equal_var:
+            df = n_a + n_b - 2
+            denom = np.sqrt((m2_a + m2_b) / df * (1 / n_a + 1 / n_b))
+        else:
+            vn_a, vn_b = m2_a / (n_a - 1) / n_a, m2_b / (n_b - 1) / n_b
+            df = (vn_a + vn_b) ** 2 / (vn_a ** 2 / (n_a - 1) + vn_b ** 2 / (n_b - 1))
+            denom = np.sqrt(vn_a + vn_b)
+        t_stat = (mean_a - mean_b) / denom
+        p_val = 2 * special.stdtr(df, -np.abs(t_stat))
+    invalid = (df <= 0) | ~np.isfinite(t_stat)
+    if not equal_var:
+        # the pooled variance of Student's test only needs one group with two values
+        invalid |= (n_a < 2) | (n_b < 2)
+    t_stat = np.where(invalid, np.nan, t_stat)
+    p_val = np.where(invalid, np.nan, p_val)
+    return t_stat, p_val
+
+
+def log10_fold_change(samples_mean, control_mean):
+    """
+    log10(samples_mean / control_mean), NaN where the ratio isn't defined or is zero.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = samples_mean / control_mean
+        return np.where((control_mean != 0) & (ratio != 0), np.log10(ratio), np.nan)
+
+
+def statistics_from_moments(control, samples, equal_var=True):
+    t_stat, p_val = t_test(control, samples, equal_var=equal_var)
+    with np.errstate(divide='ignore'):
+        log_p_val = -np.log10(p_val)
+    return {'p_val': p_val, '(-)log10_p_val': log_p_val, 'control_mean': control[1], 'samples_mean': samples[1],
+            'L10FC': log10_fold_change(samples[1], control[1])}
+
+
+def differential_statistics(control, samples, equal_var=True, dtype=np.float64):
+    """
+    Computes all per-protein statistics of clean_data in one pass over the LFQ matrix.
+    Args:
+        control: A proteins x replicates matrix (or Data Frame) of the control group, missing values are NaN.
+        samples: A proteins x replicates matrix of the samples group.
+        equal_var: Student's (True) or Welch's (False) t-test.
+        dtype: np.float64 or np.float32.
+
+    Returns:A dict with the 'p_val', '(-)log10_p_val', 'control_mean', 'samples_mean' and 'L10FC' columns.
+
+    """
+    return statistics_from_moments(group_moments(control, dtype), group_moments(samples, dtype), equal_var)
+
+
+def timepoint_groups(columns, pattern=r'TP\d+'):
+    """
+    Groups the LFQ columns by the first match of a pattern, e.g. LFQ_58_TP2 -> TP2.
+    Returns:A dict of group names (in natural order) to column positions.
+
+    """
+    groups = {}
+    for position, column in enumerate(columns):
+        match = re.search(pattern, column, flags=re.IGNORECASE)
+        if match:
+            groups.setdefault(match.group(0).upper(), []).append(position)
+    natural = lambda name: [int(x) if x.isdigit() else x for x in re.split(r'(\d+)', name)]
+    return {name: groups[name] for name in sorted(groups, key=natural)}
+
+
+def baseline_contrasts(group_names, baseline):
+    """
+    Returns:(control, samples) pairs of every group against the baseline group.
+    """
+    return [(baseline, name) for name in group_names if name != baseline]
+
+
+def contrast_name(contrast):
+    return '{} vs {}'.format(contrast[1], contrast[0])
+
+
+def contrasts_from_moments(moments, contrasts, equal_var=True):
+    return [statistics_from_moments(moments[control], moments[samples], equal_var) for control, samples in contrasts]
+
+
+def multi_contrast_statistics(values, groups, contrasts, equal_var=True, dtype=np.float64, processes=None,
+                              moments=None):
+    """
+    Computes the statistics of several contrasts together. The moments of every group are computed once and
+    shared by all contrasts using it; large contrast sets are split over a process pool.
+    Args:
+        values: A proteins x samples matrix, missing values are NaN. Not read if moments are given.
+        groups: A dict of group names to column positions.
+        contrasts: A list of (control group, samples group) pairs.
+        equal_var: Student's (True) or Welch's (False) t-test.
+        dtype: np.float64 or np.float32.
+        processes: Number of worker processes, 1 disables the pool, None uses all CPUs.
+        moments: Precomputed group moments, e.g. computed block by block out of core.
+
+    Returns:A dict of contrast names ('TP4 vs TP1') to dicts of the statistics columns.
+
+    """
+    used = {name for contrast in contrasts for name in contrast}
+    unknown = used - set(groups) if moments is None else used - set(moments)
+    if unknown:
+        raise ValueError('Unknown groups in the contrasts: {}'.format(', '.join(sorted(unknown))))
+    if moments is None:
+        values = np.asarray(values)
+        moments = {name: group_moments(values[:, groups[name]], dtype) for name in used}
+    n_proteins = len(next(iter(moments.values()))[0]) if moments else 0
+    if processes == 1 or len(contrasts) < 2 or len(contrasts) * n_proteins < PARALLEL_MIN_CELLS:
+        results = contrasts_from_moments(moments, contrasts, equal_var)
+    else:
+        n_chunks = min(len(contrasts), processes or os.cpu_count() or 1)
+        # spawned workers don't inherit the locks of a threaded server, e.g. when a report is downloaded
+        with ProcessPoolExecutor(n_chunks, mp_context=multiprocessing.get_context('spawn')) as executor:
+            chunks = [contrasts[i::n_chunks] for i in range(n_chunks)]
+            futures = [executor.submit(contrasts_from_moments,
+                                       {name: moments[name] for contrast in chunk for name in contrast},
+                                       chunk, equal_var) for chunk in chunks]
+            chunk_results = [future.result() for future in futures]
+        results = [None] * len(contrasts)
+        for i, chunk_result in enumerate(chunk_results):
+            results[i::n_chunks] = chunk_result
+    return {contrast_name(contrast): result for contrast, result in zip(contrasts, results)}
+
+
+# Paired (repeated measures) design. The subject and the timepoint of every LFQ column are parsed from its
+# header, e.g. LFQ_02_TP1 -> subject 02, timepoint TP1, and the columns are aligned into a
+# proteins x subjects x timepoints tensor, so every comparison of two timepoints is a paired test over the
+# subjects measured at both.
+
+DESIGN_PATTERN = r'^LFQ[\s_.-]*(?P<subject>.+?)[\s_.-]+(?P<timepoint>TP\d+)$'
+
+
+def parse_design(columns, pattern=DESIGN_PATTERN):
+    """
+    Args:
+        columns: LFQ column names.
+        pattern: A regular expression with the 'subject' and 'timepoint' groups.
+
+    Returns:A dict with the 'subjects' and 'timepoints' (in order of appearance / natural order) and the
+    'subject' and 'timepoint' position of every column (-1 if the header doesn't match the pattern).
+
+    """
+    matches = [re.match(pattern, column, flags=re.IGNORECASE) for column in columns]
+    subjects, timepoints = [], []
+    for match in matches:
+        if match:
+            if match.group('subject') not in subjects:
+                subjects.append(match.group('subject'))
+            if match.group('timepoint').upper() not in timepoints:
+                timepoints.append(match.group('timepoint').upper())
+    natural = lambda name: [int(x) if x.isdigit() else x for x in re.split(r'(\d+)', name)]
+    timepoints = sorted(timepoints, key=natural)
+    subject = np.array([subjects.index(m.group('subject')) if m else -1 for m in matches], dtype=int)
+    timepoint = np.array([timepoints.index(m.group('timepoint').upper()) if m else -1 for m in matches], dtype=int)
+    return {'subjects': subjects, 'timepoints': timepoints, 'subject': subject, 'timepoint': timepoint}
+
+
+def is_paired(design):
+    # a paired design needs at least one subject measured at two timepoints
+    counts = np.bincount(design['subject'][design['subject'] >= 0], minlength=len(design['subjects']))
+    return bool(len(counts)) and counts.max() > 1
+
+
+def subject_indicator(design, positions, n_columns):
+    """
+    Returns:A columns x subjects matrix with 1.0 where one of the given columns belongs to the subject.
+    """
+    indicator = np.zeros((n_columns, len(design['subjects'])))
+    positions = [position for position in positions if design['subject'][position] >= 0]
+    indicator[positions, design['subject'][positions]] = 1
+    return indicator
+
+
+def subject_means(values, indicator):
+    """
+    NaN-aware mean of the columns of every subject (a single column for one timepoint per subject) as two
+    matrix products.
+    Returns:A proteins x subjects matrix, NaN where a subject has no valid value.
+
+    """
+    values = np.asarray(values, dtype=np.float64)
+    mask = ~np.isnan(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(mask, values, 0).dot(indicator) / mask.dot(indicator)
+
+
+def design_tensor(values, design):
+    """
+    Returns:A proteins x subjects x timepoints tensor of the intensities, NaN where a subject wasn't measured.
+    """
+    n_subjects, n_timepoints = len(design['subjects']), len(design['timepoints'])
+    indicator = np.zeros((len(design['subject']), n_subjects * n_timepoints))
+    matched = np.flatnonzero(design['subject'] >= 0)
+    indicator[matched, design['subject'][matched] * n_timepoints + design['timepoint'][matched]] = 1
+    return subject_means(values, indicator).reshape(-1, n_subjects, n_timepoints)
+
+
+def paired_statistics(control, samples, dtype=np.float64):
+    """
+    Paired t-test (like scipy.stats.ttest_rel on the complete pairs) of all proteins and contrasts at once.
+    Args:
+        control: A proteins x subjects (x contrasts) array of the control values of every subject.
+        samples: The samples values aligned with control.
+        dtype: np.float64 or np.float32.
+
+    Returns:A dict with the 'p_val', '(-)log10_p_val', 'control_mean', 'samples_mean' and 'L10FC' columns
+    (proteins (x contrasts) arrays). The means are taken over the complete pairs.
+
+    """
+    control, samples = np.asarray(control, dtype=dtype), np.asarray(samples, dtype=dtype)
+    complete = ~np.isnan(control) & ~np.isnan(samples)
+    n = complete.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        control_mean = np.where(complete, control, 0).sum(axis=1) / n
+        samples_mean = np.where(complete, samples, 0).sum(axis=1) / n
+        mean_diff = samples_mean - control_mean
+        deviations = np.where(complete, samples - control - np.expand_dims(mean_diff, 1), 0)
+        se = np.sqrt((deviations * deviations).sum(axis=1) / (n - 1) / n)
+        t_stat = -mean_diff / se
+        p_val = 2 * special.stdtr(n - 1, -np.abs(t_stat))
+    p_val = np.where((n < 2) | ~np.isfinite(t_stat), np.nan, p_val)
+    with np.errstate(divide='ignore'):
+        log_p_val = -np.log10(p_val)
+    return {'p_val': p_val, '(-)log10_p_val': log_p_val, 'control_mean': control_mean, 'samples_mean': samples_mean,
+            'L10FC': log10_fold_change(samples_mean, control_mean)}
+
+
+def subject_pairs(values, design, control_cols, samples_cols):
+    """
+    Each subject is represented by the mean of its control columns and the mean of its samples columns.
+    Returns:The proteins x subjects control and samples matrices.
+
+    """
+    n_columns = len(design['subject'])
+    return (subject_means(values, subject_indicator(design, control_cols, n_columns)),
+            subject_means(values, subject_indicator(design, samples_cols, n_columns)))
+
+
+def paired_group_statistics(values, design, control_cols, samples_cols, dtype=np.float64):
+    """
+    Paired version of differential_statistics.
+    Args:
+        values: A proteins x samples matrix, missing values are NaN.
+        design: A design returned by parse_design for the columns of values.
+        control_cols: Positions of the control group columns.
+        samples_cols: Positions of the samples group columns.
+        dtype: np.float64 or np.float32.
+
+    Returns:A dict with the 'p_val', '(-)log10_p_val', 'control_mean', 'samples_mean' and 'L10FC' columns.
+
+    """
+    return paired_statistics(*subject_pairs(values, design, control_cols, samples_cols), dtype=dtype)
+
+
+def pair_differences(values, design, control_cols, samples_cols):
+    control, samples = subject_pairs(values, design, control_cols, samples_cols)
+    return samples - control
+
+
+def paired_contrast_statistics(tensor, timepoints, contrasts, dtype=np.float64):
+    """
+    Paired tests of several timepoint contrasts in one vectorized pass over the design tensor.
+    Args:
+        tensor: A proteins x subjects x timepoints tensor returned by design_tensor.
+        timepoints: Timepoint names of the last axis.
+        contrasts: A list of (control timepoint, samples timepoint) pairs.
+
+    Returns:A dict of contrast names ('TP4 vs TP1') to dicts of the statistics columns.
+
+    """
+    unknown = {name for contrast in contrasts for name in contrast} - set(timepoints)
+    if unknown:
+        raise ValueError('Unknown timepoints in the contrasts: {}'.format(', '.join(sorted(unknown))))
+    control = tensor[:, :, [timepoints.index(control) for control, samples in contrasts]]
+    samples = tensor[:, :, [timepoints.index(samples) for control, samples in contrasts]]
+    statistics = paired_statistics(control, samples, dtype)
+    return {contrast_name(contrast): {column: values[:, i] for column, values in statistics.items()}
+            for i, contrast in enumerate(contrasts)}
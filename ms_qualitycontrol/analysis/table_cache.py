@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from .functions import read_own_table, get_separator
+
+# bump whenever read_own_table changes what ends up in the parsed table
+CACHE_VERSION = '1'
+
+INTENSITIES_FILE = 'intensities.npy'
+STRINGS_FILE = 'strings.json'
+META_FILE = 'meta.json'
+
+
+def new_digest(salt=''):
+    return hashlib.sha256((CACHE_VERSION + salt).encode())
+
+
+def file_digest(filepath, salt='', block_size=1024 * 1024):
+    """
+    Hashes the raw content of a file, so that the same table uploaded under another name hits the same cache entry.
+    Args:
+        filepath: A path to the file.
+        salt: Reader options which change the parsed table, e.g. the separator and the LFQ dtype.
+        block_size: Number of bytes read at once.
+
+    Returns:A hex digest of the file content and the cache version.
+
+    """
+    digest = new_digest(salt)
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def entry_path(cache_dir, digest):
+    return os.path.join(cache_dir, digest)
+
+
+def entry_size(path):
+    try:
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    except OSError:
+        # evicted by another request meanwhile
+        return 0
+
+
+def store_table(cache_dir, digest, df):
+    """
+    Writes a parsed table into the cache. Numeric (LFQ) columns are kept as one typed binary matrix,
+    all other columns (Gene names, Protein IDs, Protein names) as string tables.
+    Args:
+        cache_dir: A directory of the cache.
+        digest: A content hash of the source file.
+        df: A Data Frame returned by read_own_table.
+
+    Returns:A path to the cache entry.
+
+    """
+    numeric_columns = list(df.select_dtypes(include=[np.number]).columns)
+    string_columns = [column for column in df.columns if column not in numeric_columns]
+    tmp_path = os.path.join(cache_dir, '.tmp_' + uuid.uuid4().hex)
+    os.makedirs(tmp_path)
+    try:
+        dtype = np.result_type(*df[numeric_columns].dtypes) if numeric_columns else np.float64
+        np.save(os.path.join(tmp_path, INTENSITIES_FILE),
+                np.ascontiguousarray(df[numeric_columns].values, dtype=dtype))
+        with open(os.path.join(tmp_path, STRINGS_FILE), 'w') as f:
+            json.dump({column: [None if pd.isnull(value) else str(value) for value in df[column]]
+                       for column in string_columns}, f)
+        with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+            json.dump({'columns': list(df.columns),
+                       'numeric_columns': numeric_columns,
+                       'dtypes': [str(df[column].dtype) for column in numeric_columns]}, f)
+        os.rename(tmp_path, entry_path(cache_dir, digest))
+    except OSError:
+        # another request stored the same content first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return entry_path(cache_dir, digest)
+
+
+def load_table(cache_dir, digest):
+    """
+    Rebuilds a parsed table from the cache and marks the entry as recently used.
+    Args:
+        cache_dir: A directory of the cache.
+        digest: A content hash of the source file.
+
+    Returns:A Data Frame or None if the table isn't cached.
+
+    """
+    path = entry_path(cache_dir, digest)
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        with open(os.path.join(path, STRINGS_FILE)) as f:
+            strings = json.load(f)
+        intensities = np.load(os.path.join(path, INTENSITIES_FILE))
+    except (OSError, ValueError):
+        return None
+    os.utime(path, None)
+    df = pd.DataFrame(intensities, columns=meta['numeric_columns'])
+    for column, dtype in zip(meta['numeric_columns'], meta['dtypes']):
+        if dtype != str(intensities.dtype):
+            df[column] = df[column].astype(dtype)
+    for column, values in strings.items():
+        df[column] = pd.Series([np.nan if value is None else value for value in values], dtype=object)
+    return df[meta['columns']]
+
+
+def evict(cache_dir, max_bytes):
+    """
+    Removes the least recently used entries until the cache fits into max_bytes.
+    Args:
+        cache_dir: A directory of the cache.
+        max_bytes: A size cap of the cache.
+
+    """
+    # plain files (e.g. compiled marker panels) are not table entries
+    used = []
+    for name in os.listdir(cache_dir):
+        path = entry_path(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        try:
+            used.append((os.path.getmtime(path), path))
+        except OSError:
+            continue
+    entries = [path for mtime, path in sorted(used)]
+    sizes = [entry_size(path) for path in entries]
+    total = sum(sizes)
+    for path, size in zip(entries, sizes):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def add_table(cache_dir, max_bytes, digest, df):
+    """
+    Caches a table which was parsed elsewhere, e.g. while it was being uploaded.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    if not os.path.isdir(entry_path(cache_dir, digest)):
+        store_table(cache_dir, digest, df)
+        evict(cache_dir, max_bytes)
+
+
+def read_cached_table(filepath, cache_dir, max_bytes, chunksize=None, dtype=None):
+    """
+    A drop-in replacement of read_own_table which parses every distinct file content only once.
+    Args:
+        filepath: A path to the uploaded file.
+        cache_dir: A directory of the cache, created if missing.
+        max_bytes: A size cap of the cache.
+        chunksize: If set, the file is parsed by read_own_table_chunked.
+        dtype: A dtype of the LFQ matrix for the chunked reader.
+
+    Returns:A Data Frame with LFQ, Gene names, Protein IDs and Protein names columns.
+
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # the same bytes parse differently as .txt and .csv
+    salt = get_separator(filepath) + ('' if chunksize is None else str(np.dtype(dtype or np.float32)))
+    digest = file_digest(filepath, salt=salt)
+    df = load_table(cache_dir, digest)
+    if df is None:
+        df = read_own_table(filepath, chunksize=chunksize, dtype=dtype)
+        add_table(cache_dir, max_bytes, digest, df)
+    return df
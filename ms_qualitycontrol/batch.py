@@ -0,0 +1,204 @@
+import fnmatch
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import ms_qualitycontrol.analysis.cohort as cohort
+import ms_qualitycontrol.analysis.functions as fn
+import ms_qualitycontrol.analysis.markers as markers
+import ms_qualitycontrol.analysis.permutation as perm
+import ms_qualitycontrol.analysis.table_cache as tc
+from ms_qualitycontrol.analysis.pipeline import Pipeline, PANELS
+
+#########################
+# Headless batch QC / CLI
+#########################
+
+# The QC of the web interface without Dash: every file of a directory is read, filtered to proteins with at least
+# 50% valid values, tested (control vs samples, with the permutation FDR) and scored with the platelet, erythrocyte
+# and coagulation contamination ratios. Files run in parallel worker processes; every file gets its own table of
+# per-sample ratios and flags, and one summary table lists all files. Result files are written under a temporary
+# name first, so after a crash or a failed file a resumed run only repeats the files without a result.
+# The ratios of every study can be added to a cohort file, and every study can be scored against the baseline of
+# a cohort built before (see analysis/cohort.py).
+
+RESULT_SUFFIX = '.qc.csv'
+SUMMARY_FILE = 'summary.csv'
+SUMMARY_COLUMNS = ['file', 'status', 'proteins', 'filtered_proteins', 'significant', 'platelets_flagged',
+                   'erythrocytes_flagged', 'coagulation_flagged', 'error']
+
+
+def find_tables(input_dir, pattern='*'):
+    """
+    Returns:Sorted paths of the .txt/.csv protein tables (possibly compressed) of a directory.
+    """
+    paths = []
+    for name in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, name)
+        if name.startswith('.') or not os.path.isfile(path) or not fnmatch.fnmatch(name, pattern):
+            continue
+        try:
+            fn.get_separator(path)
+        except ValueError:
+            continue
+        paths.append(path)
+    return paths
+
+
+def result_path(output_dir, filepath):
+    return os.path.join(output_dir, os.path.basename(filepath) + RESULT_SUFFIX)
+
+
+def qc_table(df, control_input, sample_input=None, paired=False, num_std=3, options=None):
+    """
+    Runs the QC of one parsed table.
+    Args:
+        df: A Data Frame returned by read_own_table.
+        control_input: An identifier of the control group columns, e.g. 'TP1'.
+        sample_input: An identifier of the samples group columns, every other column if empty.
+        paired: Tests subjects against themselves if the LFQ headers have a subject/timepoint design.
+        num_std: Number of standard deviations above the harmonic mean at which a sample is flagged.
+        options: A dict with the statistics and FDR settings of run.py ('stats_equal_var', 'stats_dtype',
+            'fdr_level', 'fdr_permutations', 'fdr_s0', 'fdr_seed') and optionally a cohort as 'baseline'.
+
+    Returns:The per-sample table of ratios, thresholds and flags and the summary row of the table, which also
+    has the 'ratios' of every panel.
+
+    """
+    options = options or {}
+    pipeline = Pipeline(data=df, control=control_input, samples=sample_input, paired=paired, num_std=num_std,
+                        equal_var=options.get('stats_equal_var', True), dtype=options.get('stats_dtype', 'float64'),
+                        fdr_permutations=options.get('fdr_permutations', perm.N_PERMUTATIONS),
+                        fdr_s0=options.get('fdr_s0'), fdr_seed=options.get('fdr_seed', 0), fdr_processes=1)
+    statistics = pipeline.statistics()
+    report = None
+    summary = {'proteins': int(df['Gene names'].notnull().sum()), 'filtered_proteins': len(statistics),
+               'significant': int(np.sum(statistics['q_val'] <= options.get('fdr_level', 0.05))), 'ratios': {}}
+    # contamination ratios of the marker panels
+    for name, genes, reverse in PANELS:
+        flags = pipeline.flags(name)
+        report = flags[['Sample']].copy() if report is None else report
+        for column in ['ratio', 'threshold', 'flagged']:
+            report['{} {}'.format(name, column)] = flags[column].values
+        summary['{}_flagged'.format(name.lower())] = ';'.join(flags['Sample'][flags['flagged']])
+        summary['ratios'][name] = flags['ratio'].tolist()
+        if options.get('baseline') is not None:
+            scores = cohort.score(options['baseline'], name, flags['ratio'].values, num_std)
+            for column in ['threshold', 'percentile', 'flagged']:
+                report['{} cohort {}'.format(name, column)] = scores[column]
+    return report, summary
+
+
+def read_ratios(output_dir, filepath):
+    """
+    Returns:The ratios of every panel from the result table of a previous run, as in the 'ratios' of qc_table.
+    """
+    report = pd.read_csv(result_path(output_dir, filepath))
+    return {name: report['{} ratio'.format(name)].tolist() for name, genes, reverse in PANELS}
+
+
+def write_atomic(df, path):
+    tmp_path = path + '.tmp'
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def qc_file(filepath, output_dir, control_input, sample_input=None, paired=False, num_std=3, options=None):
+    """
+    Runs the QC of one file and writes its result table. Errors are reported in the summary row instead of
+    being raised, so one broken file doesn't stop the batch.
+    Returns:The summary row of the file.
+
+    """
+    row = dict.fromkeys(SUMMARY_COLUMNS, '')
+    row['file'] = os.path.basename(filepath)
+    try:
+        options = options or {}
+        if options.get('cache_path'):
+            df = tc.read_cached_table(filepath, options['cache_path'], options.get('cache_max_bytes', 0))
+        else:
+            df = fn.read_own_table(filepath)
+        report, summary = qc_table(df, control_input, sample_input, paired, num_std, options)
+        write_atomic(report, result_path(output_dir, filepath))
+        row.update(summary, status='ok', error='')
+        if options.get('cohort'):
+            row['digest'] = tc.file_digest(filepath)
+    except Exception as e:
+        row.update(status='failed', error='{}: {}'.format(type(e).__name__, e))
+        traceback.print_exc()
+    return row
+
+
+def init_worker(marker_sources):
+    # the marker registry of the parent is not inherited by spawned workers
+    for path, cache_dir in marker_sources:
+        if os.path.isdir(path):
+            markers.register_directory(path, cache_dir)
+        else:
+            markers.register_file(path, cache_dir)
+
+
+def run_batch(input_dir, output_dir, control_input, sample_input=None, paired=False, num_std=3, processes=None,
+              resume=False, pattern='*', marker_sources=(), options=None, cohort_file=None, baseline_file=None):
+    """
+    Runs the QC of every protein table of a directory.
+    Args:
+        input_dir: A directory with the protein tables (e.g. proteinGroups files).
+        output_dir: A directory for the result tables and the summary table, created if missing.
+        control_input: An identifier of the control group columns.
+        sample_input: An identifier of the samples group columns, every other column if empty.
+        paired: Uses a paired design where the LFQ headers have one.
+        num_std: Number of standard deviations of the flag thresholds.
+        processes: Number of worker processes, None uses all CPUs.
+        resume: Skips files which already have a result table from a previous run. Their ratios are read back from
+            the result table if the cohort doesn't have them yet.
+        pattern: A file name pattern, e.g. '*proteinGroups*'.
+        marker_sources: (path, cache directory) pairs of the marker panel files or directories.
+        options: Statistics, FDR and cache settings, see qc_table.
+        cohort_file: A cohort file to which the ratios of every study are added, created if missing.
+        baseline_file: A cohort file to score the samples of every study against.
+
+    Returns:The summary Data Frame, also written to output_dir.
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    options = dict(options or {}, cohort=cohort_file is not None)
+    if baseline_file is not None:
+        options['baseline'] = cohort.load_cohort(baseline_file)
+    studies = cohort.load_cohort(cohort_file) if cohort_file is not None else None
+    summary_file = os.path.join(output_dir, SUMMARY_FILE)
+    previous = {}
+    if resume and os.path.exists(summary_file):
+        previous = {row['file']: row for row in pd.read_csv(summary_file, keep_default_na=False)
+                    .to_dict(orient='records')}
+    paths = find_tables(input_dir, pattern)
+    rows, pending = {}, []
+    for path in paths:
+        name = os.path.basename(path)
+        if resume and os.path.exists(result_path(output_dir, path)) and previous.get(name, {}).get('status') == 'ok':
+            rows[name] = previous[name]
+            if studies is not None:
+                # a previous run may have been started without the cohort or stopped before saving it
+                digest = tc.file_digest(path)
+                if digest not in studies['studies'] and cohort.add_study(studies, digest,
+                                                                         read_ratios(output_dir, path)):
+                    cohort.save_cohort(studies, cohort_file)
+        else:
+            pending.append(path)
+    with ProcessPoolExecutor(processes or os.cpu_count() or 1, initializer=init_worker,
+                             initargs=(list(marker_sources),)) as executor:
+        futures = [executor.submit(qc_file, path, output_dir, control_input, sample_input, paired, num_std, options)
+                   for path in pending]
+        for done, future in enumerate(as_completed(futures), 1):
+            row = future.result()
+            rows[row['file']] = row
+            if studies is not None and row['status'] == 'ok' and cohort.add_study(studies, row['digest'],
+                                                                                  row['ratios']):
+                cohort.save_cohort(studies, cohort_file)
+            print('[{}/{}] {} {}'.format(done, len(pending), row['file'], row['status']), flush=True)
+    summary = pd.DataFrame([rows[os.path.basename(path)] for path in paths], columns=SUMMARY_COLUMNS)
+    write_atomic(summary, summary_file)
+    return summary
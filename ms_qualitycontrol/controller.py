@@ -1,28 +1,96 @@
-import itertools
-import math
+import collections
+import functools
+import hashlib
+import io
+import os
+import re
 import urllib
 
+import flask
+from werkzeug.utils import secure_filename
+
 import dash_core_components as dcc
 import dash_html_components as html
+import numpy as np
 import pandas as pd
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 
+import ms_qualitycontrol.analysis.clustering as clus
+import ms_qualitycontrol.analysis.correlation as corr
 import ms_qualitycontrol.analysis.functions as fn
+import ms_qualitycontrol.analysis.markers as markers
 import ms_qualitycontrol.analysis.plotting_functions as plot
-from run import dir_path, platelet_contamination_markers, erythrocyte_contamination_markers, \
-    coagulation_contamination_markers, example_file, warning_encoded
+import ms_qualitycontrol.analysis.outofcore as ooc
+import ms_qualitycontrol.analysis.permutation as perm
+import ms_qualitycontrol.analysis.stats_engine as se
+import ms_qualitycontrol.analysis.table_cache as tc
+import ms_qualitycontrol.datastore as store
+import ms_qualitycontrol.jobs as jobs
+import ms_qualitycontrol.upload as upload
+from run import cache_path, cache_max_bytes, stream_min_bytes, stream_chunksize, stream_dtype, \
+    marker_file, panels_path, example_file, warning_encoded, store_path, store_max_bytes, store_max_disk_bytes, \
+    stats_equal_var, stats_dtype, contrast_processes, fdr_level, fdr_permutations, fdr_s0, fdr_seed, fdr_processes, \
+    heatmap_method, heatmap_dtype, heatmap_threads, heatmap_max_cells, volcano_webgl, volcano_max_points, \
+    memory_budget_bytes, heatmap_cluster_exact_max, heatmap_cluster_dims, heatmap_preclusters, job_processes
 from .app import app
 
+store.configure(store_path, store_max_bytes, max_disk_bytes=store_max_disk_bytes)
+# everything a job stores is written through to store_path, where the server process picks it up, and dropped from
+# the memory of the worker after the job
+jobs.configure(os.path.join(store_path, 'jobs'), job_processes,
+               functools.partial(store.configure, store_path, store_max_bytes, True, store_max_disk_bytes),
+               store.clear)
+markers.register_file(marker_file, cache_path)
+markers.register_directory(panels_path, cache_path)
+
 
 #############################################
 # Interaction Between Components / Controller
 #############################################
 
+def streamed(filepath):
+    # the size of a compressed file says little about the size of the table, those are always parsed in chunks
+    return fn.detect_compression(filepath) is not None or os.path.getsize(filepath) > stream_min_bytes
+
+
+def read_table(filepath):
+    if streamed(filepath):
+        return tc.read_cached_table(filepath, cache_path, cache_max_bytes, chunksize=stream_chunksize,
+                                    dtype=stream_dtype)
+    return tc.read_cached_table(filepath, cache_path, cache_max_bytes)
+
+
+def store_table(filepath):
+    """
+    Parses and stores a table. Studies estimated above memory_budget_bytes are never loaded into memory, their LFQ
+    columns are written straight into a memory-mapped matrix stored under matrix_key, like those of out-of-core
+    cleaned datasets.
+    Returns:The key of the dataset.
+
+    """
+    if streamed(filepath):
+        rows, columns_lfq = fn.table_shape(filepath)
+        if ooc.exceeds_budget(rows, len(columns_lfq), memory_budget_bytes):
+            dataset_key = store.new_key()
+            path = matrix_path(matrix_key(dataset_key))
+            df, report = fn.read_own_table_chunked(filepath, stream_chunksize, stream_dtype, lfq_path=path,
+                                                   expected_rows=rows)
+            store.put(pd.DataFrame(np.load(path, mmap_mode='r'), columns=columns_lfq, copy=False),
+                      matrix_key(dataset_key))
+            return store.put(df, dataset_key)
+    return store.put(read_table(filepath))
+
+
+# large and compressed uploads are parsed and stored like local files once they are complete, small ones are parsed
+# while they are received
+upload.configure(store_table, stream_min_bytes)
+
 @app.callback(
     Output('only-graphs', 'style'),
     [Input('intermediate-value', 'children')])
-def update_layout(jsonified_df):
-    if jsonified_df is not None:
+def update_layout(dataset_key):
+    if dataset_key is not None:
         return {'padding': '10px 10px 3050px 10px', 'display': '',
                 'marginLeft': 'auto', 'marginRight': 'auto', 'marginTop': '20px', "width": "1300px",
                 'boxShadow': '0px 0px 5px 5px', 'background-color': '#EFEFEF'}
@@ -34,12 +102,11 @@ def update_layout(jsonified_df):
      Input('button-example', 'n_clicks')])
 def upload_files(fileNames, example):
     if example is not None:
-        df = fn.read_own_table(example_file)
-        return df.to_json(date_format='iso', orient='split')
-    elif fileNames is not None:
-        df = fn.read_own_table(dir_path + '/' + fileNames[-1])
-        fn.delete_uploaded_file(dir_path, fileNames[-1])
-        return df.to_json(date_format='iso', orient='split')
+        return store_table(example_file)
+    elif fileNames:
+        table = upload.get_table(fileNames[-1])
+        # large uploads come back as the key of the stored dataset
+        return table if isinstance(table, str) else store.put(table)
 
 
 @app.callback(
@@ -48,9 +115,9 @@ def upload_files(fileNames, example):
      Input('input-control', 'value'),
      Input('button-example', 'n_clicks'),
      Input('button', 'n_clicks')])
-def check_input_control(jsonified_df, control_input, example, submit):
-    if all([jsonified_df, submit]) and example is None:
-        df = pd.read_json(jsonified_df, orient='split')
+def check_input_control(dataset_key, control_input, example, submit):
+    if all([dataset_key, submit]) and example is None:
+        df = dataset_header(dataset_key)
         columns_control_group = fn.get_list_of_col(df, fn.lower_input(control_input))
         if not control_input:
             return html.Div([
@@ -70,9 +137,9 @@ def check_input_control(jsonified_df, control_input, example, submit):
      Input('input-samples', 'value'),
      Input('button-example', 'n_clicks'),
      Input('button', 'n_clicks')])
-def check_input_control(jsonified_df, sample_input, example, submit):
-    if all([jsonified_df, sample_input, submit]) and example is None:
-        df = pd.read_json(jsonified_df, orient='split')
+def check_input_control(dataset_key, sample_input, example, submit):
+    if all([dataset_key, sample_input, submit]) and example is None:
+        df = dataset_header(dataset_key)
         columns_samples_group = fn.get_list_of_col(df, fn.lower_input(sample_input))
         if not all([columns_samples_group, sample_input]):
             return html.Div([
@@ -81,60 +148,389 @@ def check_input_control(jsonified_df, sample_input, example, submit):
             ], className='warning-samples')
 
 
-# to store a created dataframe based on the uploaded .txt file
+# the analysis of the uploaded table runs as a background job, its result is picked up by collect_analysis
 @app.callback(
-    Output('intermediate-value', 'children'),
+    Output('job-analysis', 'children'),
     [Input('output', 'children'),
      Input('input-control', 'value'),
      Input('input-samples', 'value'),
      Input('button', 'n_clicks'),
      Input('button-example', 'n_clicks'),
      Input('output-control', 'children'),
-     Input('output-samples', 'children')])
-def clean_data(jsonified_df, control_input, sample_input, submit, example, warning_control, warning_samples):
-    control, samples, df = None, None, None
+     Input('output-samples', 'children'),
+     Input('radio-design', 'value')],
+    [State('job-analysis', 'children')])
+def clean_data(dataset_key, control_input, sample_input, submit, example, warning_control, warning_samples,
+               design_mode, previous_job):
+    columns_control_group, columns_samples_group, df = None, None, None
     if example:
-        df = pd.read_json(jsonified_df, orient='split')
+        df = dataset_header(dataset_key)
         columns_control_group = fn.get_list_of_col(df, fn.lower_input('TP1'))
-        control = df[columns_control_group].apply(pd.to_numeric)
         columns_samples_group = fn.get_list_of_col(df, fn.lower_input('TP4'))
-        samples = df[columns_samples_group].apply(pd.to_numeric)
-    elif all([jsonified_df, control_input, submit]) and not all([warning_control, warning_samples]):
-        df = pd.read_json(jsonified_df, orient='split')
+    elif all([dataset_key, control_input, submit]) and not all([warning_control, warning_samples]):
+        df = dataset_header(dataset_key)
         columns_control_group = fn.get_list_of_col(df, fn.lower_input(control_input))
-        control = df[columns_control_group].apply(pd.to_numeric)
         if not sample_input:
-            columns_control_group.extend(['Gene names', 'Protein IDs', 'Protein names'])
-            samples = df.drop(columns=columns_control_group)
+            excluded = columns_control_group + ['Gene names', 'Protein IDs', 'Protein names']
+            columns_samples_group = [column for column in df.columns if column not in excluded]
         else:
             columns_samples_group = fn.get_list_of_col(df, fn.lower_input(sample_input))
-            samples = df[columns_samples_group].apply(pd.to_numeric)
+    columns_lfq = fn.get_list_of_col(df, fn.lower_input('LFQ'))
+    design = paired_design(columns_lfq) if design_mode == 'paired' else None
+    # a new analysis replaces the one still running
+    if previous_job is not None:
+        jobs.cancel(previous_job)
+    if jobs.processes:
+        persist_dataset(dataset_key)
+    return jobs.submit(analyse_dataset, dataset_key, columns_lfq, columns_control_group, columns_samples_group,
+                       design)
+
+
+def analyse_dataset(dataset_key, columns_lfq, columns_control_group, columns_samples_group, design=None):
+    """
+    The statistics and the permutation FDR of the proteins with at least 50% valid values, run as a background job.
+    Returns:The key of the cleaned dataset.
+
+    """
+    df = store.get(dataset_key)
+    lfq = out_of_core_matrix(dataset_key)
+    if lfq is not None or ooc.exceeds_budget(len(df), len(columns_lfq), memory_budget_bytes):
+        return clean_data_out_of_core(df, lfq, columns_lfq, columns_control_group, columns_samples_group, design)
+    jobs.progress(0.05, 'Statistics')
+    df = df.copy(deep=False)
     # statistical analysis
-    df['p_val'], df['(-)log10_p_val'] = fn.two_sample_t_test(control, samples)
-    df['control_mean'], df['samples_mean'] = fn.calculate_mean(control, samples)
-    df['L10FC'] = fn.calculate_LFC(df)
+    if design is not None:
+        statistics = se.paired_group_statistics(df[columns_lfq].apply(pd.to_numeric).values, design,
+                                                group_positions(columns_lfq, columns_control_group),
+                                                group_positions(columns_lfq, columns_samples_group), dtype=stats_dtype)
+    else:
+        control = df[columns_control_group].apply(pd.to_numeric)
+        samples = df[columns_samples_group].apply(pd.to_numeric)
+        statistics = se.differential_statistics(control, samples, equal_var=stats_equal_var, dtype=stats_dtype)
+    for column, values in statistics.items():
+        df[column] = values
     df = df.dropna(subset=['Gene names'])
     df_filtered = fn.filter_valid_values(df, index=fn.get_reversed_list_of_col(df, fn.lower_input('LFQ')),
                                      numeric_columns=fn.get_list_of_col(df, fn.lower_input('LFQ')), percent=0.5, ax=0)
-    return df_filtered.to_json(date_format='iso', orient='split')
+    jobs.progress(0.3, 'Permutation FDR')
+    fdr = permutation_fdr(df_filtered[columns_lfq].values, columns_lfq, columns_control_group, columns_samples_group,
+                          design, 'Permutation FDR')
+    df_filtered.insert(df_filtered.columns.get_loc('L10FC') + 1, 'q_val', fdr['q_val'])
+    jobs.progress(0.95, 'Storing the results')
+    return store.put(df_filtered)
+
+
+def group_positions(columns_lfq, columns_group):
+    return [columns_lfq.index(column) for column in columns_group if column in columns_lfq]
+
+
+def paired_design(columns_lfq):
+    """
+    Returns:The subject/timepoint design parsed from the LFQ headers, or None if no subject has two samples.
+    """
+    design = se.parse_design(columns_lfq)
+    return design if se.is_paired(design) else None
+
+
+def fdr_pool_size():
+    # the job workers share the CPUs instead of starting a pool of all CPUs each
+    if fdr_processes is None and jobs.in_job():
+        return max(1, (os.cpu_count() or 1) // max(job_processes, 1))
+    return fdr_processes
+
+
+def permutation_fdr(matrix, columns_lfq, columns_control_group, columns_samples_group, design=None, message=''):
+    """
+    q-values of the proteins which passed the valid values filter, the job progress goes from 0.3 to 0.95.
+    """
+    control_cols = group_positions(columns_lfq, columns_control_group)
+    samples_cols = group_positions(columns_lfq, columns_samples_group)
+    options = {'n_permutations': fdr_permutations, 's0': fdr_s0, 'seed': fdr_seed, 'processes': fdr_pool_size(),
+               'progress': lambda fraction: jobs.progress(0.3 + 0.65 * fraction, message)}
+    if design is not None:
+        differences = ooc.pair_differences(perm.open_matrix(matrix), design, control_cols, samples_cols)
+        return perm.permutation_fdr(differences, [], [], paired=True, **options)
+    return perm.permutation_fdr(matrix, control_cols, samples_cols, **options)
+
+
+def matrix_key(dataset_key):
+    return dataset_key + '-lfq'
+
+
+def matrix_path(key):
+    return os.path.join(store_path, key + '.npy')
+
+
+def out_of_core_matrix(dataset_key):
+    """
+    Returns the memory-mapped LFQ columns of a dataset or None if it is kept in memory.
+    """
+    if store.contains(matrix_key(dataset_key)):
+        return store.get(matrix_key(dataset_key))
+
+
+def dataset_header(dataset_key):
+    """
+    Returns:An empty Data Frame with the columns of a dataset, including the LFQ columns of out-of-core datasets.
+    """
+    columns = list(store.get(dataset_key).columns)
+    lfq = out_of_core_matrix(dataset_key)
+    return pd.DataFrame(columns=columns + ([] if lfq is None else list(lfq.columns)))
+
+
+def persist_dataset(dataset_key):
+    # worker processes read the dataset and its memory-mapped LFQ columns by their keys
+    store.persist(dataset_key)
+    if out_of_core_matrix(dataset_key) is not None:
+        store.persist(matrix_key(dataset_key))
+
+
+def clean_data_out_of_core(df, lfq, columns_lfq, columns_control_group, columns_samples_group, design=None):
+    """
+    Same as clean_data for studies above memory_budget_bytes. The LFQ columns are moved into a memory-mapped
+    matrix (unless they were stored as one, lfq) and the statistics are computed block by block. The cleaned dataset
+    is stored without LFQ columns, they are stored separately under matrix_key.
+    """
+    jobs.progress(0.05, 'Statistics (out of core)')
+    dataset_key = store.new_key()
+    try:
+        rows = np.flatnonzero(df['Gene names'].notnull().values)
+        if lfq is None:
+            matrix = ooc.to_memmap(df, columns_lfq, matrix_path(dataset_key + '-unfiltered'), rows=rows)
+        else:
+            matrix = ooc.to_memmap(lfq.values, [list(lfq.columns).index(column) for column in columns_lfq],
+                                   matrix_path(dataset_key + '-unfiltered'), rows=rows)
+        control_cols = group_positions(columns_lfq, columns_control_group)
+        samples_cols = group_positions(columns_lfq, columns_samples_group)
+        df_filtered = df.iloc[rows][fn.get_reversed_list_of_col(df, fn.lower_input('LFQ'))].copy()
+        # statistical analysis
+        if design is not None:
+            statistics = ooc.paired_group_statistics(matrix, design, control_cols, samples_cols, dtype=stats_dtype)
+        else:
+            statistics = ooc.differential_statistics(matrix, control_cols, samples_cols, equal_var=stats_equal_var,
+                                                     dtype=stats_dtype)
+        for column, values in statistics.items():
+            df_filtered[column] = values
+        valid = ooc.filter_valid_values(matrix, percent=0.5)
+        df_filtered = df_filtered[valid].reset_index(drop=True)
+        matrix_filtered = ooc.to_memmap(matrix, None, matrix_path(matrix_key(dataset_key)),
+                                        rows=np.flatnonzero(valid))
+        del matrix
+        os.remove(matrix_path(dataset_key + '-unfiltered'))
+        jobs.progress(0.3, 'Permutation FDR (out of core)')
+        fdr = permutation_fdr(matrix_path(matrix_key(dataset_key)), columns_lfq, columns_control_group,
+                              columns_samples_group, design, 'Permutation FDR (out of core)')
+        df_filtered.insert(df_filtered.columns.get_loc('L10FC') + 1, 'q_val', fdr['q_val'])
+        jobs.progress(0.95, 'Storing the results')
+        store.put(pd.DataFrame(matrix_filtered, columns=columns_lfq, copy=False), matrix_key(dataset_key))
+        return store.put(df_filtered, dataset_key)
+    except BaseException:
+        # a failed or cancelled analysis leaves no matrices behind
+        store.delete(dataset_key)
+        raise
+
+
+@app.callback(
+    Output('job-heatmap', 'children'),
+    [Input('intermediate-value', 'children')],
+    [State('job-heatmap', 'children')])
+def prepare_data_heatmap(dataset_key, previous_job):
+    if dataset_key is None:
+        raise PreventUpdate()
+    if previous_job is not None:
+        jobs.cancel(previous_job)
+    if jobs.processes:
+        persist_dataset(dataset_key)
+    return jobs.submit(build_heatmap, dataset_key)
+
+
+def correlation_dataset(dataset_key):
+    """
+    Returns:The key of the protein x protein correlation of a cleaned dataset.
+    """
+    df = store.get(dataset_key)
+    lfq = out_of_core_matrix(dataset_key)
+    if lfq is not None:
+        key = store.new_key()
+        data = ooc.log_correlation(lfq.values, matrix_path(key), method=heatmap_method, dtype=heatmap_dtype,
+                                   threads=heatmap_threads)
+        return store.put(pd.DataFrame(data, index=df['Gene names'], columns=df['Gene names'], copy=False), key)
+    data = corr.correlation(df[fn.get_list_of_col(df, fn.lower_input('LFQ'))].values, method=heatmap_method,
+                            dtype=heatmap_dtype, threads=heatmap_threads, transform=corr.log_transform)
+    return store.put(pd.DataFrame(data, index=df['Gene names'], columns=df['Gene names'], copy=False))
+
+
+def build_heatmap(dataset_key):
+    """
+    The correlation map of a cleaned dataset with its clustering and static figure, run as a background job.
+    Returns:The key of the correlation matrix.
+
+    """
+    jobs.progress(0.05, 'Correlation')
+    key = correlation_dataset(dataset_key)
+    try:
+        jobs.progress(0.4, 'Clustering')
+        heatmap_clustering(key)
+        jobs.progress(0.8, 'Figure')
+        heatmap_figure(key)
+    except BaseException:
+        store.delete(key)
+        raise
+    return key
+
+
+def job_status(job_id):
+    """
+    Returns:The status of a job (see jobs.status), None without a job or for a job of a former server process.
+    """
+    if job_id is None:
+        return None
+    try:
+        return jobs.status(job_id)
+    except KeyError:
+        return None
+
+
+def job_result(job_id, current_key):
+    """
+    The result of a finished job for the hidden Div holding the key, nothing while it runs or once it was picked up.
+    """
+    status = job_status(job_id)
+    if status is None or status['state'] != jobs.DONE:
+        raise PreventUpdate()
+    key = jobs.result(job_id)
+    if key == current_key:
+        raise PreventUpdate()
+    # the replaced result is unreachable, its memory-mapped matrices are deleted with it
+    if current_key is not None:
+        store.delete(current_key)
+    return key
+
+
+@app.callback(
+    Output('intermediate-value', 'children'),
+    [Input('job-analysis', 'children'),
+     Input('interval-jobs', 'n_intervals')],
+    [State('intermediate-value', 'children')])
+def collect_analysis(job_id, n_intervals, dataset_key):
+    return job_result(job_id, dataset_key)
 
 
 @app.callback(
     Output('intermediate-value-heatmap', 'children'),
-    [Input('intermediate-value', 'children')])
-def prepare_data_heatmap(jsonified_df):
-    df = pd.read_json(jsonified_df, orient='split')
-    data_filt = df.set_index('Gene names')[fn.get_list_of_col(df, fn.lower_input('LFQ'))]
-    data_filt = data_filt.applymap(lambda x: math.log10(x) if x != 0 else 0)
-    data = data_filt.T.corr(method='pearson')
-    return data.to_json(date_format='iso', orient='split')
+    [Input('job-heatmap', 'children'),
+     Input('interval-jobs', 'n_intervals')],
+    [State('intermediate-value-heatmap', 'children')])
+def collect_heatmap(job_id, n_intervals, dataset_key):
+    return job_result(job_id, dataset_key)
+
+
+@app.callback(
+    Output('interval-jobs', 'disabled'),
+    [Input('job-analysis', 'children'),
+     Input('job-heatmap', 'children'),
+     Input('interval-jobs', 'n_intervals')])
+def toggle_job_polling(analysis_job, heatmap_job, n_intervals):
+    # polling stops once every job has finished and its result was picked up
+    for job_id in [analysis_job, heatmap_job]:
+        status = job_status(job_id)
+        # a job is forgotten once its result was picked up
+        if status is not None and status['state'] in [jobs.PENDING, jobs.RUNNING, jobs.DONE]:
+            return False
+    return True
+
+
+@app.callback(
+    Output('job-progress', 'children'),
+    [Input('interval-jobs', 'n_intervals'),
+     Input('job-analysis', 'children'),
+     Input('job-heatmap', 'children')])
+def show_job_progress(n_intervals, analysis_job, heatmap_job):
+    rows = []
+    for label, job_id in [('Analysis', analysis_job), ('Correlation map', heatmap_job)]:
+        status = job_status(job_id)
+        if status is None or status['state'] == jobs.DONE:
+            continue
+        if status['state'] in [jobs.PENDING, jobs.RUNNING]:
+            rows.append(html.Div([
+                html.Span('{}: {} '.format(label, status['message'] or 'waiting for a worker')),
+                html.Progress(value=int(100 * status['progress']), max=100),
+            ]))
+        elif status['state'] == jobs.CANCELLED:
+            rows.append(html.Div('{}: cancelled'.format(label)))
+        else:
+            rows.append(html.Div('{} failed: {}'.format(label, status['error'])))
+    return rows
+
+
+@app.callback(
+    Output('button-cancel', 'style'),
+    [Input('interval-jobs', 'disabled')])
+def show_cancel_button(polling_disabled):
+    return {'display': 'none'} if polling_disabled else {}
+
+
+@app.callback(
+    Output('job-cancelled', 'children'),
+    [Input('button-cancel', 'n_clicks')],
+    [State('job-analysis', 'children'),
+     State('job-heatmap', 'children')])
+def cancel_jobs(n_clicks, analysis_job, heatmap_job):
+    if not n_clicks:
+        raise PreventUpdate()
+    cancelled = [job_id for job_id in [analysis_job, heatmap_job] if job_status(job_id) is not None]
+    for job_id in cancelled:
+        jobs.cancel(job_id)
+    return ' '.join(cancelled)
+
+
+def panel_rows(dataset_key, markers, column='Gene names'):
+    """
+    Rows of a cleaned dataset which belong to a marker panel. The gene and protein ID index is built once
+    per dataset and shared by all callbacks.
+    """
+    indices = store.derived(dataset_key, 'indices', fn.build_indices)
+    return fn.lookup_rows(indices[column], markers)
+
+
+def panel_ratio(dataset_key, df, rows, reverse=False):
+    """
+    Contamination ratio of every sample for the proteins of one marker panel, in memory or out of core.
+    Returns:Sample names and the ratios.
+
+    """
+    lfq = out_of_core_matrix(dataset_key)
+    if lfq is None:
+        columns_lfq = fn.get_list_of_col(df, fn.lower_input('LFQ'))
+        ratio = fn.contamination_ratio(df[columns_lfq], df[columns_lfq].iloc[rows], reverse=reverse)
+    else:
+        columns_lfq = list(lfq.columns)
+        ratio = ooc.contamination_ratio(lfq.values, rows, reverse=reverse)
+    columns_names = [name.replace('LFQ', '').replace(' intensity', '') for name in columns_lfq]
+    return columns_names, ratio
+
+
+def panel_summary(dataset_key, name, genes, reverse=False):
+    """
+    Contamination ratios of a marker panel and their summary statistics, computed once per dataset and panel,
+    so moving an SD slider only recomputes the threshold and the annotations.
+    Returns:Sample names, the ratios and their summary.
+
+    """
+    def compute(df):
+        columns_names, ratio = panel_ratio(dataset_key, df, panel_rows(dataset_key, genes), reverse=reverse)
+        return columns_names, ratio, fn.ratio_summary(ratio)
+
+    # a stable digest of the genes, so a reloaded panel is computed again and job workers share the key
+    digest = hashlib.sha1(';'.join(genes).encode()).hexdigest()
+    return store.derived(dataset_key, 'ratio-{}-{}-{}'.format(name, digest, reverse), compute)
 
 
 @app.callback(
     Output('before-graphs', 'children'),
     [Input('intermediate-value', 'children')])
-def plot_all_graphs(jsonified_df):
-    if jsonified_df is not None:
+def plot_all_graphs(dataset_key):
+    if dataset_key is not None:
         return html.Div([
             html.H2("Individual sample quality"),
             dcc.Markdown(
@@ -150,8 +546,8 @@ def plot_all_graphs(jsonified_df):
 @app.callback(
     Output('barchart-platelets-common', 'children'),
     [Input('intermediate-value', 'children')])
-def plot_barchart_plat(jsonified_df):
-    if jsonified_df is not None:
+def plot_barchart_plat(dataset_key):
+    if dataset_key is not None:
         return html.Div([
             html.H3("Platelets"),
             dcc.Markdown(
@@ -187,16 +583,11 @@ def plot_barchart_plat(jsonified_df):
     [Input('intermediate-value', 'children'),
      Input('radio-button-platelets', 'value'),
      Input('slider-platelets', 'value')])
-def update_barchart_plat(jsonified_df, radio_button_value, slider_plat):
-    df = pd.read_json(jsonified_df, orient='split')
-    df_platelet = fn.get_list_of_indices(df, 'Gene names',
-                                         fn.extract_val_from_col(platelet_contamination_markers, 'Gene names', ';'),
-                                         ';')
-    platelet_calc = df_platelet[fn.get_list_of_col(df, fn.lower_input('LFQ'))]
-    columns_names = [name.replace('LFQ', '').replace(' intensity', '') for name in platelet_calc.columns]
+def update_barchart_plat(dataset_key, radio_button_value, slider_plat):
     if radio_button_value == 'rat':
-        platelet_calc_ratio, threshold_pl_std = \
-            fn.normal_ratio(df[fn.get_list_of_col(df, fn.lower_input('LFQ'))], platelet_calc, slider_plat)
+        columns_names, platelet_calc_ratio, summary = panel_summary(dataset_key, 'Platelets',
+                                                                    markers.get_panel('Platelets')['genes'])
+        threshold_pl_std = fn.ratio_threshold(summary, slider_plat)
         annotat = fn.create_annotations(platelet_calc_ratio, threshold_pl_std, columns_names)
         return {
             'data': plot.getBarChart(
@@ -215,8 +606,8 @@ def update_barchart_plat(jsonified_df, radio_button_value, slider_plat):
 @app.callback(
     Output('barchart-erythro-common', 'children'),
     [Input('intermediate-value', 'children')])
-def plot_barchart_erythro(jsonified_df):
-    if jsonified_df is not None:
+def plot_barchart_erythro(dataset_key):
+    if dataset_key is not None:
         return html.Div([
             html.H3("Erythrocytes"),
             dcc.Markdown(
@@ -251,16 +642,11 @@ def plot_barchart_erythro(jsonified_df):
     [Input('intermediate-value', 'children'),
      Input('radio-button-erythrocytes', 'value'),
      Input('slider-erythro', 'value')])
-def update_barchart_erythro(jsonified_df, radio_button_value, slider_erythro):
-    df = pd.read_json(jsonified_df, orient='split')
-    df_erythrocyte = fn.get_list_of_indices(df, 'Gene names',
-                                            fn.extract_val_from_col(erythrocyte_contamination_markers, 'Gene names',
-                                                                    ';'), ';')
-    erythrocyte_calc = df_erythrocyte[fn.get_list_of_col(df, fn.lower_input('LFQ'))]
-    columns_names = [name.replace('LFQ', '').replace(' intensity', '') for name in erythrocyte_calc.columns]
+def update_barchart_erythro(dataset_key, radio_button_value, slider_erythro):
     if radio_button_value == 'rat':
-        erythrocyte_calc_ratio, threshold_er_std = \
-            fn.normal_ratio(df[fn.get_list_of_col(df, fn.lower_input('LFQ'))], erythrocyte_calc, slider_erythro)
+        columns_names, erythrocyte_calc_ratio, summary = panel_summary(dataset_key, 'Erythrocytes',
+                                                                       markers.get_panel('Erythrocytes')['genes'])
+        threshold_er_std = fn.ratio_threshold(summary, slider_erythro)
         annotat = fn.create_annotations(erythrocyte_calc_ratio, threshold_er_std, columns_names)
         return {
             'data': plot.getBarChart(
@@ -282,7 +668,7 @@ def update_barchart_erythro(jsonified_df, radio_button_value, slider_erythro):
      Input('button', 'n_clicks'),
      Input('upload-data', 'fileNames'),
      Input('button-example', 'n_clicks')])
-def plot_barchart_coag(jsonified_df, submit, file_name, example):
+def plot_barchart_coag(dataset_key, submit, file_name, example):
     if example:
         return html.Div([
             html.H3("Coagulation"),
@@ -311,9 +697,10 @@ def plot_barchart_coag(jsonified_df, submit, file_name, example):
             dcc.Graph(
                 id='barchart-coagulation',
             ),
+        ] + contrasts_controls() + [
             html.Hr(),
         ])
-    elif all([jsonified_df, submit]):
+    elif all([dataset_key, submit]):
         return html.Div([
             html.H3("Coagulation"),
             dcc.Markdown(
@@ -341,32 +728,59 @@ def plot_barchart_coag(jsonified_df, submit, file_name, example):
             dcc.Graph(
                 id='barchart-coagulation',
             ),
+            dcc.RadioItems(
+                id='radio-report-format',
+                options=[{'label': label, 'value': value} for label, value in
+                         [('CSV', 'csv'), ('Parquet', 'parquet'), ('Excel', 'xlsx')]],
+                value='csv',
+                labelStyle={'display': 'inline-block'},
+            ),
+            # the report is generated on the server when the link is followed
             html.A(
                 'Download Calculated Data',
                 id='download-link',
-                download='%s_changed.csv' % file_name[0].split('.')[0],
+                download='',
                 target="_blank",
                 className='download-button'
             ),
+        ] + contrasts_controls() + [
             html.Hr(),
         ])
 
+
+def coagulation_genes():
+    # the coagulation ratio only uses the fibrinogen chains of the panel
+    return [x for x in markers.get_panel('Coagulation')['genes'] if x in ['FGG', 'FGB', 'FGA']]
+
+
+def contrasts_controls():
+    # the coagulation panel is rendered again for every dataset, so it has to keep the contrasts controls
+    return [
+        dcc.Input(
+            id='input-contrasts',
+            placeholder='Contrasts, e.g. "TP4 vs TP1, TP7 vs TP1" (every timepoint vs control if empty)',
+            type='text',
+            value='',
+        ),
+        html.A(
+            'Download All Contrasts',
+            id='download-contrasts',
+            download="contrasts.csv",
+            target="_blank",
+            className='download-button'
+        ),
+    ]
+
 @app.callback(
     Output('barchart-coagulation', 'figure'),
     [Input('intermediate-value', 'children'),
      Input('radio-button-coagulation', 'value'),
      Input('slider-coag', 'value')])
-def update_barchart_coag(jsonified_df, radio_button_value, slider_coag):
-    df = pd.read_json(jsonified_df, orient='split')
-    df_coagulation = fn.get_list_of_indices(df, 'Gene names',
-                                            [x for x in coagulation_contamination_markers['Gene names'] if
-                                             x in ['FGG', 'FGB', 'FGA']], ';')
-    coagulation_calc = df_coagulation[fn.get_list_of_col(df, fn.lower_input('LFQ'))]
-    columns_names = [name.replace('LFQ', '').replace(' intensity', '') for name in coagulation_calc.columns]
+def update_barchart_coag(dataset_key, radio_button_value, slider_coag):
     if radio_button_value == 'rat':
-        coagulation_calc_ratio, threshold_coag_std = \
-            fn.normal_ratio(df[fn.get_list_of_col(df, fn.lower_input('LFQ'))], coagulation_calc, slider_coag,
-                            reverse=True)
+        columns_names, coagulation_calc_ratio, summary = panel_summary(dataset_key, 'Coagulation', coagulation_genes(),
+                                                                          reverse=True)
+        threshold_coag_std = fn.ratio_threshold(summary, slider_coag)
         annotat = fn.create_annotations(coagulation_calc_ratio, threshold_coag_std, columns_names)
         return {
             'data': plot.getBarChart(
@@ -385,41 +799,36 @@ def update_barchart_coag(jsonified_df, radio_button_value, slider_coag):
 @app.callback(
     Output('common-volcano', 'children'),
     [Input('intermediate-value', 'children')])
-def plot_volcano(jsonified_df):
-    if jsonified_df is not None:
-        df = pd.read_json(jsonified_df, orient='split').round(4)
-        df_platelet = fn.get_list_of_indices(df, 'Gene names',
-                                             fn.extract_val_from_col(platelet_contamination_markers, 'Gene names', ';'),
-                                             ';')
-        df_erythrocyte = fn.get_list_of_indices(df, 'Gene names',
-                                                fn.extract_val_from_col(erythrocyte_contamination_markers, 'Gene names',
-                                                                        ';'), ';')
-        df_coagulation = fn.get_list_of_indices(df, 'Gene names',
-                                                fn.extract_val_from_col(coagulation_contamination_markers, 'Gene names',
-                                                                        ';'), ';')
-
-        trace_vol_pl = plot.getVolcanoPlot(df_platelet, '#990000', name='Platelets')
-        trace_vol_er = plot.getVolcanoPlot(df_erythrocyte, '#006699', name='Erythrocytes')
-        trace_vol_coag = plot.getVolcanoPlot(df_coagulation, '#66CCCC', name='Coagulation')
-
-        all_markers = []
-        all_markers.extend(
-            [df_platelet['Gene names'], df_erythrocyte['Gene names'], df_coagulation['Gene names']])
-        all_markers_list = list(itertools.chain.from_iterable(all_markers))
-        trace_vol_other = plot.getVolcanoPlot(df.drop(
-            index=[idx for idx in df.index if df.loc[idx, 'Gene names'] in all_markers_list]), 'gray',
-            opacity=0.4, name='Other proteins')
-        data_vol = [trace_vol_pl, trace_vol_er, trace_vol_coag, trace_vol_other]
+def plot_volcano(dataset_key):
+    if dataset_key is not None:
+        df_unrounded = store.get(dataset_key)
+        df = df_unrounded.round(4)
+        panels = [('Platelets', '#990000'), ('Erythrocytes', '#006699'), ('Coagulation', '#66CCCC')]
+        indices = store.derived(dataset_key, 'indices', fn.build_indices)
+        genes = [markers.get_panel(name)['genes'] for name, color in panels]
+        # one pass assigns every protein to its panels, the rest are the other proteins
+        membership = fn.panel_membership(indices['Gene names'], genes, len(df))
+        data_vol = [plot.getVolcanoPlot(df.iloc[np.flatnonzero(membership[:, i])], color, name=name,
+                                        webgl=volcano_webgl) for i, (name, color) in enumerate(panels)]
+        other_proteins = np.flatnonzero(~membership.any(axis=1))
+        if volcano_max_points is not None:
+            significant = df_unrounded['q_val'].values[other_proteins] <= fdr_level
+            other_proteins = other_proteins[fn.decimate_points(df['L10FC'].values[other_proteins],
+                                                               df['(-)log10_p_val'].values[other_proteins],
+                                                               significant, volcano_max_points)]
+        data_vol.append(plot.getVolcanoPlot(df.iloc[other_proteins], 'gray', opacity=0.4, name='Other proteins',
+                                            webgl=volcano_webgl))
+        data_vol.append(plot.getVolcanoSignificant(df[df_unrounded['q_val'].values <= fdr_level], fdr_level))
 
         return html.Div([
             html.H2("Systemic bias"),
             dcc.Markdown(
                 '''
                 The volcano plot illustrates the significance and the fold change of a comparison of two groups for 
-                the proteins in a study. Proteins above the red dashed line are considered as significantly different 
-                between both groups. Proteins of each of the three quality marker panels can be highlighted by 
-                clicking in the legend.
-                '''.replace('  ', ''),
+                the proteins in a study. Proteins circled in red are considered as significantly different between 
+                both groups at a permutation-based FDR of {:g}%. Proteins of each of the three quality marker panels 
+                can be highlighted by clicking in the legend.
+                '''.replace('  ', '').format(fdr_level * 100),
             ),
             dcc.Graph(
                 id='plot-volcano',
@@ -428,31 +837,57 @@ def plot_volcano(jsonified_df):
         ])
 
 
+def heatmap_clustering(dataset_key):
+    """
+    The clustering of the correlation map, computed once per dataset. Maps with more than heatmap_cluster_exact_max
+    proteins are clustered without the pairwise distance matrix.
+    """
+    def cluster(df):
+        if len(df) <= heatmap_cluster_exact_max:
+            return plot.getHeatmapClustering(df)
+        return plot.getHeatmapClustering(df, lambda values: clus.ward_linkage(values, heatmap_cluster_dims,
+                                                                              heatmap_preclusters))
+
+    return store.derived(dataset_key, 'clustering', cluster)
+
+
+def heatmap_figure(dataset_key):
+    """
+    The static correlation map (dendrograms and heatmap), built once per dataset. Maps with more than
+    heatmap_max_cells proteins show an overview averaged over blocks of neighbouring leaves.
+    """
+    clustering = heatmap_clustering(dataset_key)
+    axis_range = plot.getHeatmapRange(clustering)
+
+    def overview(df):
+        cells = None
+        if len(clustering['leaves']) > heatmap_max_cells:
+            cells = corr.level_of_detail(df.values, clustering['leaves'], axis_range, axis_range, heatmap_max_cells)
+        return plot.getComplexHeatmapFigure(df, [], clustering, cells)[0]
+
+    return store.derived(dataset_key, 'figure', overview)
+
+
+def heatmap_ranges(relayout_data, axis_range):
+    """
+    The visible ranges of the correlation map after zooming or panning, so the overlay follows the map.
+    """
+    ranges = []
+    for axis in ['xaxis', 'yaxis']:
+        relayout_data = relayout_data or {}
+        if '{}.range[0]'.format(axis) in relayout_data and '{}.range[1]'.format(axis) in relayout_data:
+            ranges.append([relayout_data['{}.range[0]'.format(axis)], relayout_data['{}.range[1]'.format(axis)]])
+        elif '{}.range'.format(axis) in relayout_data:
+            ranges.append(list(relayout_data['{}.range'.format(axis)]))
+        else:
+            ranges.append(list(axis_range))
+    return ranges
+
+
 @app.callback(
     Output('common-heatmap', 'children'),
-    [Input('intermediate-value-heatmap', 'children'),
-     Input('plot-volcano', 'clickData')])
-def plot_heatmap(jsonified_data, volcano_click):
-    df = pd.read_json(jsonified_data, orient='split')
-    annotation = []
-    figure, markers = plot.getComplexHeatmapFigure(df, annotation)
-    top3_proteins = {'erythrocytes': ['HBA1', 'HBB', 'CA1'],
-                     'platelets': ['FLNA', 'TLN1', 'MYH9'],
-                     'coagulation': ['FGB', 'FGG', 'FGA']}
-    for each in top3_proteins['platelets']:
-        stable_coordinate_platelets = [val for key, val in markers.items() if each in key][0]
-        annotation.append(plot.addAnnotatHeatmap(stable_coordinate_platelets, each, '#990000', -50, label=False))
-    for each in top3_proteins['erythrocytes']:
-        stable_coordinate_erythrocytes = [val for key, val in markers.items() if each in key][0]
-        annotation.append(plot.addAnnotatHeatmap(stable_coordinate_erythrocytes, each, '#006699', -50, label=False))
-    for each in top3_proteins['coagulation']:
-        stable_coordinate_coagulation = [val for key, val in markers.items() if each in key][0]
-        annotation.append(plot.addAnnotatHeatmap(stable_coordinate_coagulation, each, '#66CCCC', -50, label=False))
-    if volcano_click is not None:
-        gene = volcano_click['points'][0]['text']
-        coordinate = [val for key, val in markers.items() if gene in key][0]
-        annotation.append(plot.addAnnotatHeatmap(coordinate, gene, 'dimgrey', 50))
-        figure, markers = plot.getComplexHeatmapFigure(df, annotation)
+    [Input('intermediate-value-heatmap', 'children')])
+def plot_heatmap(dataset_key):
     return html.Div([
         html.H2("Evaluation of potential markers"),
         dcc.Markdown(
@@ -464,45 +899,252 @@ def plot_heatmap(jsonified_data, volcano_click):
             erythrocyte or thrombocyte-specific proteins.
             '''.replace('  ', ''),
         ),
-        dcc.Graph(
-            id='plot-heatmap',
-            figure=figure
-        ),
+        # the annotations are drawn by a transparent graph on top of the static map
+        html.Div([
+            # the map itself is sent by update_heatmap
+            dcc.Graph(
+                id='plot-heatmap',
+            ),
+            dcc.Graph(
+                id='plot-heatmap-overlay',
+                config={'displayModeBar': False, 'staticPlot': True},
+                style={'position': 'absolute', 'top': 0, 'left': 0, 'pointerEvents': 'none'}
+            ),
+        ], style={'position': 'relative'}),
     ])
 
 
+@app.callback(
+    Output('plot-heatmap', 'figure'),
+    [Input('intermediate-value-heatmap', 'children'),
+     Input('plot-heatmap', 'relayoutData')])
+def update_heatmap(dataset_key, relayout_data):
+    """
+    Large maps are sent as a block-averaged overview, zooming in replaces the heatmap by the cells of the visible
+    range, down to single proteins.
+    """
+    figure = heatmap_figure(dataset_key)
+    clustering = heatmap_clustering(dataset_key)
+    axis_range = plot.getHeatmapRange(clustering)
+    if relayout_data and len(clustering['leaves']) <= heatmap_max_cells:
+        # the whole map is in the browser already
+        raise PreventUpdate()
+    x_range, y_range = heatmap_ranges(relayout_data, axis_range)
+    if x_range == axis_range and y_range == axis_range:
+        return figure
+    cells = corr.level_of_detail(store.get(dataset_key).values, clustering['leaves'], x_range, y_range,
+                                 heatmap_max_cells)
+    return plot.getHeatmapTile(figure, cells, x_range, y_range)
+
+
+@app.callback(
+    Output('plot-heatmap-overlay', 'figure'),
+    [Input('intermediate-value-heatmap', 'children'),
+     Input('plot-volcano', 'clickData'),
+     Input('plot-heatmap', 'relayoutData')])
+def update_heatmap_overlay(dataset_key, volcano_click, relayout_data):
+    clustering = heatmap_clustering(dataset_key)
+    markers = clustering['markers']
+    markers_index = store.derived(dataset_key, 'markers-index', lambda df: fn.build_marker_index(markers))
+    annotation = []
+    # the marker annotations are shown once a protein is selected in the volcano plot
+    if volcano_click is not None:
+        top3_proteins = {'erythrocytes': ['HBA1', 'HBB', 'CA1'],
+                         'platelets': ['FLNA', 'TLN1', 'MYH9'],
+                         'coagulation': ['FGB', 'FGG', 'FGA']}
+        for each in top3_proteins['platelets']:
+            stable_coordinate_platelets = fn.find_marker(markers_index, markers, each)
+            annotation.append(plot.addAnnotatHeatmap(stable_coordinate_platelets, each, '#990000', -50, label=False))
+        for each in top3_proteins['erythrocytes']:
+            stable_coordinate_erythrocytes = fn.find_marker(markers_index, markers, each)
+            annotation.append(plot.addAnnotatHeatmap(stable_coordinate_erythrocytes, each, '#006699', -50,
+                                                     label=False))
+        for each in top3_proteins['coagulation']:
+            stable_coordinate_coagulation = fn.find_marker(markers_index, markers, each)
+            annotation.append(plot.addAnnotatHeatmap(stable_coordinate_coagulation, each, '#66CCCC', -50, label=False))
+        gene = volcano_click['points'][0]['text']
+        coordinate = fn.find_marker(markers_index, markers, gene)
+        annotation.append(plot.addAnnotatHeatmap(coordinate, gene, 'dimgrey', 50))
+    x_range, y_range = heatmap_ranges(relayout_data, plot.getHeatmapRange(clustering))
+    return plot.getHeatmapOverlay(annotation, x_range, y_range)
+
+
+REPORT_FORMATS = {'csv': 'text/csv', 'parquet': 'application/octet-stream',
+                  'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'}
+
+
+def contamination_report(dataset_key, slider_plat, slider_erythro, slider_coag):
+    """
+    The contamination ratios of every sample and whether they are above the threshold of the SD sliders, one row
+    per panel and state like the former data URI report.
+    Returns:A Data Frame with the LFQ columns.
+
+    """
+    lfq = out_of_core_matrix(dataset_key)
+    df = store.get(dataset_key)
+    columns_lfq = list(lfq.columns) if lfq is not None else fn.get_list_of_col(df, fn.lower_input('LFQ'))
+    rows = collections.OrderedDict()
+    for prefix, name, genes, reverse, slider in [
+            ('plat', 'Platelets', markers.get_panel('Platelets')['genes'], False, slider_plat),
+            ('erythro', 'Erythrocytes', markers.get_panel('Erythrocytes')['genes'], False, slider_erythro),
+            ('coag', 'Coagulation', coagulation_genes(), True, slider_coag)]:
+        columns_names, ratio, summary = panel_summary(dataset_key, name, genes, reverse=reverse)
+        threshold = fn.ratio_threshold(summary, slider)
+        row_name = '{}_contamination_ratio_SD{}={}'.format(prefix, slider, threshold)
+        rows[row_name] = list(ratio)
+        rows[row_name + '_high'] = ['no' if x < threshold else 'yes' for x in ratio]
+    return pd.DataFrame(list(rows.values()), index=list(rows), columns=columns_lfq)
+
+
+def stream_csv(df, chunk_rows=1000):
+    # the BOM lets Excel detect UTF-8, like the former data URI
+    yield '\ufeff'
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows].to_csv(header=start == 0, encoding='utf-8')
+
+
+@app.server.route(app.config.routes_pathname_prefix + 'download/report')
+def download_report():
+    """
+    Generates the contamination report (one row per sample in Parquet) or, with report=contrasts, the contrasts
+    report of a dataset when it is downloaded, as CSV (streamed), Parquet or XLSX.
+    """
+    args = flask.request.args
+    dataset_key, report_format = args.get('dataset', type=str), args.get('format', 'csv', type=str)
+    # matrix keys pass the store's key check but are no datasets
+    if not dataset_key or not store.DATASET_KEY.match(dataset_key) or not store.contains(dataset_key):
+        flask.abort(404, 'Unknown dataset')
+    if report_format not in REPORT_FORMATS:
+        flask.abort(400, 'Unsupported report format: {}'.format(report_format))
+    if args.get('report') == 'contrasts':
+        report = contrasts_report(dataset_key, args.get('contrasts', ''), args.get('control', ''),
+                                  args.get('design', 'unpaired')).set_index('Gene names')
+        filename = 'contrasts.{}'.format(report_format)
+    else:
+        report = contamination_report(dataset_key, args.get('plat', 3, type=int), args.get('erythro', 3, type=int),
+                                      args.get('coag', 3, type=int))
+        filename = '{}_changed.{}'.format(secure_filename(args.get('name', '')) or 'report', report_format)
+    headers = {'Content-Disposition': 'attachment; filename="{}"'.format(filename)}
+    if report_format == 'csv':
+        return flask.Response(flask.stream_with_context(stream_csv(report)), mimetype=REPORT_FORMATS['csv'],
+                              headers=headers)
+    buffer = io.BytesIO()
+    try:
+        if report_format == 'parquet':
+            table = report if args.get('report') == 'contrasts' else report.T.rename_axis('Sample')
+            table.reset_index().to_parquet(buffer, index=False)
+        else:
+            report.to_excel(buffer)
+    except ImportError as e:
+        # pyarrow/fastparquet and openpyxl are optional
+        flask.abort(501, 'The {} report needs an additional package: {}'.format(report_format, e))
+    buffer.seek(0)
+    return flask.Response(buffer, mimetype=REPORT_FORMATS[report_format], headers=headers)
+
+
 @app.callback(
     Output('download-link', 'href'),
     [Input('intermediate-value', 'children'),
-     Input('barchart-platelets', 'figure'),
-     Input('barchart-erythrocytes', 'figure'),
-     Input('barchart-coagulation', 'figure'),
-     Input('radio-button-platelets', 'value'),
      Input('slider-platelets', 'value'),
-     Input('radio-button-erythrocytes', 'value'),
      Input('slider-erythro', 'value'),
-     Input('radio-button-coagulation', 'value'),
-     Input('slider-coag', 'value')])
-def create_report(jsonified_df, barchart_plat, barchart_eryth, barchart_coag, radio_plat, slider_plat, radio_erythro,
-                  slider_erythro, radio_coag, slider_coag):
-    df = pd.read_json(jsonified_df, orient='split')
-    if radio_plat == 'rat':
-        plat_row_name = 'plat_contamination_ratio_SD' + str(slider_plat) + '=' \
-                        + str(barchart_plat['layout']['shapes'][0]['y1'])
-    df.ix[plat_row_name, 8:] = barchart_plat['data'][0]['y']
-    df.ix[plat_row_name + '_high', 8:] = ['no' if x < barchart_plat['layout']['shapes'][0]['y1'] else 'yes'
-                                            for x in df.ix[plat_row_name, 8:]]
-    if radio_erythro == 'rat':
-        erythro_row_name = 'erythro_contamination_ratio_SD' + str(slider_erythro) + '=' + str(barchart_eryth['layout']['shapes'][0]['y1'])
-    df.ix[erythro_row_name, 8:] = barchart_eryth['data'][0]['y']
-    df.ix[erythro_row_name + '_high', 8:] = ['no' if x < barchart_eryth['layout']['shapes'][0]['y1'] else 'yes'
-                                               for x in df.ix[erythro_row_name, 8:]]
-    if radio_coag == 'rat':
-        coag_row_name = 'coag_contamination_ratio_SD' + str(slider_coag) + '=' \
-                        + str(barchart_coag['layout']['shapes'][0]['y1'])
-    df.ix[coag_row_name, 8:] = barchart_coag['data'][0]['y']
-    df.ix[coag_row_name + '_high', 8:] = ['no' if x < barchart_coag['layout']['shapes'][0]['y1'] else 'yes'
-                                            for x in df.ix[coag_row_name, 8:]]
-    csv_string = df.iloc[-6:, 8:].to_csv(index=True, encoding='utf-8')
-    csv_string = "data:text/csv;charset=utf-8,%EF%BB%BF" + urllib.parse.quote(csv_string)
-    return csv_string
+     Input('slider-coag', 'value'),
+     Input('radio-report-format', 'value')],
+    [State('upload-data', 'fileNames')])
+def create_report(dataset_key, slider_plat, slider_erythro, slider_coag, report_format, file_names):
+    # only the link changes with the sliders, the report is generated by download_report when it is downloaded
+    if dataset_key is None:
+        return None
+    query = {'dataset': dataset_key, 'plat': slider_plat, 'erythro': slider_erythro, 'coag': slider_coag,
+             'format': report_format or 'csv'}
+    if file_names:
+        query['name'] = upload.split_reported_name(file_names[-1])[0].split('.')[0]
+    return app.config.requests_pathname_prefix + 'download/report?' + urllib.parse.urlencode(query)
+
+
+def parse_contrasts(contrasts_input):
+    """
+    Parses "TP4 vs TP1, TP7 vs TP1" into [('TP1', 'TP4'), ('TP1', 'TP7')] (control, samples) pairs.
+    """
+    contrasts = []
+    for each in re.split(r'[,;\n]', contrasts_input or ''):
+        # hyphens only separate the groups with spaces around them, identifiers like "pre-op" may contain them
+        sides = re.split(r'\s+vs\.?\s+|\s+-\s+', each.strip(), flags=re.IGNORECASE)
+        if len(sides) == 2 and all(sides):
+            contrasts.append((sides[1].upper(), sides[0].upper()))
+    return contrasts
+
+
+def contrast_groups(columns_lfq, contrasts_input, control_input):
+    """
+    Resolves the requested contrasts. Every group identifier is matched as a whole against the LFQ columns (so
+    'pre-op' doesn't match 'post-op'); without requested contrasts every timepoint is compared to the control group.
+    Returns:A dict of group names to LFQ column positions and a list of (control, samples) pairs.
+
+    """
+    contrasts = parse_contrasts(contrasts_input)
+    if not contrasts:
+        groups = se.timepoint_groups(columns_lfq)
+        baseline = (control_input or '').strip().upper()
+        baseline = baseline if baseline in groups else next(iter(groups), None)
+        return groups, se.baseline_contrasts(groups, baseline)
+    columns = pd.Index(columns_lfq)
+    groups = {}
+    for name in {name for contrast in contrasts for name in contrast}:
+        matched = fn.get_list_of_col(pd.DataFrame(columns=columns), [name.lower()])
+        groups[name] = [columns_lfq.index(column) for column in matched]
+    return groups, contrasts
+
+
+@app.callback(
+    Output('download-contrasts', 'href'),
+    [Input('intermediate-value', 'children'),
+     Input('input-contrasts', 'value')],
+    [State('input-control', 'value'),
+     State('radio-design', 'value')])
+def create_contrasts_report(dataset_key, contrasts_input, control_input, design_mode):
+    # like create_report, the contrasts are only computed by download_report when they are downloaded
+    if dataset_key is None:
+        return None
+    query = {'dataset': dataset_key, 'report': 'contrasts', 'contrasts': contrasts_input or '',
+             'control': control_input or '', 'design': design_mode or 'unpaired'}
+    return app.config.requests_pathname_prefix + 'download/report?' + urllib.parse.urlencode(query)
+
+
+def contrasts_report(dataset_key, contrasts_input, control_input, design_mode):
+    """
+    The statistics of every requested contrast (see contrast_groups), one row per protein.
+    Returns:A Data Frame with the Gene names, Protein IDs and the statistics columns of every contrast.
+
+    """
+    df = store.get(dataset_key)
+    lfq = out_of_core_matrix(dataset_key)
+    columns_lfq = list(lfq.columns) if lfq is not None else fn.get_list_of_col(df, fn.lower_input('LFQ'))
+    design = paired_design(columns_lfq) if design_mode == 'paired' else None
+    if design is not None:
+        timepoints = design['timepoints']
+        contrasts = parse_contrasts(contrasts_input)
+        if not contrasts:
+            baseline = (control_input or '').strip().upper()
+            contrasts = se.baseline_contrasts(timepoints, baseline if baseline in timepoints else timepoints[0])
+        contrasts = [contrast for contrast in contrasts if all(name in timepoints for name in contrast)]
+    else:
+        groups, contrasts = contrast_groups(columns_lfq, contrasts_input, control_input)
+        groups = {name: cols for name, cols in groups.items() if cols}
+        contrasts = [contrast for contrast in contrasts if all(name in groups for name in contrast)]
+    if design is not None and lfq is not None:
+        results = ooc.paired_contrast_statistics(lfq.values, design, contrasts, dtype=stats_dtype)
+    elif design is not None:
+        results = se.paired_contrast_statistics(se.design_tensor(df[columns_lfq].values, design), design['timepoints'],
+                                                contrasts, dtype=stats_dtype)
+    elif lfq is not None:
+        moments = ooc.group_moments(lfq.values, groups, dtype=stats_dtype)
+        results = se.multi_contrast_statistics(None, groups, contrasts, equal_var=stats_equal_var,
+                                               processes=contrast_processes, moments=moments)
+    else:
+        results = se.multi_contrast_statistics(df[columns_lfq].values, groups, contrasts, equal_var=stats_equal_var,
+                                               dtype=stats_dtype, processes=contrast_processes)
+    report = df[['Gene names', 'Protein IDs']].copy()
+    for name, statistics in results.items():
+        for column, values in statistics.items():
+            report['{} {}'.format(column, name)] = values
+    return report
@@ -0,0 +1,289 @@
+import collections
+import os
+import re
+import threading
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from .analysis.outofcore import is_memmap, memmap_file
+
+##############################
+# Server-side store / Datasets
+##############################
+
+# Only the keys of these entries travel through the hidden Divs, the data itself stays in the server process.
+# Entries are kept in memory in least recently used order; above memory_max_bytes the oldest ones are pickled
+# into spill_path (if configured) and loaded back on the next access. Every file of a dataset in spill_path starts
+# with its key (spill file, derived objects, memory-mapped matrices); above disk_max_bytes the files of the least
+# recently used datasets which aren't in memory are deleted.
+# Worker processes of background jobs (see jobs.py) have their own store. With write_through, everything they store
+# and derive is also pickled into spill_path right away, where the server process finds it by its key. Data Frames
+# over memory-mapped files are pickled as the path of the file, not as a copy of the values.
+
+# keys come back from the browser and end up in file names, only generated keys are accepted
+KEY = re.compile(r'^[0-9a-f]{32}(-lfq)?$')
+# keys of whole datasets, without the matrices stored next to them
+DATASET_KEY = re.compile(r'^[0-9a-f]{32}$')
+
+_entries = collections.OrderedDict()
+_sizes = {}
+_derived = {}
+_lock = threading.RLock()
+
+spill_path = None
+memory_max_bytes = 2 * 1024 * 1024 * 1024
+disk_max_bytes = 20 * 1024 * 1024 * 1024
+write_through = False
+
+
+class MappedFrame(object):
+    """
+    A Data Frame over a memory-mapped .npy file, pickled without its values.
+    """
+
+    def __init__(self, df):
+        self.path, self.index, self.columns = memmap_file(df.values), df.index, df.columns
+
+    def open(self):
+        return pd.DataFrame(np.load(self.path, mmap_mode='r'), index=self.index, columns=self.columns, copy=False)
+
+
+def configure(spill_dir=None, max_bytes=None, write=None, max_disk_bytes=None):
+    global spill_path, memory_max_bytes, write_through, disk_max_bytes
+    if spill_dir is not None:
+        os.makedirs(spill_dir, exist_ok=True)
+        spill_path = spill_dir
+    if max_bytes is not None:
+        memory_max_bytes = max_bytes
+    if write is not None:
+        write_through = write
+    if max_disk_bytes is not None:
+        disk_max_bytes = max_disk_bytes
+
+
+def new_key():
+    return uuid.uuid4().hex
+
+
+def check_key(key):
+    if not isinstance(key, str) or not KEY.match(key):
+        raise KeyError('Invalid dataset key {!r}.'.format(key))
+    return key
+
+
+def estimate_size(value):
+    # memory-mapped matrices live on disk already and are never spilled
+    if isinstance(value, pd.DataFrame):
+        if len(set(value.dtypes)) == 1 and is_memmap(value.values):
+            return 0
+        return int(value.memory_usage(index=True, deep=False).sum())
+    if isinstance(value, np.ndarray):
+        return 0 if is_memmap(value) else value.nbytes
+    return 0
+
+
+def spill_file(key):
+    return os.path.join(spill_path, check_key(key) + '.pkl')
+
+
+def derived_file(key, name):
+    return os.path.join(spill_path, '{}-derived-{}.pkl'.format(check_key(key), name))
+
+
+def plain(value):
+    # plotly 2 figures can't be pickled, they are stored as the dicts and lists they consist of
+    if isinstance(value, dict):
+        return {name: plain(each) for name, each in value.items()}
+    if isinstance(value, tuple):
+        return tuple(plain(each) for each in value)
+    if isinstance(value, list):
+        return [plain(each) for each in value]
+    return value
+
+
+def dump(value, path):
+    if isinstance(value, pd.DataFrame) and len(set(value.dtypes)) == 1 and memmap_file(value.values) is not None:
+        value = MappedFrame(value)
+    elif not isinstance(value, (pd.DataFrame, np.ndarray)):
+        value = plain(value)
+    tmp_path = path + '.tmp'
+    pd.to_pickle(value, tmp_path)
+    os.replace(tmp_path, path)
+    _trim_disk(keep=os.path.basename(path)[:32])
+
+
+def load(path):
+    value = pd.read_pickle(path)
+    return value.open() if isinstance(value, MappedFrame) else value
+
+
+def put(value, key=None):
+    """
+    Stores a dataset (Data Frame, ndarray or any picklable object) on the server.
+    Args:
+        value: A dataset to store.
+        key: A key to store it under, a new one is generated if omitted.
+
+    Returns:The key which is passed between callbacks instead of the dataset.
+
+    """
+    key = check_key(key or new_key())
+    with _lock:
+        _entries[key] = value
+        _entries.move_to_end(key)
+        _sizes[key] = estimate_size(value)
+        _derived.pop(key, None)
+        _shrink()
+    if write_through and spill_path is not None:
+        dump(value, spill_file(key))
+    return key
+
+
+def get(key):
+    """
+    Returns the stored object itself, not a copy. Callbacks must not modify it in place.
+    Args:
+        key: A key returned by put.
+
+    Returns:The stored dataset.
+
+    """
+    check_key(key)
+    with _lock:
+        if key in _entries:
+            _entries.move_to_end(key)
+            return _entries[key]
+        if spill_path is not None and os.path.exists(spill_file(key)):
+            value = load(spill_file(key))
+            _touch(spill_file(key))
+            _entries[key] = value
+            _sizes[key] = estimate_size(value)
+            _shrink(keep=key)
+            return value
+    raise KeyError('Dataset {} is not stored on the server.'.format(key))
+
+
+def persist(key):
+    """
+    Pickles a dataset into spill_path (if it isn't there yet), so worker processes can read it by its key.
+    """
+    value = get(key)
+    if spill_path is not None and not _touch(spill_file(key)):
+        dump(value, spill_file(key))
+
+
+def contains(key):
+    check_key(key)
+    with _lock:
+        return key in _entries or (spill_path is not None and os.path.exists(spill_file(key)))
+
+
+def delete(key):
+    """
+    Removes a dataset, everything derived from it and the files it owns in spill_path, i.e. every file starting with
+    its key like the memory-mapped matrices of out-of-core datasets.
+    """
+    check_key(key)
+    with _lock:
+        for each in [each for each in _entries if each.startswith(key)]:
+            _entries.pop(each)
+            _sizes.pop(each)
+            _derived.pop(each, None)
+        if spill_path is not None:
+            for name in os.listdir(spill_path):
+                if name.startswith(key):
+                    try:
+                        os.remove(os.path.join(spill_path, name))
+                    except OSError:
+                        pass
+
+
+def clear():
+    """
+    Drops every dataset kept in memory, e.g. in a worker process after a job. Spilled files stay in spill_path.
+    """
+    with _lock:
+        _entries.clear()
+        _sizes.clear()
+        _derived.clear()
+
+
+def derived(key, name, factory):
+    """
+    Memoizes an object computed from a stored dataset (e.g. an index or summary) for as long as the dataset is
+    kept in memory.
+    Args:
+        key: A key of the dataset.
+        name: A name of the derived object, including every parameter it depends on.
+        factory: A function of the dataset computing the derived object.
+
+    Returns:The derived object.
+
+    """
+    with _lock:
+        cached = _derived.get(key, {})
+        if name in cached:
+            return cached[name]
+    if spill_path is not None and os.path.exists(derived_file(key, name)):
+        # derived by a worker process, kept for as long as the dataset like every derived object
+        get(key)
+        value = load(derived_file(key, name))
+    else:
+        value = factory(get(key))
+        if write_through and spill_path is not None:
+            dump(value, derived_file(key, name))
+    with _lock:
+        if key in _entries:
+            _derived.setdefault(key, {})[name] = value
+    return value
+
+
+def _shrink(keep=None):
+    while sum(_sizes.values()) > memory_max_bytes:
+        candidates = [key for key in _entries if key != keep and _sizes[key] > 0]
+        if not candidates:
+            break
+        key = candidates[0]
+        value = _entries.pop(key)
+        _sizes.pop(key)
+        _derived.pop(key, None)
+        if spill_path is not None and not os.path.exists(spill_file(key)):
+            dump(value, spill_file(key))
+
+
+def _touch(path):
+    # marks the files of a dataset as recently used, returns False if the file is missing
+    try:
+        os.utime(path, None)
+        return True
+    except OSError:
+        return False
+
+
+def _trim_disk(keep=None):
+    with _lock:
+        in_memory = set(key[:32] for key in _entries) | {keep}
+        groups = {}
+        for name in os.listdir(spill_path):
+            if name.endswith('.tmp') or not KEY.match(name[:32]):
+                continue
+            try:
+                stat = os.stat(os.path.join(spill_path, name))
+            except OSError:
+                continue
+            names, size, used = groups.get(name[:32], ([], 0, 0))
+            groups[name[:32]] = (names + [name], size + stat.st_size, max(used, stat.st_mtime))
+        total = sum(size for names, size, used in groups.values())
+        for key, (names, size, used) in sorted(groups.items(), key=lambda item: item[1][2]):
+            if total <= disk_max_bytes:
+                break
+            if key in in_memory:
+                continue
+            for name in names:
+                try:
+                    os.remove(os.path.join(spill_path, name))
+                except OSError:
+                    pass
+            total -= size
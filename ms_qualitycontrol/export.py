@@ -0,0 +1,268 @@
+import html
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import plotly.offline as offline
+from plotly.offline.offline import get_plotlyjs
+
+import ms_qualitycontrol.analysis.correlation as corr
+import ms_qualitycontrol.analysis.functions as fn
+import ms_qualitycontrol.analysis.markers as markers
+import ms_qualitycontrol.analysis.permutation as perm
+import ms_qualitycontrol.analysis.plotting_functions as plot
+import ms_qualitycontrol.analysis.table_cache as tc
+from ms_qualitycontrol.analysis.pipeline import Pipeline
+from ms_qualitycontrol.batch import find_tables, init_worker, write_atomic
+
+##########################
+# Bulk export of QC reports
+##########################
+
+# The figures of the web interface for every protein table of a directory, built from plotting_functions without a
+# Dash server: the three contamination bar charts, the volcano plot and the correlation map. Every study gets one
+# self-contained HTML report (plotly.js is embedded, the report opens offline) and/or one image per figure.
+# Studies run in parallel worker processes like the batch QC, outputs are written under a temporary name first, so
+# a resumed export only repeats the studies with missing outputs.
+
+EXPORT_FILE = 'export.csv'
+EXPORT_COLUMNS = ['file', 'status', 'outputs', 'error']
+IMAGE_FORMATS = ['png', 'svg', 'pdf']
+
+# panel, y axis title of its bar chart
+BAR_CHARTS = [('Platelets', 'Contamination Ratio <br> [Platelets : Plasma]'),
+              ('Erythrocytes', 'Contamination Ratio <br> [Erythrocytes : Plasma]'),
+              ('Coagulation', 'Contamination Ratio <br> [Plasma : Coagulation]')]
+VOLCANO_PANELS = [('Platelets', '#990000'), ('Erythrocytes', '#006699'), ('Coagulation', '#66CCCC')]
+
+HTML_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script type="text/javascript">{plotlyjs}</script>
+</head>
+<body style="font-family: Arial, sans-serif; background-color: #EFEFEF">
+<h1>{title}</h1>
+{sections}
+</body>
+</html>
+'''
+
+
+def bar_chart_figure(pipeline, panel, yaxis_title):
+    flags = pipeline.flags(panel)
+    threshold = flags['threshold'].iloc[0] if len(flags) else np.nan
+    return {
+        'data': plot.getBarChart(x=list(flags['Sample']), y=list(flags['ratio']), color='rgb(66, 196, 247)'),
+        'layout': plot.getLayoutBarChart(
+            threshold=threshold,
+            yaxis_title=yaxis_title,
+            annotations=fn.create_annotations(flags['ratio'].values, threshold, list(flags['Sample'])),
+        )
+    }
+
+
+def volcano_figure(pipeline, fdr_level=0.05, max_points=None):
+    """
+    The volcano plot of the web interface, drawn as SVG since the figure is rendered once.
+    """
+    df_unrounded = pipeline.statistics()
+    df = df_unrounded.round(4)
+    genes = [markers.get_panel(name)['genes'] for name, color in VOLCANO_PANELS]
+    membership = fn.panel_membership(fn.build_indices(df)['Gene names'], genes, len(df))
+    data = [plot.getVolcanoPlot(df.iloc[np.flatnonzero(membership[:, i])], color, name=name)
+            for i, (name, color) in enumerate(VOLCANO_PANELS)]
+    other_proteins = np.flatnonzero(~membership.any(axis=1))
+    if max_points is not None:
+        significant = df_unrounded['q_val'].values[other_proteins] <= fdr_level
+        other_proteins = other_proteins[fn.decimate_points(df['L10FC'].values[other_proteins],
+                                                           df['(-)log10_p_val'].values[other_proteins],
+                                                           significant, max_points)]
+    data.append(plot.getVolcanoPlot(df.iloc[other_proteins], 'gray', opacity=0.4, name='Other proteins'))
+    data.append(plot.getVolcanoSignificant(df[df_unrounded['q_val'].values <= fdr_level], fdr_level))
+    return {'data': data, 'layout': plot.getLayoutVolcanoPlot()}
+
+
+def heatmap_figure(pipeline, max_cells=600):
+    """
+    The correlation map with both dendrograms, maps with more than max_cells proteins as the block-averaged
+    overview of the web interface.
+    """
+    data = pipeline.correlation()
+    clustering = plot.getHeatmapClustering(data, lambda values: pipeline.clustering()['linkage'])
+    cells = None
+    if len(clustering['leaves']) > max_cells:
+        axis_range = plot.getHeatmapRange(clustering)
+        cells = corr.level_of_detail(data.values, clustering['leaves'], axis_range, axis_range, max_cells)
+    return plot.getComplexHeatmapFigure(data, [], clustering, cells)[0]
+
+
+def study_figures(pipeline, options=None):
+    """
+    Returns:A list of (name, heading, figure, description) of all figures of a study.
+    """
+    options = options or {}
+    figures = []
+    for panel, yaxis_title in BAR_CHARTS:
+        flags = pipeline.flags(panel)
+        flagged = ', '.join(flags['Sample'][flags['flagged']]) or 'none'
+        figures.append((panel.lower(), panel, bar_chart_figure(pipeline, panel, yaxis_title),
+                        'Samples above {} SD: {}'.format(pipeline.params['num_std'], flagged)))
+    fdr_level = options.get('fdr_level', 0.05)
+    figures.append(('volcano', 'Systemic bias', volcano_figure(pipeline, fdr_level, options.get('volcano_max_points')),
+                    'Proteins circled in red are significant at a permutation-based FDR of {:g}%.'
+                    .format(fdr_level * 100)))
+    figures.append(('heatmap', 'Global correlation map',
+                    heatmap_figure(pipeline, options.get('heatmap_max_cells', 600)), ''))
+    return figures
+
+
+def html_report(title, figures):
+    """
+    Returns:A self-contained HTML page with the figures, plotly.js is embedded once.
+    """
+    sections = []
+    for name, heading, figure, description in figures:
+        div = offline.plot(figure, output_type='div', include_plotlyjs=False, show_link=False, validate=False)
+        sections.append('<h2>{}</h2>\n<p>{}</p>\n{}'.format(html.escape(heading), html.escape(description), div))
+    return HTML_TEMPLATE.format(title=html.escape(title), plotlyjs=get_plotlyjs(), sections='\n'.join(sections))
+
+
+def image_io(image_format):
+    try:
+        import plotly.io as pio
+    except ImportError:
+        raise ImportError('{} export needs plotly >= 3.2 with orca, the HTML export works with every plotly version.'
+                          .format(image_format.upper()))
+    return pio
+
+
+def write_image(figure, path, image_format):
+    pio = image_io(image_format)
+    tmp_path = path + '.tmp'
+    pio.write_image(figure, tmp_path, format=image_format)
+    os.replace(tmp_path, path)
+
+
+def write_text(text, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def export_paths(output_dir, filepath, formats):
+    """
+    Returns:The output files of a study: <file>.report.html and <file>.<figure>.<format> for images.
+    """
+    base = os.path.join(output_dir, os.path.basename(filepath))
+    paths = []
+    for export_format in formats:
+        if export_format == 'html':
+            paths.append(base + '.report.html')
+        else:
+            paths.extend('{}.{}.{}'.format(base, name, export_format)
+                         for name in ['platelets', 'erythrocytes', 'coagulation', 'volcano', 'heatmap'])
+    return paths
+
+
+def export_file(filepath, output_dir, control_input, sample_input=None, paired=False, num_std=3, formats=('html',),
+                options=None):
+    """
+    Builds the figures of one file and writes them in every format. Errors are reported in the summary row instead
+    of being raised, so one broken file doesn't stop the export.
+    Returns:The summary row of the file.
+
+    """
+    row = dict.fromkeys(EXPORT_COLUMNS, '')
+    row['file'] = os.path.basename(filepath)
+    try:
+        options = options or {}
+        if options.get('cache_path'):
+            df = tc.read_cached_table(filepath, options['cache_path'], options.get('cache_max_bytes', 0))
+        else:
+            df = fn.read_own_table(filepath)
+        # one worker per study, so the statistics and the correlation stay on one core
+        pipeline = Pipeline(data=df, control=control_input, samples=sample_input, paired=paired, num_std=num_std,
+                            equal_var=options.get('stats_equal_var', True),
+                            dtype=options.get('stats_dtype', 'float64'),
+                            fdr_permutations=options.get('fdr_permutations', perm.N_PERMUTATIONS),
+                            fdr_s0=options.get('fdr_s0'), fdr_seed=options.get('fdr_seed', 0), fdr_processes=1,
+                            correlation_method=options.get('heatmap_method', 'pearson'),
+                            correlation_dtype=options.get('heatmap_dtype', 'float64'), correlation_threads=1,
+                            cluster_exact_max=options.get('heatmap_cluster_exact_max', 5000),
+                            cluster_dims=options.get('heatmap_cluster_dims', 256),
+                            preclusters=options.get('heatmap_preclusters'))
+        figures = study_figures(pipeline, options)
+        base = os.path.join(output_dir, os.path.basename(filepath))
+        outputs = []
+        for export_format in formats:
+            if export_format == 'html':
+                write_text(html_report(os.path.basename(filepath), figures), base + '.report.html')
+                outputs.append(base + '.report.html')
+                continue
+            for name, heading, figure, description in figures:
+                path = '{}.{}.{}'.format(base, name, export_format)
+                write_image(figure, path, export_format)
+                outputs.append(path)
+        row.update(status='ok', outputs=';'.join(os.path.basename(path) for path in outputs), error='')
+    except Exception as e:
+        row.update(status='failed', error='{}: {}'.format(type(e).__name__, e))
+        traceback.print_exc()
+    return row
+
+
+def run_export(input_dir, output_dir, control_input, sample_input=None, paired=False, num_std=3, formats=('html',),
+               processes=None, resume=False, pattern='*', marker_sources=(), options=None):
+    """
+    Exports the QC figures of every protein table of a directory.
+    Args:
+        input_dir: A directory with the protein tables.
+        output_dir: A directory for the reports and the export summary, created if missing.
+        control_input: An identifier of the control group columns.
+        sample_input: An identifier of the samples group columns, every other column if empty.
+        paired: Uses a paired design where the LFQ headers have one.
+        num_std: Number of standard deviations of the flag thresholds.
+        formats: 'html' and/or image formats of IMAGE_FORMATS.
+        processes: Number of worker processes, None uses all CPUs.
+        resume: Skips files which have all their outputs from a previous run.
+        pattern: A file name pattern, e.g. '*proteinGroups*'.
+        marker_sources: (path, cache directory) pairs of the marker panel files or directories.
+        options: Statistics, FDR and cache settings like in the batch QC and the figure settings of run.py
+            ('fdr_level', 'volcano_max_points', 'heatmap_max_cells', 'heatmap_method', 'heatmap_dtype',
+            'heatmap_cluster_exact_max', 'heatmap_cluster_dims', 'heatmap_preclusters').
+
+    Returns:The export summary Data Frame, also written to output_dir.
+
+    """
+    unknown = set(formats) - set(['html'] + IMAGE_FORMATS)
+    if unknown:
+        raise ValueError('Unsupported export formats: {}'.format(', '.join(sorted(unknown))))
+    # fail before reading any file if the image export is missing
+    for export_format in set(formats) & set(IMAGE_FORMATS):
+        image_io(export_format)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = find_tables(input_dir, pattern)
+    rows, pending = {}, []
+    for path in paths:
+        outputs = export_paths(output_dir, path, formats)
+        if resume and all(os.path.exists(output) for output in outputs):
+            rows[os.path.basename(path)] = {'file': os.path.basename(path), 'status': 'ok',
+                                            'outputs': ';'.join(os.path.basename(output) for output in outputs),
+                                            'error': ''}
+        else:
+            pending.append(path)
+    with ProcessPoolExecutor(processes or os.cpu_count() or 1, initializer=init_worker,
+                             initargs=(list(marker_sources),)) as executor:
+        futures = [executor.submit(export_file, path, output_dir, control_input, sample_input, paired, num_std,
+                                   tuple(formats), options) for path in pending]
+        for done, future in enumerate(as_completed(futures), 1):
+            row = future.result()
+            rows[row['file']] = row
+            print('[{}/{}] {} {}'.format(done, len(pending), row['file'], row['status']), flush=True)
+    summary = pd.DataFrame([rows[os.path.basename(path)] for path in paths], columns=EXPORT_COLUMNS)
+    write_atomic(summary, os.path.join(output_dir, EXPORT_FILE))
+    return summary
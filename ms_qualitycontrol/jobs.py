@@ -0,0 +1,227 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+###########################
+# Background jobs / Workers
+###########################
+
+# Heavy stages of the web interface run in a local pool of worker processes instead of the Flask request threads,
+# the callbacks only submit them and poll their state. Workers report their progress through a small JSON file per
+# job in job_path and look for a cancel file there whenever they report, so a running stage stops at its next
+# checkpoint. Jobs return what they return, large results are passed through the datastore (see store.write_through).
+# Without worker processes (processes=0) jobs run right away in the calling thread, like before.
+# A job is forgotten once its result was picked up, or KEEP_SECONDS after it failed or was cancelled.
+
+PENDING, RUNNING, DONE, FAILED, CANCELLED = 'pending', 'running', 'done', 'failed', 'cancelled'
+
+KEEP_SECONDS = 3600
+
+job_path = None
+processes = 0
+
+_executor = None
+_initializer = None
+_finalizer = None
+_futures = {}
+_inline = {}
+_finished = {}
+_lock = threading.Lock()
+# the job of a worker process, None outside of jobs
+_current = None
+
+
+class Cancelled(Exception):
+    pass
+
+
+def configure(path, max_workers=0, initializer=None, finalizer=None):
+    """
+    Args:
+        path: A directory for the progress and cancel files, created if missing.
+        max_workers: Number of worker processes, 0 runs jobs in the calling thread.
+        initializer: A function called once in every worker process, e.g. to configure the datastore.
+        finalizer: A module-level function called in the worker process after every job, e.g. to release what the
+            job kept in memory.
+
+    """
+    global job_path, processes, _initializer, _finalizer
+    os.makedirs(path, exist_ok=True)
+    job_path, processes, _initializer, _finalizer = path, max_workers, initializer, finalizer
+
+
+def executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # spawned workers don't inherit the locks and BLAS threads of the threaded server
+            _executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_initializer)
+        return _executor
+
+
+def progress_file(job_id):
+    return os.path.join(job_path, job_id + '.json')
+
+
+def cancel_file(job_id):
+    return os.path.join(job_path, job_id + '.cancel')
+
+
+def remove_files(job_id):
+    for path in [progress_file(job_id), cancel_file(job_id)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def run(job_id, path, function, args, finalizer=None):
+    # the entry point of a job in the worker process
+    global _current, job_path
+    _current, job_path = job_id, path
+    try:
+        progress(0, 'Started')
+        return function(*args)
+    finally:
+        _current = None
+        remove_files(job_id)
+        if finalizer is not None:
+            finalizer()
+
+
+def in_job():
+    return _current is not None
+
+
+def finish(job_id):
+    with _lock:
+        _finished[job_id] = time.time()
+
+
+def forget(job_id):
+    with _lock:
+        _futures.pop(job_id, None)
+        _inline.pop(job_id, None)
+        _finished.pop(job_id, None)
+    remove_files(job_id)
+
+
+def prune():
+    # jobs whose result is never picked up, e.g. failed or cancelled ones
+    now = time.time()
+    with _lock:
+        expired = [job_id for job_id, finished in _finished.items() if now - finished > KEEP_SECONDS]
+    for job_id in expired:
+        forget(job_id)
+
+
+def submit(function, *args):
+    """
+    Runs function(*args) in a worker process.
+    Args:
+        function: A module-level function, it may call progress to report its progress and to stop when the job
+            is cancelled.
+        *args: Picklable arguments.
+
+    Returns:The id of the job.
+
+    """
+    prune()
+    job_id = uuid.uuid4().hex
+    if processes:
+        future = executor().submit(run, job_id, job_path, function, args, _finalizer)
+        with _lock:
+            _futures[job_id] = future
+        future.add_done_callback(lambda future: finish(job_id))
+        return job_id
+    try:
+        _inline[job_id] = (DONE, function(*args))
+    except Exception as e:
+        _inline[job_id] = (FAILED, e)
+        traceback.print_exc()
+    finish(job_id)
+    return job_id
+
+
+def progress(fraction, message=''):
+    """
+    Reports the progress of the current job, raises Cancelled if it was cancelled. Does nothing outside of jobs.
+    Args:
+        fraction: The completed part of the job, between 0 and 1.
+        message: What the job is doing.
+
+    """
+    if _current is None:
+        return
+    if os.path.exists(cancel_file(_current)):
+        raise Cancelled()
+    tmp_path = progress_file(_current) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'progress': fraction, 'message': message}, f)
+    os.replace(tmp_path, progress_file(_current))
+
+
+def status(job_id):
+    """
+    Returns:A dict with the 'state' of a job, its 'progress' (0 to 1), the 'message' of its last report and the
+    'error' of a failed job.
+
+    """
+    state = {'state': PENDING, 'progress': 0, 'message': '', 'error': ''}
+    if job_id in _inline:
+        outcome, value = _inline[job_id]
+        state.update(state=outcome, progress=1,
+                     error='' if outcome == DONE else '{}: {}'.format(type(value).__name__, value))
+        return state
+    future = _futures.get(job_id)
+    if future is None:
+        raise KeyError('Unknown job {}.'.format(job_id))
+    if future.cancelled():
+        state['state'] = CANCELLED
+    elif future.done():
+        error = future.exception()
+        if isinstance(error, Cancelled):
+            state['state'] = CANCELLED
+        elif error is not None:
+            state.update(state=FAILED, error='{}: {}'.format(type(error).__name__, error))
+        else:
+            state.update(state=DONE, progress=1)
+    elif os.path.exists(progress_file(job_id)):
+        try:
+            with open(progress_file(job_id)) as f:
+                state.update(json.load(f), state=RUNNING)
+        except (OSError, ValueError):
+            state['state'] = RUNNING
+    return state
+
+
+def result(job_id):
+    """
+    Returns:The return value of a finished job, raises its exception if it failed. The job is forgotten.
+    """
+    try:
+        if job_id in _inline:
+            outcome, value = _inline[job_id]
+            if outcome == FAILED:
+                raise value
+            return value
+        return _futures[job_id].result()
+    finally:
+        forget(job_id)
+
+
+def cancel(job_id):
+    """
+    Cancels a job: a pending job is never started, a running job stops at its next progress report.
+    """
+    future = _futures.get(job_id)
+    if future is None or future.done() or future.cancel():
+        return
+    with open(cancel_file(job_id), 'w'):
+        pass
@@ -0,0 +1,236 @@
+import io
+import os
+import re
+import shutil
+import threading
+import time
+
+from dash_resumable_upload import get_chunk_name
+from flask import request as _request
+from flask import abort as _abort
+from werkzeug.utils import secure_filename
+
+import ms_qualitycontrol.analysis.functions as fn
+
+##########################################
+# Resumable upload endpoint / Parse ingest
+##########################################
+
+# Same protocol as dash_resumable_upload.decorate_server, but instead of concatenating the chunks into one file
+# after the last one has landed, every upload is parsed by a background thread which consumes the chunks in order
+# while they are received. Uploads above large_bytes and compressed ones are written to one file instead and read
+# by read_file once all chunks have arrived, i.e. by the chunked reader and the table cache. The server answers every chunk with
+# "<file name> (<resumable identifier>)", which the upload component reports in fileNames, and the parsed table
+# is picked up with get_table by that name.
+
+# seconds to wait for the next chunk before the upload is treated as abandoned, and for a parsed table to be
+# picked up
+CHUNK_TIMEOUT = 600
+
+# resumable.js builds the identifiers from the file size and the alphanumeric characters of the file name
+IDENTIFIER = re.compile(r'^[\w-]+$')
+REPORTED_NAME = re.compile(r'^(.*) \(([\w-]+)\)$')
+
+read_file = None
+large_bytes = None
+
+_ingests = {}
+_lock = threading.Lock()
+
+
+class ChunkStream(io.RawIOBase):
+    """
+    A readable stream over the chunks of one upload. Chunks may arrive in any order, reading blocks until the
+    next one in order is saved.
+    """
+
+    def __init__(self, total_chunks):
+        super().__init__()
+        self.total_chunks = total_chunks
+        self.next_chunk = 1
+        self.paths = {}
+        self.current = memoryview(b'')
+        self.condition = threading.Condition()
+
+    def add(self, chunk_number, path):
+        with self.condition:
+            self.paths[chunk_number] = path
+            self.condition.notify_all()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self.current):
+            if self.next_chunk > self.total_chunks:
+                return 0
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.next_chunk in self.paths, CHUNK_TIMEOUT):
+                    raise IOError('Upload stalled before chunk {}.'.format(self.next_chunk))
+                path = self.paths[self.next_chunk]
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.current = memoryview(data)
+            self.next_chunk += 1
+        n = min(len(b), len(self.current))
+        b[:n] = self.current[:n]
+        self.current = self.current[n:]
+        return n
+
+
+def configure(reader, min_bytes):
+    """
+    Args:
+        reader: A function which parses a table from a file path, e.g. with the chunked reader and the table cache.
+        min_bytes: Uploads above this size and compressed uploads are written to one file and parsed by reader once
+            they are complete.
+
+    """
+    global read_file, large_bytes
+    read_file, large_bytes = reader, min_bytes
+
+
+def chunk_name(filename, chunk_number):
+    # the file name comes from the client
+    return get_chunk_name(secure_filename(filename) or 'upload', chunk_number)
+
+
+def reported_name(filename, identifier):
+    return '{} ({})'.format(filename, identifier)
+
+
+def split_reported_name(name):
+    """
+    Returns:The file name and the resumable identifier of a name reported by the upload component.
+    """
+    match = REPORTED_NAME.match(name)
+    if match is None:
+        raise KeyError('Unknown upload {}.'.format(name))
+    return match.group(1), match.group(2)
+
+
+def parse_upload(ingest):
+    compressed = ingest['filename'].lower().rsplit('.', 1)[-1] in fn.COMPRESSED_EXTENSIONS
+    try:
+        if read_file is not None and large_bytes is not None and (ingest['total_size'] > large_bytes or compressed):
+            path = os.path.join(ingest['temp_dir'], secure_filename(ingest['filename']) or 'upload')
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(ingest['stream'], f, 1024 * 1024)
+            ingest['table'] = read_file(path)
+        else:
+            ingest['table'] = fn.read_own_stream(io.BufferedReader(ingest['stream'], 1024 * 1024),
+                                                 ingest['filename'])
+    except Exception as e:
+        ingest['error'] = e
+    finally:
+        shutil.rmtree(ingest['temp_dir'], ignore_errors=True)
+        ingest['finished'] = time.time()
+        ingest['done'].set()
+
+
+def prune():
+    # drops the tables of uploads which were never picked up, e.g. after the browser was closed
+    now = time.time()
+    for identifier, ingest in list(_ingests.items()):
+        if ingest['done'].is_set() and now - ingest['finished'] > CHUNK_TIMEOUT:
+            del _ingests[identifier]
+
+
+def start_ingest(identifier, filename, total_chunks, total_size, temp_dir):
+    with _lock:
+        prune()
+        ingest = _ingests.get(identifier)
+        # a failed parse is kept until get_table reports its error, the rest of its chunks is ignored
+        if ingest is not None and (not ingest['done'].is_set() or ingest['error'] is not None):
+            return ingest
+        os.makedirs(temp_dir, exist_ok=True)
+        ingest = {'filename': filename, 'temp_dir': temp_dir, 'total_size': total_size,
+                  'stream': ChunkStream(total_chunks), 'done': threading.Event(), 'finished': None, 'table': None,
+                  'error': None}
+        # chunks saved before a restart of the server are not sent again
+        for chunk_number in range(1, total_chunks + 1):
+            chunk_file = os.path.join(temp_dir, chunk_name(filename, chunk_number))
+            if os.path.isfile(chunk_file):
+                ingest['stream'].add(chunk_number, chunk_file)
+        _ingests[identifier] = ingest
+    thread = threading.Thread(target=parse_upload, args=(ingest,))
+    thread.daemon = True
+    thread.start()
+    return ingest
+
+
+def get_table(name, timeout=CHUNK_TIMEOUT):
+    """
+    Waits for the background parse of an upload to finish and hands its table over, every upload can be picked up
+    once.
+    Args:
+        name: A name reported by the upload component, see reported_name.
+        timeout: Seconds to wait.
+
+    Returns:The parsed Data Frame.
+
+    """
+    filename, identifier = split_reported_name(name)
+    with _lock:
+        ingest = _ingests.get(identifier)
+    if ingest is None:
+        raise KeyError('The upload of {} is no longer available, please upload the file again.'.format(filename))
+    if not ingest['done'].wait(timeout):
+        raise IOError('The upload of {} was not parsed within {} s.'.format(filename, timeout))
+    with _lock:
+        if _ingests.get(identifier) is ingest:
+            del _ingests[identifier]
+    if ingest['error'] is not None:
+        raise ingest['error']
+    return ingest['table']
+
+
+def decorate_server(server, temp_base):
+    # resumable.js uses a GET request to check if it uploaded the file already.
+    @server.route("/upload_resumable", methods=['GET'])
+    def resumable():
+        resumableIdentfier = _request.args.get('resumableIdentifier', type=str)
+        resumableFilename = _request.args.get('resumableFilename', type=str)
+        resumableChunkNumber = _request.args.get('resumableChunkNumber', type=int)
+
+        if not (resumableIdentfier and resumableFilename and resumableChunkNumber):
+            # Parameters are missing or invalid
+            _abort(500, 'Parameter error')
+        if not IDENTIFIER.match(resumableIdentfier):
+            _abort(400, 'Invalid identifier')
+
+        chunk_file = os.path.join(temp_base, resumableIdentfier,
+                                  chunk_name(resumableFilename, resumableChunkNumber))
+        if os.path.isfile(chunk_file):
+            # Let resumable.js know this chunk already exists
+            return 'OK'
+        else:
+            # Let resumable.js know this chunk does not exists and needs to be uploaded
+            _abort(404, 'Not found')
+
+    # if it didn't already upload, resumable.js sends the chunk here
+    @server.route("/upload_resumable", methods=['POST'])
+    def resumable_post():
+        resumableTotalChunks = _request.form.get('resumableTotalChunks', type=int)
+        resumableChunkNumber = _request.form.get('resumableChunkNumber', default=1, type=int)
+        resumableFilename = _request.form.get('resumableFilename', default='error', type=str)
+        resumableIdentfier = _request.form.get('resumableIdentifier', default='error', type=str)
+        resumableTotalSize = _request.form.get('resumableTotalSize', default=0, type=int)
+        if not IDENTIFIER.match(resumableIdentfier):
+            _abort(400, 'Invalid identifier')
+
+        temp_dir = os.path.join(temp_base, resumableIdentfier)
+        ingest = start_ingest(resumableIdentfier, resumableFilename, resumableTotalChunks, resumableTotalSize,
+                              temp_dir)
+        if ingest['error'] is not None:
+            # the upload still completes, so the callback picks up the error
+            return reported_name(resumableFilename, resumableIdentfier)
+
+        # save the chunk under a temporary name, so the parser never reads a partially written chunk
+        chunk_file = os.path.join(temp_dir, chunk_name(resumableFilename, resumableChunkNumber))
+        _request.files['file'].save(chunk_file + '.part')
+        os.rename(chunk_file + '.part', chunk_file)
+        server.logger.debug('Saved chunk: %s', chunk_file)
+        ingest['stream'].add(resumableChunkNumber, chunk_file)
+
+        return reported_name(resumableFilename, resumableIdentfier)
@@ -2,7 +2,7 @@ import os
 import dash_core_components as dcc
 import dash_html_components as html
 from dash_resumable_upload import Upload
-from run import logo_encoded, markers_encoded
+from run import logo_encoded, markers_encoded, job_poll_interval
 
 #########################
 # Dashboard Layout / View
@@ -44,7 +44,7 @@ def apply_app_layout(app):
                         service="/upload_resumable",
                         textLabel="Drag and Drop to upload!",
                         startButton=False,
-                        filetypes=['txt', 'csv'],
+                        filetypes=['txt', 'csv', 'gz', 'bz2', 'xz', 'zst'],
                         completeStyle={'background-color': '#F19F4D', 'font-size': '30px', 'font-size': '1.2vw',
                                        'font-family': 'Arial', 'white-space': 'nowrap', 'padding': '45px',
                                        'color': 'white', 'display': 'fixed', 'justify-content': 'center',
@@ -76,6 +76,13 @@ def apply_app_layout(app):
                 ], className='input_samples',
                 ),
                 html.Div([
+                    dcc.RadioItems(
+                        id='radio-design',
+                        options=[{'label': 'Independent groups', 'value': 'unpaired'},
+                                 {'label': 'Paired by subject (LFQ_<subject>_TP<n>)', 'value': 'paired'}],
+                        value='unpaired',
+                        labelStyle={'display': 'inline-block'}
+                    ),
                     html.Button(
                         'Submit',
                         id='button',
@@ -84,7 +91,14 @@ def apply_app_layout(app):
                     html.Div(id='intermediate-value', style={'display': 'none'}
                              ),
                     html.Div(id='intermediate-value-heatmap', style={'display': 'none'}
-                             )
+                             ),
+                    # ids of the background jobs, polled while they run
+                    html.Div(id='job-analysis', style={'display': 'none'}),
+                    html.Div(id='job-heatmap', style={'display': 'none'}),
+                    html.Div(id='job-cancelled', style={'display': 'none'}),
+                    dcc.Interval(id='interval-jobs', interval=job_poll_interval, n_intervals=0, disabled=True),
+                    html.Div(id='job-progress'),
+                    html.Button('Cancel', id='button-cancel', style={'display': 'none'}),
                 ],
                     className='submit_button'),
             ], className='six columns all_buttons'),
@@ -146,10 +160,25 @@ def apply_app_layout(app):
                     id='barchart-coagulation',
                 ),
                 html.Button(id='button-report'),
+                dcc.RadioItems(
+                    id='radio-report-format',
+                ),
                 html.A(
                     'Download Data',
                     id='download-link',
-                    download="rawdata.csv",
+                    download="",
+                    target="_blank"
+                ),
+                dcc.Input(
+                    id='input-contrasts',
+                    placeholder='Contrasts, e.g. "TP4 vs TP1, TP7 vs TP1" (every timepoint vs control if empty)',
+                    type='text',
+                    value='',
+                ),
+                html.A(
+                    'Download All Contrasts',
+                    id='download-contrasts',
+                    download="contrasts.csv",
                     target="_blank"
                 ),
                 html.Hr(),
@@ -165,6 +194,9 @@ def apply_app_layout(app):
                 dcc.Graph(
                     id='plot-heatmap',
                 ),
+                dcc.Graph(
+                    id='plot-heatmap-overlay',
+                ),
             ], className='eight columns heatmap-plot')
 
         ], style={'display': 'none'}
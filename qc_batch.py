@@ -0,0 +1,42 @@
+import argparse
+
+from ms_qualitycontrol.batch import run_batch
+from run import cache_path, cache_max_bytes, marker_file, panels_path, stats_equal_var, stats_dtype, fdr_level, \
+    fdr_permutations, fdr_s0, fdr_seed
+
+# Runs the quality control of the web interface for every protein table of a directory, e.g.
+#   python qc_batch.py weekly_runs/ qc_results/ --control TP1 --samples TP4 --processes 8
+# Every file gets a table of contamination ratios and flagged samples (<file>.qc.csv), summary.csv lists all files.
+# --cohort cohort.json collects the ratios of all studies, a later run with --baseline cohort.json scores new
+# studies against them.
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Quality control of the plasma proteome for a directory of '
+                                                 'protein tables (.txt/.csv, optionally compressed).')
+    parser.add_argument('input_dir', help='directory with the protein tables, e.g. proteinGroups.txt files')
+    parser.add_argument('output_dir', help='directory for the result tables and summary.csv')
+    parser.add_argument('--control', required=True, help='identifier of the control group columns, e.g. TP1')
+    parser.add_argument('--samples', default='', help='identifier of the samples group columns, '
+                                                      'every other column if empty')
+    parser.add_argument('--paired', action='store_true', help='paired design from the subject/timepoint headers')
+    parser.add_argument('--sd', type=float, default=3, help='standard deviations of the flag thresholds')
+    parser.add_argument('--pattern', default='*', help='file name pattern, e.g. "*proteinGroups*"')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, all CPUs by default')
+    parser.add_argument('--resume', action='store_true', help='skip files with a result from a previous run')
+    parser.add_argument('--cohort', default=None, help='cohort file to which the ratios of every study are added')
+    parser.add_argument('--baseline', default=None, help='cohort file to score every study against')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    options = {'stats_equal_var': stats_equal_var, 'stats_dtype': stats_dtype, 'fdr_level': fdr_level,
+               'fdr_permutations': fdr_permutations, 'fdr_s0': fdr_s0, 'fdr_seed': fdr_seed,
+               'cache_path': cache_path, 'cache_max_bytes': cache_max_bytes}
+    summary = run_batch(args.input_dir, args.output_dir, args.control, args.samples, paired=args.paired,
+                        num_std=args.sd, processes=args.processes, resume=args.resume, pattern=args.pattern,
+                        marker_sources=[(marker_file, cache_path), (panels_path, cache_path)], options=options,
+                        cohort_file=args.cohort, baseline_file=args.baseline)
+    failed = summary[summary['status'] != 'ok']
+    print('{} files, {} failed'.format(len(summary), len(failed)))
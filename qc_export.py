@@ -0,0 +1,45 @@
+import argparse
+
+from ms_qualitycontrol.export import run_export, IMAGE_FORMATS
+from run import cache_path, cache_max_bytes, marker_file, panels_path, stats_equal_var, stats_dtype, fdr_level, \
+    fdr_permutations, fdr_s0, fdr_seed, volcano_max_points, heatmap_method, heatmap_dtype, heatmap_max_cells, \
+    heatmap_cluster_exact_max, heatmap_cluster_dims, heatmap_preclusters
+
+# Exports the figures of the web interface for every protein table of a directory, e.g.
+#   python qc_export.py weekly_runs/ qc_reports/ --control TP1 --samples TP4 --format html png --processes 8
+# Every file gets a self-contained <file>.report.html and/or <file>.<figure>.png, export.csv lists all files.
+# Image formats need plotly >= 3.2 with orca, the HTML reports work with every plotly version.
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Offline QC reports (contamination bar charts, volcano plot and '
+                                                 'correlation map) for a directory of protein tables.')
+    parser.add_argument('input_dir', help='directory with the protein tables, e.g. proteinGroups.txt files')
+    parser.add_argument('output_dir', help='directory for the reports and export.csv')
+    parser.add_argument('--control', required=True, help='identifier of the control group columns, e.g. TP1')
+    parser.add_argument('--samples', default='', help='identifier of the samples group columns, '
+                                                      'every other column if empty')
+    parser.add_argument('--paired', action='store_true', help='paired design from the subject/timepoint headers')
+    parser.add_argument('--sd', type=float, default=3, help='standard deviations of the flag thresholds')
+    parser.add_argument('--format', nargs='+', default=['html'], choices=['html'] + IMAGE_FORMATS,
+                        help='html reports and/or one image per figure')
+    parser.add_argument('--pattern', default='*', help='file name pattern, e.g. "*proteinGroups*"')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, all CPUs by default')
+    parser.add_argument('--resume', action='store_true', help='skip files with all outputs from a previous run')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    options = {'stats_equal_var': stats_equal_var, 'stats_dtype': stats_dtype, 'fdr_level': fdr_level,
+               'fdr_permutations': fdr_permutations, 'fdr_s0': fdr_s0, 'fdr_seed': fdr_seed,
+               'cache_path': cache_path, 'cache_max_bytes': cache_max_bytes, 'volcano_max_points': volcano_max_points,
+               'heatmap_method': heatmap_method, 'heatmap_dtype': heatmap_dtype, 'heatmap_max_cells': heatmap_max_cells,
+               'heatmap_cluster_exact_max': heatmap_cluster_exact_max, 'heatmap_cluster_dims': heatmap_cluster_dims,
+               'heatmap_preclusters': heatmap_preclusters}
+    summary = run_export(args.input_dir, args.output_dir, args.control, args.samples, paired=args.paired,
+                         num_std=args.sd, formats=args.format, processes=args.processes, resume=args.resume,
+                         pattern=args.pattern, marker_sources=[(marker_file, cache_path), (panels_path, cache_path)],
+                         options=options)
+    failed = summary[summary['status'] != 'ok']
+    print('{} files, {} failed'.format(len(summary), len(failed)))
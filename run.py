@@ -1,8 +1,5 @@
 import os
 import base64
-from dash_resumable_upload import decorate_server
-from ms_qualitycontrol import app
-import pandas as pd
 
 def clean_directory(file_path):
     for root, dirs, files in os.walk(file_path, topdown=False):
@@ -19,17 +16,67 @@ markers_encoded = base64.b64encode(open(marker, 'rb').read())
 warning_encoded = base64.b64encode(open(warning, 'rb').read())
 
 dir_path = "uploads"
+cache_path = "cache"
+cache_max_bytes = 1024 * 1024 * 1024  # 1 GB
+# files above this size are parsed in row chunks into a float32 LFQ matrix
+stream_min_bytes = 256 * 1024 * 1024  # 256 MB
+stream_chunksize = 20000
+stream_dtype = 'float32'
+# datasets shared between callbacks are kept on the server, the oldest are spilled to disk above the memory cap
+store_path = "store"
+store_max_bytes = 2 * 1024 * 1024 * 1024  # 2 GB
+# the files of the least recently used datasets are deleted above the disk cap
+store_max_disk_bytes = 20 * 1024 * 1024 * 1024  # 20 GB
+# studies whose LFQ matrix is estimated above this size are analysed out of core from memory-mapped files
+memory_budget_bytes = 4 * 1024 * 1024 * 1024  # 4 GB
+# Student's (True) or Welch's (False) t-test, 'float32' halves the memory of the statistics on large studies
+stats_equal_var = True
+stats_dtype = 'float64'
+# worker processes for large sets of contrasts, None uses all CPUs
+contrast_processes = None
+# significant proteins of the volcano plot pass a permutation-based (SAM) FDR, s0 = None uses the median standard error
+fdr_level = 0.05
+fdr_permutations = 1000
+fdr_s0 = None
+fdr_seed = 0
+fdr_processes = None
+# the volcano plot is drawn with WebGL, above volcano_max_points the non-significant other proteins are thinned out
+# to one point per pixel block (None keeps all points), markers and significant proteins are always drawn
+volcano_webgl = True
+volcano_max_points = None
+# correlation of the global correlation map, 'pearson' or 'spearman', threads = None uses all CPUs
+# (spearman ranks every pair of proteins with missing values separately, which is much slower)
+heatmap_method = 'pearson'
+heatmap_dtype = 'float64'
+heatmap_threads = None
+# maps with more proteins are sent as a block-averaged overview, zooming in loads the visible range in more detail
+heatmap_max_cells = 600
+# maps with more proteins are clustered with bounded memory: a nearest-neighbor-chain Ward on a random projection
+# of the correlation profiles to heatmap_cluster_dims dimensions. Above heatmap_preclusters proteins, that many
+# k-means clusters are formed first (None never pre-clusters).
+heatmap_cluster_exact_max = 5000
+heatmap_cluster_dims = 256
+heatmap_preclusters = None
+# the analysis and the correlation map run in background worker processes polled every job_poll_interval ms,
+# 0 processes runs them in the request threads
+job_processes = 2
+job_poll_interval = 1000
 
 example_file = 'data/example_Weight_loss_study.txt'
 
-platelet_contamination_markers = pd.read_excel('data/Marker List.xlsx', sheet_name='Platelets')
-erythrocyte_contamination_markers = pd.read_excel('data/Marker List.xlsx', sheet_name='Erythrocytes')
-coagulation_contamination_markers = pd.read_excel('data/Marker List.xlsx', sheet_name='Coagulation')
+# marker panels are compiled on first use, additional panel files (.xlsx/.txt/.csv) can be put into panels_path
+marker_file = 'data/Marker List.xlsx'
+panels_path = 'data/panels'
 
 # start Flask server
 if __name__ == '__main__':
+    # the app is only imported here, so scripts like qc_batch.py can import the settings without Dash
+    from ms_qualitycontrol.app import app
+    from ms_qualitycontrol import controller
+    from ms_qualitycontrol.upload import decorate_server
 
     clean_directory(dir_path)
+    clean_directory(store_path)
 
     decorate_server(app.server, dir_path)
     app.scripts.config.serve_locally = True  # Uploaded to npm, this can work online now too.